@@ -0,0 +1,237 @@
+import os
+import sys
+import json
+import struct
+import ctypes
+
+from array import array
+
+from . import CacheHelper
+
+
+'''compiled annotation index for the aggregate files
+
+    the six annotation files are compiled into one memory mapped file holding, for every
+    (model, transcript index) pair, the annotation columns exactly as they are written into the
+    aggregate rows. The index is recompiled only when one of the source files changes.
+
+    layout:
+        header      - magic, entry count, model count, length of the json source fingerprints
+        sources     - json list of (path, size, mtime, sha1) of the annotation files
+        models      - newline separated model names
+        first       - per model: position of its first entry (uint32)
+        count       - per model: number of entries (uint32)
+        indexes     - per entry: transcript index (uint32)
+        offsets     - per entry + 1: offset into text (unsigned long)
+        text        - concatenated annotation columns
+    '''
+
+
+MAGIC = 'RNAAIDX1'
+HEADER = struct.Struct('<8sIII')
+
+ANNOTATION_FILES = {
+    "nr": "nr_annotation.tsv",
+    "swiss": "Swiss_annotation.tsv",
+    "trembl": "trEMBL_annotation.tsv",
+    "keyword": "Keywords.tsv",
+    "pfam": "PFAMAnnotation.tsv",
+    "phyto": "v6/Gmax_109_annotation_info.txt"
+}
+SORTED_ANNOTATION = [
+    "keyword",
+    "nr",
+    "swiss",
+    "trembl",
+    "phyto",
+    "pfam"]
+PHYTO_COLUMNS = 8
+PHYTO_INDEXES = range(1, 11)
+# annotation columns of a (model, index) without any annotation
+EMPTY = '\t'.join([''] * len(SORTED_ANNOTATION))
+
+
+def _uint32():
+    a = array('I')
+    if a.itemsize != 4:
+        a = array('L')
+    return a
+
+
+def compile_annotations(annotationpath):
+    '''returns {(model, index): annotation columns} for every annotated (model, index)
+
+    reproduces the nested annotation dicts the aggregate was built from:
+        - a model's lines in a file are numbered from 1 (restarting whenever the model changes)
+        - several lines landing on the same (model, index) are tab joined
+        - the phytozome loader kept one shared list, so every model in that file carries the
+          accumulated (last non-empty value per column) phytozome columns for indexes 1-10
+        - any other (model, index) gets "None" for the 8 phytozome columns'''
+    groups = [g for g in SORTED_ANNOTATION if g != "phyto"]
+    entries = dict()
+    for slot, group in enumerate(groups):
+        with open(os.path.join(annotationpath, ANNOTATION_FILES[group])) as fh:
+            fh.readline()
+            lmodel = ''
+            for line in fh:
+                sp = line.strip().partition("\t")
+                model, content = sp[0].strip(), sp[2].strip()
+                if model != lmodel:
+                    i = 1
+                    lmodel = model
+                entry = entries.get((model, i))
+                if entry is None:
+                    entry = entries[(model, i)] = [None] * len(groups)
+                if entry[slot] is None:
+                    entry[slot] = content
+                else:
+                    entry[slot] += '\t' + content
+                i += 1
+    phyto_models = set()
+    anno = ["None"] * PHYTO_COLUMNS
+    with open(os.path.join(annotationpath, ANNOTATION_FILES["phyto"])) as fh:
+        fh.readline()
+        for line in fh:
+            sp = line.strip().split('\t')
+            phyto_models.add(sp[0])
+            for i, x in enumerate(sp[1:]):
+                if x.strip() != '':
+                    anno[i] = x
+    phyto = '\t'.join(anno)
+    no_phyto = '\t'.join(["None"] * PHYTO_COLUMNS)
+    for model in phyto_models:
+        for i in PHYTO_INDEXES:
+            if (model, i) not in entries:
+                entries[(model, i)] = [None] * len(groups)
+    compiled = dict()
+    phyto_slot = SORTED_ANNOTATION.index("phyto")
+    for (model, i), entry in entries.iteritems():
+        columns = [e if e is not None else '' for e in entry]
+        if model in phyto_models and i in PHYTO_INDEXES:
+            columns.insert(phyto_slot, phyto)
+        else:
+            columns.insert(phyto_slot, no_phyto)
+        compiled[(model, i)] = '\t'.join(columns)
+    return compiled
+
+
+class AnnotationIndex(object):
+    '''read only, memory mapped view of the compiled annotations'''
+
+    def __init__(self, annotationpath, folder=None):
+        self.annotationpath = annotationpath
+        self.sources = [os.path.join(annotationpath, f)
+                        for g, f in sorted(ANNOTATION_FILES.items())]
+        self.indexfile = os.path.join(
+            CacheHelper.cache_folder('annotations', folder),
+            CacheHelper.key_name(os.path.abspath(annotationpath)) + '.aidx')
+        if not self._load():
+            self.build()
+            self._load()
+
+    def _load(self):
+        if not os.path.isfile(self.indexfile):
+            return False
+        self.mm = CacheHelper.map_file(self.indexfile)
+        magic, count, nmodels, sourceslen = HEADER.unpack_from(self.mm, 0)
+        pos = HEADER.size
+        if magic != MAGIC or not self._is_current(json.loads(self.mm[pos:pos + sourceslen])):
+            self.mm.close()
+            return False
+        pos += sourceslen
+        modelslen = struct.unpack_from('<Q', self.mm, pos)[0]
+        pos += 8
+        names = self.mm[pos:pos + modelslen]
+        pos += modelslen
+        self.models = names.split('\n') if nmodels else []
+        # the numbers are read in place (see CacheHelper.view), not copied into this process
+        self.first, pos = CacheHelper.view(self.mm, pos, nmodels)
+        self.count, pos = CacheHelper.view(self.mm, pos, nmodels)
+        self.indexes, pos = CacheHelper.view(self.mm, pos, count)
+        self.offsets, pos = CacheHelper.view(self.mm, pos, count + 1, ctypes.c_ulong)
+        self.text_start = pos
+        self.positions = dict((m, i) for i, m in enumerate(self.models))
+        return True
+
+    def _is_current(self, sources):
+        '''stat first, content hash only for files whose size or mtime changed'''
+        if [s[0] for s in sources] != [os.path.abspath(f) for f in self.sources]:
+            return False
+        for (path, size, mtime, sha), filename in zip(sources, self.sources):
+            try:
+                cpath, csize, cmtime = CacheHelper.file_stat(filename)
+            except OSError:
+                return False
+            if (csize, cmtime) == (size, mtime):
+                continue
+            if csize != size or CacheHelper.content_hash(filename) != sha:
+                return False
+        return True
+
+    def build(self):
+        print "compiling annotations in %s" % self.annotationpath
+        sources = [CacheHelper.fingerprint(f) for f in self.sources]
+        compiled = compile_annotations(self.annotationpath)
+        keys = sorted(compiled)
+        models = list()
+        first = _uint32()
+        count = _uint32()
+        indexes = _uint32()
+        offsets = array('L')
+        total = 0
+        for model, i in keys:
+            if not models or models[-1] != model:
+                models.append(model)
+                first.append(len(indexes))
+                count.append(0)
+            count[-1] += 1
+            indexes.append(i)
+            offsets.append(total)
+            total += len(compiled[(model, i)])
+        offsets.append(total)
+        sourcesjson = json.dumps(sources)
+        names = '\n'.join(models)
+        with CacheHelper.atomic_open(self.indexfile) as fh:
+            fh.write(HEADER.pack(MAGIC, len(keys), len(models), len(sourcesjson)))
+            fh.write(sourcesjson)
+            fh.write(struct.pack('<Q', len(names)))
+            fh.write(names)
+            for a in (first, count, indexes, offsets):
+                fh.write(a.tostring())
+            for key in keys:
+                fh.write(compiled[key])
+        return
+
+    def get(self, model, i):
+        '''annotation columns (tab joined) of a model's i-th transcript row'''
+        m = self.positions.get(model)
+        if m is None:
+            return EMPTY
+        start = self.first[m]
+        for entry in xrange(start, start + self.count[m]):
+            if self.indexes[entry] == i:
+                base = self.text_start
+                return self.mm[base + self.offsets[entry]:base + self.offsets[entry + 1]]
+        return EMPTY
+
+    def items(self, model):
+        '''(transcript index, annotation columns) of every annotated row of a model, by index'''
+        m = self.positions.get(model)
+        if m is None:
+            return []
+        start = self.first[m]
+        base = self.text_start
+        return [(self.indexes[entry], self.mm[base + self.offsets[entry]:base + self.offsets[entry + 1]])
+                for entry in xrange(start, start + self.count[m])]
+
+    def close(self):
+        '''drops the mapping, it is unmapped once no view of it is left'''
+        self.first = self.count = self.indexes = self.offsets = self.mm = None
+
+
+def main():
+    index = AnnotationIndex(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None)
+    print "%s annotated models in %s" % (len(index.models), index.indexfile)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,238 @@
+import os
+import sys
+import json
+import time
+import shutil
+import sqlite3 as db
+import argparse
+import subprocess
+
+from . import SyntheticData
+from . import FakeBowtie
+
+
+'''end to end benchmark of the pipeline on synthetic data with the fake bowtie
+
+    the synthetic inputs (SyntheticData) and the fake bowtie & bowtie-build (FakeBowtie) go into a
+    work folder. Every benchmark starts from empty outputs with its own config & ledger (RNASEQ_DB),
+    the pipeline config in rnaseq.sqlite is never touched.
+    Each stage runs in its own process, its wall & cpu time and peak RSS (of the stage's largest
+    process, bowtie & the worker processes included) come from wait4:
+        align       - every library aligned the way runPipeline queues them (the index build included)
+        count       - hits & rpkms of every alignment file (RPKMbyDirectory)
+        aggregate   - the aggregate Hit & RPKM files (Pipeline.Aggregate)
+        split       - the aggregate RPKM file split in two halves (tsv_splitter.Splitter)
+    -save writes the results as json, -baseline compares a run against saved results.
+    '''
+
+
+STAGES = ["align", "count", "aggregate", "split"]
+
+
+def _files(folder):
+    if not os.path.isdir(folder):
+        return []
+    return [os.path.join(folder, f) for f in sorted(os.listdir(folder)) if not f.startswith('.')]
+
+
+def _bytes(filenames):
+    return sum(os.path.getsize(f) for f in filenames)
+
+
+def aggregate_file(config):
+    '''the aggregate RPKM file of the last aggregate (from its manifest)'''
+    with open(os.path.join(config["Aggregate Output"], 'aggregate.manifest.json')) as fh:
+        return json.load(fh)["rpkms"]
+
+
+def _lines(filenames):
+    lines = 0
+    for filename in filenames:
+        with open(filename, 'rb') as fh:
+            for block in iter(lambda: fh.read(4 * 1024 * 1024), ''):
+                lines += block.count('\n')
+    return lines
+
+
+class Benchmark(object):
+
+    def __init__(self, work, libraries=4, reads=100000, models=2000, read_length=36, seed=1,
+                 rate=0, cores=None):
+        self.work = os.path.abspath(work)
+        self.data = os.path.join(self.work, 'data')
+        self.run_folder = os.path.join(self.work, 'run')
+        self.dbfile = os.path.join(self.run_folder, 'benchmark.sqlite')
+        self.params = SyntheticData.generate(self.data, libraries, reads, models, read_length, seed)
+        self.bin = FakeBowtie.install(os.path.join(self.work, 'bin'), rate)
+        self.cores = cores
+        self.results = list()
+
+    def config(self):
+        folder = self.run_folder
+        return {
+            "Bowtie Path": self.bin,
+            "Reference Path": os.path.join(self.data, 'reference.fa'),
+            "-v": "2",
+            "-a": "True",
+            "-m": "25",
+            "-p": str(self.cores or 2),
+            "Raw Path": os.path.join(self.data, 'raw'),
+            "GlymaFile": os.path.join(self.data, 'glyma.tsv'),
+            "Annotation Path": os.path.join(self.data, 'annotation'),
+            "Glyma Column": "2",
+            "Bowtie Column": "2",
+            "Bowtie Output": os.path.join(folder, 'bowtie'),
+            "RPKM Output": os.path.join(folder, 'rpkm'),
+            "RPKM Path": os.path.join(folder, 'rpkm'),
+            "Aggregate Output": os.path.join(folder, 'aggregate'),
+            "Cache Path": os.path.join(folder, 'cache'),
+            # the result cache would turn every count after the first into a lookup
+            "Cache Size": "0",
+            "Split": str(self.params["libraries"] // 2 + 1),
+            "Max Cores": str(self.cores or ''),
+        }
+
+    def prepare(self):
+        '''empty output folders, the benchmark config & a manifest that lets the batch run build the index'''
+        if os.path.isdir(self.run_folder):
+            shutil.rmtree(self.run_folder)
+        config = self.config()
+        for folder in ["Bowtie Output", "RPKM Output", "Cache Path"]:
+            os.makedirs(config[folder])
+        for folder in ["Hits", "RPKMs"]:
+            os.makedirs(os.path.join(config["Aggregate Output"], folder))
+        conn = db.connect(self.dbfile)
+        conn.execute("create table pipelineconfig (optionname VARCHAR(1000), optionvalue VARCHAR(1000));")
+        conn.executemany("insert into pipelineconfig values (?, ?)",
+                         [(k, v) for k, v in sorted(config.items()) if v != ''])
+        conn.commit()
+        conn.close()
+        with open(os.path.join(self.run_folder, 'manifest.json'), 'w') as fh:
+            json.dump({"build_index": True}, fh)
+        return
+
+    def run_stage(self, stage):
+        '''runs a stage in a child process, returns its result dict'''
+        env = dict(os.environ)
+        env["RNASEQ_DB"] = self.dbfile
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env["PYTHONPATH"] = root + (os.pathsep + env["PYTHONPATH"] if env.get("PYTHONPATH") else '')
+        log = open(os.path.join(self.run_folder, stage + '.log'), 'w')
+        started = time.time()
+        child = subprocess.Popen([sys.executable, '-m', 'Pipeline.Benchmark', '-stage', stage, self.work],
+                                 env=env, cwd=self.run_folder, stdout=log, stderr=subprocess.STDOUT)
+        pid, status, usage = os.wait4(child.pid, 0)
+        child.returncode = status
+        wall = time.time() - started
+        log.close()
+        items, unit, size = self.measure(stage) if status == 0 else (0, "", 0)
+        result = {"stage": stage, "wall": wall, "cpu": usage.ru_utime + usage.ru_stime,
+                  "peak_rss": usage.ru_maxrss * 1024, "items": items, "unit": unit, "bytes": size,
+                  "ok": status == 0}
+        self.results.append(result)
+        return result
+
+    def measure(self, stage):
+        '''(items, unit, bytes) a stage processed, read from its inputs & outputs'''
+        config = self.config()
+        if stage == "align":
+            raw = _files(config["Raw Path"])
+            return self.params["libraries"] * self.params["reads"], "reads", _bytes(raw)
+        if stage == "count":
+            alignments = _files(config["Bowtie Output"])
+            return _lines(alignments), "alignments", _bytes(alignments)
+        aggregate = [aggregate_file(config)]
+        if stage == "aggregate":
+            return _lines(aggregate) - 1, "rows", _bytes(aggregate)
+        return _lines(aggregate), "lines", _bytes(aggregate)
+
+    def run(self, stages=STAGES):
+        self.prepare()
+        for stage in stages:
+            result = self.run_stage(stage)
+            if not result["ok"]:
+                print "%s failed, see %s" % (stage, os.path.join(self.run_folder, stage + '.log'))
+                break
+        return self.results
+
+    def report(self, baseline=None):
+        previous = dict((r["stage"], r) for r in (baseline or {}).get("results", []))
+        print "%s libraries x %s reads, %s models" % (
+            self.params["libraries"], self.params["reads"], self.params["models"])
+        print "\t".join(["stage", "wall", "cpu", "peak MB", "throughput", "MB/s"] + (["vs baseline"] if previous else []))
+        for r in self.results:
+            line = [r["stage"] + ("" if r["ok"] else " (failed)"),
+                    "%.2fs" % r["wall"], "%.2fs" % r["cpu"], "%.1f" % (r["peak_rss"] / 1024.0 ** 2),
+                    "%.0f %s/s" % (r["items"] / r["wall"], r["unit"]) if r["wall"] else "-",
+                    "%.2f" % (r["bytes"] / 1024.0 ** 2 / r["wall"]) if r["wall"] else "-"]
+            if r["stage"] in previous and previous[r["stage"]]["wall"]:
+                line.append("%.2fx wall" % (r["wall"] / previous[r["stage"]]["wall"]))
+            print "\t".join(line)
+        return
+
+    def save(self, filename):
+        with open(filename, 'w') as fh:
+            json.dump({"params": self.params, "results": self.results}, fh, indent=1, sort_keys=True)
+        return
+
+
+def run_stage(stage, work):
+    '''the stage itself, run in the child process against the RNASEQ_DB config'''
+    from . import DBManager as DB
+    from .Pipeline2 import Pipeline
+    from .tsv_splitter import Splitter
+    manifest = os.path.join(work, 'run', 'manifest.json')
+    config = DB.DBM.config
+    if stage == "align":
+        pipe = Pipeline(manifest=manifest)
+        pipe.metrics.start_run()
+        pipe.queueBowties()
+        pipe.metrics.finish()
+        missing = [lib for lib, bowtie in pipe.manager.items() if not os.path.isfile(bowtie.output)]
+        if missing:
+            raise SystemExit("not aligned: %s" % ", ".join(sorted(missing)))
+    elif stage == "count":
+        Pipeline(manifest=manifest).RPKMbyDirectory(config["Bowtie Output"])
+    elif stage == "aggregate":
+        Pipeline(manifest=manifest).runAggregate()
+    elif stage == "split":
+        Splitter(entryfile=aggregate_file(config), cutpoints=[int(config["Split"])])
+    else:
+        raise SystemExit("unknown stage %s" % stage)
+    return
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmarks the pipeline stages on synthetic data")
+    parser.add_argument('work', nargs='?', default='benchmark', help="work folder (inputs are kept & reused)")
+    parser.add_argument('-libraries', type=int, default=4)
+    parser.add_argument('-reads', type=int, default=100000, help="reads per library")
+    parser.add_argument('-models', type=int, default=2000)
+    parser.add_argument('-length', type=int, default=36, help="read length")
+    parser.add_argument('-seed', type=int, default=1)
+    parser.add_argument('-rate', type=float, default=0, help="fake bowtie reads per second & process, 0 = unthrottled")
+    parser.add_argument('-cores', type=int, default=None, help="\"Max Cores\" of the benchmark config")
+    parser.add_argument('-stages', default=",".join(STAGES), help="comma separated stages to run")
+    parser.add_argument('-save', help="write the results to this json file")
+    parser.add_argument('-baseline', help="json results of an earlier run to compare against")
+    parser.add_argument('-stage', help=argparse.SUPPRESS)
+    p = parser.parse_args()
+    if p.stage:
+        run_stage(p.stage, os.path.abspath(p.work))
+        return
+    stages = [s.strip() for s in p.stages.split(',') if s.strip()]
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        parser.error("unknown stages: %s" % ", ".join(sorted(unknown)))
+    bench = Benchmark(p.work, p.libraries, p.reads, p.models, p.length, p.seed, p.rate, p.cores)
+    bench.run(stages)
+    baseline = None
+    if p.baseline:
+        with open(p.baseline) as fh:
+            baseline = json.load(fh)
+    bench.report(baseline)
+    if p.save:
+        bench.save(p.save)
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,22 @@
 import os
+import re
 import sys
 import subprocess
+import tempfile
 import sqlite3 as db
 import random
+import gzip
+import shutil
+import threading
 
 from collections import defaultdict
 from datetime import datetime
 
 from . import fs_autocomplete
+from . import CacheHelper
+from . import Metrics
+from .HitCounter import HitCounter
+from .IndexCache import IndexCache
 
 
 '''
@@ -22,6 +31,46 @@ v1 needs:
 '''
 
 
+def record_blocks(filename, fastq=True, block_size=1024 * 1024):
+    '''yields the reads of a FASTQ (4 lines per read) or FASTA file in blocks of whole records
+    (gzip compressed files are read through gzip)'''
+    opener = gzip.open if filename.endswith('.gz') else open
+    carry = ''
+    with opener(filename, 'rb') as fh:
+        while True:
+            block = fh.read(block_size)
+            if not block:
+                break
+            data = carry + block
+            if fastq:
+                lines = data.split('\n')
+                cut = (len(lines) - 1) - (len(lines) - 1) % 4
+                if cut == 0:
+                    carry = data
+                    continue
+                carry = '\n'.join(lines[cut:])
+                yield '\n'.join(lines[:cut]) + '\n'
+            else:
+                cut = data.rfind('\n>')
+                if cut == -1:
+                    carry = data
+                    continue
+                carry = data[cut + 1:]
+                yield data[:cut + 1]
+    if carry:
+        yield carry if carry.endswith('\n') else carry + '\n'
+
+
+def bowtie_summary(errfile):
+    '''echoes bowtie's stderr (collected in errfile) and returns the number of reads it processed (None if not reported)'''
+    errfile.seek(0)
+    text = errfile.read()
+    errfile.close()
+    sys.stderr.write(text)
+    match = re.search(r'# reads processed: (\d+)', text)
+    return int(match.group(1)) if match else None
+
+
 class Bowtie:
 
     def __init__(
@@ -34,7 +83,20 @@ class Bowtie:
             output=None,
             bowtieFolder=None,
             indexFolder=None,
+            threads=8,
+            interactive=True,
+            build_index=False,
+            build_folder=None,
+            build_name=None,
+            shards=1,
+            cache_folder=None,
+            cache_size=0,
             **kwargs):
+        '''interactive=False never prompts: an unknown query format raises ValueError and an index that is
+        neither next to the reference nor in the index cache is built (build_index=True, into
+        build_folder/build_name or the index cache) or raises IOError
+        cache_folder, cache_size - shared index cache (see IndexCache) a reference FASTA is indexed in, size in GB
+        shards - number of bowtie processes a streamed alignment is split across (see shardBowtie)'''
 
         self.query = query
         self.reference = reference
@@ -44,7 +106,19 @@ class Bowtie:
         self.suppress_alignments_above = suppress_alignments_above
         self.bowtieFolder = bowtieFolder
         self.defaultIndex = indexFolder
+        self.threads = threads
+        self.interactive = interactive
+        self.build_index = build_index
+        self.build_folder = build_folder
+        self.build_name = build_name
+        self.shards = max(1, int(shards))
+        self.cache_folder = cache_folder
+        self.cache_size = cache_size
+        self.index_cache = None
         self.duration = None
+        # (cpu seconds, peak RSS bytes) of the bowtie process(es) & the reads they aligned in the last run
+        self.usage = None
+        self.reads = None
 
     def updateKwargs(self, kwargs):
         '''set kwargs as attributes of the Bowtie object'''
@@ -62,44 +136,188 @@ class Bowtie:
             "Please enter in the output file: ")
         self.runBowtie()
 
-    def runBowtie(self):
-        '''call Bowtie function
+    def bowtieCommand(self, output=None, query=None, threads=None):
+        '''builds the bowtie command line
             report - report all sequenced alignemnts
             fastAQ - determines input filetype
-            checkReference & checkOutput confirm inputs are valid    
+            without an output file bowtie writes the alignments to stdout
+            query/threads - override the query (e.g. "-" for reads on stdin) and thread count
         '''
-        startTime = datetime.now()
         app = os.path.join(self.bowtieFolder, 'bowtie')
         report = ''
         fastAQ = self.checkQuery(self.query)
         self.checkReference(self.reference)
-        self.checkOutput(self.output)
         if self.report_all_alignments:
             report = '-a'
         cmd = [app,
                fastAQ,
                '-p',
-               '8',
+               str(threads or self.threads),
                '-v',
                str(self.mismatches),
                report,
                '-m',
                str(self.suppress_alignments_above),
                self.reference,
-               self.query,
-               self.output]
-        run = subprocess.call(cmd, stdout=subprocess.PIPE)
-        self.duration = datetime.now() - startTime()
+               query or self.query]
+        if output:
+            cmd.append(output)
+        return [arg for arg in cmd if arg != '']
+
+    def runBowtie(self):
+        '''call Bowtie function
+            checkReference & checkOutput confirm inputs are valid    
+            the alignments are written under a temporary name and renamed into place once bowtie succeeded,
+            so a killed run never leaves a truncated output behind
+        '''
+        startTime = datetime.now()
+        self.checkOutput(self.output)
+        partial = CacheHelper.temp_name(self.output)
+        cmd = self.bowtieCommand(partial)
+        try:
+            errfile = tempfile.TemporaryFile()
+            run, self.usage = Metrics.wait(subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=errfile))
+            self.reads = bowtie_summary(errfile)
+            if run != 0:
+                raise subprocess.CalledProcessError(run, ' '.join(cmd))
+            os.rename(partial, self.output)
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
+        self.duration = datetime.now() - startTime
         return
 
+    def streamBowtie(self, counter, tee=None):
+        '''runs bowtie with the alignments on stdout and feeds them straight into a HitCounter
+            tee - optional path for a gzip compressed copy of the alignments (renamed into place once bowtie succeeded)'''
+        startTime = datetime.now()
+        cmd = self.bowtieCommand()
+        teefh = None
+        if tee:
+            self.checkOutput(tee)
+            partial = CacheHelper.temp_name(tee)
+            teefh = gzip.open(partial, 'wb', 1)
+        errfile = tempfile.TemporaryFile()
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=errfile, bufsize=-1)
+        try:
+            try:
+                while True:
+                    chunk = proc.stdout.read(counter.chunk_size)
+                    if not chunk:
+                        break
+                    # keep draining the pipe even if the counter stopped so bowtie never blocks
+                    counter.feed(chunk)
+                    if teefh:
+                        teefh.write(chunk)
+            finally:
+                proc.stdout.close()
+                returncode, self.usage = Metrics.wait(proc)
+                self.reads = bowtie_summary(errfile)
+                if teefh:
+                    teefh.close()
+            counter.close()
+            if returncode != 0:
+                raise subprocess.CalledProcessError(returncode, ' '.join(cmd))
+            if teefh:
+                os.rename(partial, tee)
+        finally:
+            if teefh and os.path.exists(partial):
+                os.remove(partial)
+        self.duration = datetime.now() - startTime
+        return counter
+
+    def shardBowtie(self, counter, shards, tee=None):
+        '''aligns the query with `shards` bowtie processes at once and merges their hits into counter
+            the reads are dealt out to the processes' stdin in record aligned blocks while the query is read,
+            no shard is ever written to disk. Every read is aligned exactly once by exactly one process, so the
+            merged counts are those of an unsharded run. The bowtie threads are divided among the shards.
+            tee - optional gzip copy of the alignments (one gzip member per shard)'''
+        startTime = datetime.now()
+        fastq = self.checkQuery(self.query) == '-q'
+        cmd = self.bowtieCommand(query='-', threads=max(1, int(self.threads) // shards))
+        counters = [HitCounter(counter.column, counter.chunk_size) for i in range(shards)]
+        parts = [None] * shards
+        if tee:
+            self.checkOutput(tee)
+            parts = [CacheHelper.temp_name('%s.%s' % (tee, i)) for i in range(shards)]
+        procs = list()
+        errfiles = list()
+        readers = list()
+        try:
+            for shard_counter, part in zip(counters, parts):
+                errfiles.append(tempfile.TemporaryFile())
+                proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=errfiles[-1],
+                                        bufsize=-1)
+                procs.append(proc)
+                reader = threading.Thread(target=self._drain, args=(proc, shard_counter, part))
+                reader.daemon = True
+                reader.start()
+                readers.append(reader)
+            try:
+                for i, block in enumerate(record_blocks(self.query, fastq, counter.chunk_size)):
+                    procs[i % shards].stdin.write(block)
+            finally:
+                for proc in procs:
+                    try:
+                        proc.stdin.close()
+                    except IOError:
+                        pass
+                for reader in readers:
+                    reader.join()
+            usages = [Metrics.wait(proc)[1] for proc in procs]
+            # the shards run side by side, their memory adds up
+            self.usage = tuple(sum(u) for u in zip(*usages))
+            reads = [bowtie_summary(errfile) for errfile in errfiles]
+            self.reads = sum(reads) if None not in reads else None
+            for proc in procs:
+                if proc.returncode != 0:
+                    raise subprocess.CalledProcessError(proc.returncode, ' '.join(cmd))
+            for shard_counter in counters:
+                shard_counter.close()
+                counter.merge(shard_counter)
+            if tee:
+                with CacheHelper.atomic_open(tee) as fh:
+                    for part in parts:
+                        with open(part, 'rb') as partfh:
+                            shutil.copyfileobj(partfh, fh.fh, 4 * 1024 * 1024)
+        finally:
+            for proc in procs:
+                if proc.poll() is None:
+                    proc.kill()
+                    proc.wait()
+            for part in parts:
+                if part and os.path.exists(part):
+                    os.remove(part)
+        self.duration = datetime.now() - startTime
+        return counter
+
+    def _drain(self, proc, counter, tee=None):
+        '''reads one shard's alignments into its counter (and its gzip part)'''
+        teefh = gzip.open(tee, 'wb', 1) if tee else None
+        try:
+            while True:
+                chunk = proc.stdout.read(counter.chunk_size)
+                if not chunk:
+                    break
+                counter.feed(chunk)
+                if teefh:
+                    teefh.write(chunk)
+        finally:
+            proc.stdout.close()
+            if teefh:
+                teefh.close()
+
     def checkQuery(self, Query):
-        '''reads query file to determine if the file is FASTA (-f) or FASTQ (-q)'''
-        with open(Query) as fh:
+        '''reads query file to determine if the file is FASTA (-f) or FASTQ (-q), gzip compressed or not'''
+        opener = gzip.open if Query.endswith('.gz') else open
+        with opener(Query, 'rb') as fh:
             fchar = fh.readline().strip()[0]
             if fchar == '>':
                 return '-f'
             elif fchar == '@':
                 return '-q'
+            elif not self.interactive:
+                raise ValueError("%s is neither FASTA nor FASTQ" % Query)
             else:
                 while True:
                     resp = fs_autocomplete.get_input(
@@ -132,41 +350,56 @@ class Bowtie:
 
     def folderReferenceCheck(self, Folder, ReferenceName):
         '''checks provided index folder for reference file'''
-        indexList = os.listdir(Folder)
-        if '.'.join([ReferenceName, '1', 'ebwt']) in indexList:
-            self.reference = os.path.join(self.defaultIndex, ReferenceName)
+        if Folder and os.path.isfile(os.path.join(Folder, '.'.join([ReferenceName, '1', 'ebwt']))):
+            self.reference = os.path.join(Folder, ReferenceName)
             return True
         else:
             return False
 
     def bowtieBuildInit(self, Reference):
-        '''asks user if they want to build a bowtie index from the provided file and where they want it to be stored'''
-        if os.path.isfile(Reference):
-            while True:
-                buildQ = raw_input(
-                    "A pre-existing bowtie index for the provided file could not be found. Do you want to build one? [y/n]: ")
-                buildQ = buildQ.strip().lower()
-                if buildQ == "y":
-                    folderQ = fs_autocomplete.get_input(
-                        "What folder do you want to store the reference file in? (Leave blank for default [%s]): " %
-                        self.defaultIndex)
-                    if folderQ == "":
-                        folderQ = self.defaultIndex
-                    nameQ = raw_input(
-                        "What would you like to call the index file?: ")
-                    self.runBowtieBuild(
-                        Reference,
-                        os.path.join(
-                            folderQ,
-                            nameQ))
-                    return
-                elif buildQ == "n":
-                    print "GoodBye."
-                    sys.exit[0]
+        '''uses the index of the provided file from the shared index cache, or asks user if they want to build one into it'''
+        if not os.path.isfile(Reference):
+            raise IOError("no bowtie index or FASTA file at %s" % Reference)
+        if self.getIndexCache().find(Reference):
+            # built by an earlier run
+            self.cachedBowtieBuild(Reference)
+            return
+        if not self.interactive:
+            if not self.build_index:
+                raise IOError("no bowtie index for %s (build_index is off)" % Reference)
+            if self.build_folder or self.build_name:
+                self.runBowtieBuild(
+                    Reference,
+                    os.path.join(
+                        self.build_folder or self.defaultIndex,
+                        self.build_name or os.path.basename(Reference).rpartition('.')[0] or os.path.basename(Reference)))
+            else:
+                self.cachedBowtieBuild(Reference)
+            return
+        while True:
+            buildQ = raw_input(
+                "A pre-existing bowtie index for the provided file could not be found. Do you want to build one? [y/n]: ")
+            buildQ = buildQ.strip().lower()
+            if buildQ == "y":
+                self.cachedBowtieBuild(Reference)
+                return
+            elif buildQ == "n":
+                print "GoodBye."
+                sys.exit(0)
+
+    def getIndexCache(self):
+        if self.index_cache is None:
+            self.index_cache = IndexCache(self.cache_folder, float(self.cache_size or 0) * 1024 ** 3)
+        return self.index_cache
+
+    def cachedBowtieBuild(self, Reference):
+        '''the index of the FASTA from the shared index cache, only the first of any number of concurrent jobs builds it'''
+        self.reference = self.getIndexCache().get(Reference, os.path.join(self.bowtieFolder, 'bowtie-build'))
+        return
 
     def runBowtieBuild(self, Reference, Output):
         '''create Bowtie Reference'''
         app = os.path.join(self.bowtieFolder, 'bowtie-build')
-        subprocess.call([app, Reference, Output])
+        subprocess.check_call([app, Reference, Output])
         self.reference = Output
         return
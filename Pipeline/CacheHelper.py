@@ -0,0 +1,190 @@
+import os
+import sys
+import json
+import mmap
+import fcntl
+import ctypes
+import hashlib
+
+
+'''helpers shared by the on-disk caches/indexes of the pipeline
+
+    fingerprints identify an input file by path, size, mtime and content hash,
+    AtomicFile makes sure a half written cache/output file is never picked up as finished.
+    map_file & view let the compiled indexes be read in place: every process maps the same page
+    cache pages and reads the numbers from them without a copy of its own.
+    '''
+
+
+CACHE_FOLDER = os.path.join(os.path.split(__file__)[0], 'cache')
+
+
+def cache_folder(name, folder=None):
+    '''returns (and creates) the cache sub folder "name" inside folder or the default cache folder'''
+    if not folder or folder == 'None':
+        folder = CACHE_FOLDER
+    path = os.path.join(folder, name)
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+    return path
+
+
+def content_hash(filename, blocksize=4 * 1024 * 1024):
+    '''sha1 of the file contents'''
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as fh:
+        while True:
+            block = fh.read(blocksize)
+            if not block:
+                break
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def file_stat(filename):
+    '''(absolute path, size, mtime) of a file'''
+    st = os.stat(filename)
+    return os.path.abspath(filename), st.st_size, st.st_mtime
+
+
+def fingerprint(filename):
+    '''(absolute path, size, mtime, sha1) of a file'''
+    return file_stat(filename) + (content_hash(filename), )
+
+
+def memo_hash(filename, hashfile):
+    '''sha1 of a file, remembered in hashfile by (path, size, mtime) and recomputed only for a changed file'''
+    stat = file_stat(filename)
+    sha = known_hash(filename, hashfile, stat)
+    if sha is None:
+        sha = content_hash(filename)
+        remember_hash(hashfile, stat, sha)
+    return sha
+
+
+def known_hash(filename, hashfile, stat=None):
+    '''sha1 of a file remembered in hashfile for its current (path, size, mtime), None if there is none'''
+    path, size, mtime = stat or file_stat(filename)
+    known = read_json(hashfile).get(path)
+    if known and known[0] == size and known[1] == mtime:
+        return known[2]
+    return None
+
+
+def remember_hash(hashfile, stat, sha):
+    '''records the sha1 of a file as it was at stat (path, size, mtime)'''
+    path, size, mtime = stat
+    lock = lock_file(hashfile + '.lock')
+    try:
+        hashes = read_json(hashfile)
+        hashes[path] = [size, mtime, sha]
+        with atomic_open(hashfile, 'w') as fh:
+            json.dump(hashes, fh, indent=1, sort_keys=True)
+    finally:
+        unlock_file(lock)
+    return
+
+
+def read_json(filename):
+    '''contents of a json file, an empty dict for a missing or broken one'''
+    try:
+        with open(filename) as fh:
+            return json.load(fh)
+    except (IOError, ValueError):
+        return dict()
+
+
+def lock_file(filename, shared=False, blocking=True):
+    '''opens filename and takes a flock on it (released by unlock_file or when the process ends)
+    returns None if blocking is False and someone else holds a conflicting lock'''
+    fh = open(filename, 'a')
+    flags = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+    try:
+        fcntl.flock(fh, flags if blocking else flags | fcntl.LOCK_NB)
+    except IOError:
+        fh.close()
+        if blocking:
+            raise
+        return None
+    return fh
+
+
+def unlock_file(fh):
+    fcntl.flock(fh, fcntl.LOCK_UN)
+    fh.close()
+
+
+def map_file(filename):
+    '''maps a compiled index for reading
+
+    the mapping is private (copy on write) so ctypes can view it, the indexes never write to it,
+    so its pages stay the page cache's, shared by every process that maps the file'''
+    with open(filename, 'rb') as fh:
+        return mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_COPY)
+
+
+def view(mm, pos, count, ctype=ctypes.c_uint32):
+    '''(array of count ctype numbers at pos of a mapping, the position after it), not a copy
+
+    the view keeps the mapping alive, a mapping with views must be dropped, not closed'''
+    return (ctype * count).from_buffer(mm, pos), pos + count * ctypes.sizeof(ctype)
+
+
+def key_name(*parts):
+    '''short stable name for a cache entry built from any number of key parts'''
+    return hashlib.sha1('\0'.join([str(p) for p in parts])).hexdigest()
+
+
+def temp_name(filename):
+    '''hidden name in the same folder (created if missing) a file is written under before it is renamed into place'''
+    folder = os.path.dirname(os.path.abspath(filename))
+    if not os.path.isdir(folder):
+        try:
+            os.makedirs(folder)
+        except OSError:
+            if not os.path.isdir(folder):
+                raise
+    return os.path.join(folder, '.%s.%s.tmp' % (os.path.basename(filename), os.getpid()))
+
+
+class AtomicFile(object):
+    '''file that is written under a temporary name and renamed into place on a clean close'''
+
+    def __init__(self, filename, mode='wb'):
+        self.filename = filename
+        self.tmpname = temp_name(filename)
+        self.fh = open(self.tmpname, mode)
+
+    def __getattr__(self, name):
+        return getattr(self.fh, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+        return False
+
+    def close(self):
+        if self.fh.closed:
+            return
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+        self.fh.close()
+        os.rename(self.tmpname, self.filename)
+
+    def discard(self):
+        self.fh.close()
+        if os.path.exists(self.tmpname):
+            os.remove(self.tmpname)
+
+
+def atomic_open(filename, mode='wb'):
+    return AtomicFile(filename, mode)
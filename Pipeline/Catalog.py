@@ -0,0 +1,207 @@
+import os
+import sys
+import threading
+import sqlite3 as db
+
+from datetime import datetime
+
+from . import CacheHelper
+from .DBManager import DB_FILE
+from .LibraryIndex import library_index
+from .Ledger import RUNNING, FAILED
+
+
+'''library catalog kept in rnaseq.sqlite
+
+    one row per library id (R01 ... R164+) with the path, size & mtime of its raw, bowtie and rpkm
+    file, their sha1 (computed on request and kept until the file changes), the reads bowtie
+    reported for it (from the stage metrics) and its latest stage (from the stage ledger, or from
+    the files that exist when the ledger has no row for it).
+    refresh() updates the rows from the folders' LibraryIndex, so an unchanged folder is not listed
+    again and every file costs a single stat. Filters such as missing() or realign() are queries.
+    '''
+
+
+KINDS = ["raw", "bowtie", "rpkm"]
+BOWTIE_SUFFIXES = ('.albwt', '.albwt.gz')
+
+
+def folder_files(kind, folder, cache=None):
+    '''library id -> file of a kind in folder (the first by name if there are several), read from the
+    folder's LibraryIndex without touching the catalog'''
+    files = dict()
+    if not folder or not os.path.isdir(folder):
+        return files
+    index = library_index(folder, cache)
+    for id in index.ids():
+        names = [name for name in index.get(id) if not name.startswith('.')]
+        if kind == "bowtie":
+            names = [name for name in names if name.endswith(BOWTIE_SUFFIXES)]
+        if names:
+            files[id] = os.path.join(os.path.abspath(folder), names[0])
+    return files
+
+
+class LibraryCatalog(object):
+    '''catalog rows of every library, safe to use from the scheduler's worker threads'''
+
+    def __init__(self, dbfile=DB_FILE, cache=None):
+        self.dbfile = dbfile
+        self.cache = cache
+        self.lock = threading.Lock()
+        self.conn = db.connect(dbfile, timeout=60, check_same_thread=False)
+        columns = ["library VARCHAR(100) PRIMARY KEY"]
+        for kind in KINDS:
+            columns += ["%s_path TEXT" % kind, "%s_size INTEGER" % kind, "%s_mtime REAL" % kind,
+                        "%s_sha1 VARCHAR(40)" % kind]
+        columns += ["reads INTEGER", "stage VARCHAR(40)", "updated VARCHAR(30)"]
+        self.conn.execute("create table if not exists librarycatalog (%s);" % ", ".join(columns))
+        self.conn.commit()
+
+    def _execute(self, sql, args=()):
+        with self.lock:
+            rows = self.conn.execute(sql, args).fetchall()
+            self.conn.commit()
+        return rows
+
+    def refresh(self, raw_folder=None, bowtie_folder=None, rpkm_folder=None):
+        '''updates the file columns of the given folders' kinds, the other kinds are left as they are'''
+        folders = dict(zip(KINDS, [raw_folder, bowtie_folder, rpkm_folder]))
+        known = dict((row["library"], row) for row in self.rows())
+        now = datetime.now().isoformat(' ')
+        for kind in KINDS:
+            if folders[kind] is None:
+                continue
+            files = folder_files(kind, folders[kind], self.cache)
+            for library in set(files) | set(known):
+                row = known.setdefault(library, {"library": library})
+                path, size, mtime = files.get(library), None, None
+                if path is not None:
+                    try:
+                        path, size, mtime = CacheHelper.file_stat(path)
+                    except OSError:
+                        path = None
+                if (path, size, mtime) == tuple(row.get("%s_%s" % (kind, c)) for c in ("path", "size", "mtime")):
+                    continue
+                row.update({"%s_path" % kind: path, "%s_size" % kind: size, "%s_mtime" % kind: mtime,
+                            "%s_sha1" % kind: None, "updated": now})
+                row["changed"] = True
+        stages, reads = self._stages(), self._reads()
+        for library, row in known.iteritems():
+            stage = stages.get(library) or self._file_stage(row)
+            if row.get("stage") != stage or (reads.get(library) and row.get("reads") != reads.get(library)):
+                row.update({"stage": stage, "reads": reads.get(library, row.get("reads")), "updated": now})
+                row["changed"] = True
+            if row.pop("changed", False):
+                self._store(row)
+        return
+
+    def _file_stage(self, row):
+        if row.get("rpkm_path"):
+            return "counted"
+        if row.get("bowtie_path"):
+            return "aligned"
+        if row.get("raw_path"):
+            return "raw"
+        return None
+
+    def _stages(self):
+        '''library -> "<stage> <state>" of its latest stage ledger row'''
+        try:
+            rows = self._execute("select library, stage, state, started from stageledger order by started")
+        except db.OperationalError:
+            return dict()
+        return dict((library, "%s %s" % (stage, state)) for library, stage, state, started in rows)
+
+    def _reads(self):
+        '''library -> reads of its latest alignment with a read count in the stage metrics'''
+        try:
+            rows = self._execute("select library, records from stagemetrics "
+                                 "where stage = 'align' and ok = 1 and records is not null order by run")
+        except db.OperationalError:
+            return dict()
+        return dict(rows)
+
+    def _store(self, row):
+        columns = self.columns()
+        self._execute("insert or replace into librarycatalog (%s) values (%s)" % (
+            ", ".join(columns), ", ".join("?" * len(columns))), [row.get(c) for c in columns])
+        return
+
+    def columns(self):
+        return [c[1] for c in self._execute("pragma table_info(librarycatalog)")]
+
+    def rows(self, where="1", args=()):
+        '''catalog rows (dicts) matching the where clause, by library'''
+        columns = self.columns()
+        return [dict(zip(columns, row)) for row in self._execute(
+            "select %s from librarycatalog where %s order by library" % (", ".join(columns), where), args)]
+
+    def get(self, library):
+        rows = self.rows("library = ?", (library, ))
+        return rows[0] if rows else None
+
+    def checksum(self, library, kind):
+        '''sha1 of a library's file, computed once and kept until refresh() sees the file changed'''
+        row = self.get(library)
+        if row is None or not row["%s_path" % kind]:
+            return None
+        if row["%s_sha1" % kind] is None:
+            row["%s_sha1" % kind] = CacheHelper.content_hash(row["%s_path" % kind])
+            self._store(row)
+        return row["%s_sha1" % kind]
+
+    def libraries(self, kind="raw"):
+        '''ids of the libraries with a file of kind'''
+        return [row["library"] for row in self.rows("%s_path is not null" % kind)]
+
+    def files(self, kind):
+        '''[(library, path)] of the libraries with a file of kind'''
+        return [(row["library"], row["%s_path" % kind]) for row in self.rows("%s_path is not null" % kind)]
+
+    def missing(self):
+        '''libraries with raw reads but no rpkm file'''
+        return [row["library"] for row in self.rows("raw_path is not null and rpkm_path is null")]
+
+    def realign(self):
+        '''libraries without an rpkm file whose alignment is missing, older than their raw reads or was
+        left running or failed'''
+        return [row["library"] for row in self.rows(
+            "raw_path is not null and rpkm_path is null and (bowtie_path is null or bowtie_mtime < raw_mtime "
+            "or stage in (?, ?))", ("align " + RUNNING, "align " + FAILED))]
+
+    def report(self, libraries=None):
+        '''prints one line per library (all of them or the given ids)'''
+        size = lambda n: "%.1f MB" % (n / 1024.0 ** 2) if n is not None else "-"
+        print "\t".join(["library", "stage", "reads", "raw", "bowtie", "rpkm"])
+        for row in self.rows():
+            if libraries is not None and row["library"] not in libraries:
+                continue
+            print "\t".join([row["library"], row["stage"] or "-", str(row["reads"] or "-")] +
+                            [size(row["%s_size" % kind]) for kind in KINDS])
+        return
+
+    def close(self):
+        self.conn.close()
+
+
+def from_config(config):
+    '''the catalog refreshed from the config's raw, bowtie & rpkm folders'''
+    catalog = LibraryCatalog(cache=config["Cache Path"])
+    catalog.refresh(config["Raw Path"] or None, config["Bowtie Output"] or None, config["RPKM Path"] or None)
+    return catalog
+
+
+FILTERS = ["all", "missing", "realign"]
+
+
+def main():
+    from . import DBManager as DB
+    catalog = from_config(DB.DBM.config)
+    which = sys.argv[1] if len(sys.argv) > 1 else "all"
+    if which not in FILTERS:
+        raise SystemExit("usage: Catalog [%s]" % "|".join(FILTERS))
+    catalog.report(None if which == "all" else getattr(catalog, which)())
+
+if __name__ == '__main__':
+    main()
@@ -8,6 +8,10 @@ from . import PathCheck
 from . import fs_autocomplete
 
 
+# RNASEQ_DB points a run (e.g. a benchmark) at its own config & ledger
+DB_FILE = os.environ.get("RNASEQ_DB") or os.path.join(os.path.split(__file__)[0], 'rnaseq.sqlite')
+
+
 class DBM:
 
     def __init__(self):
@@ -22,20 +26,23 @@ class DBM:
             "RPKM Output": "Folder for the rpkm output",
             "Aggregate Output": "Folder for the aggregate file output",
             "Annotation Path": "Location of annotation files",
-            "Split": "(int) value of which library to split the RPKM/Hit aggregate files",
+            "Split": "(int[,int...]) libraries at which to split the RPKM/Hit aggregate files",
             "Raw Path": "Folder containing raw RNASeq files",
             "RPKM Path": "Folder containing pre-existing RPKM files",
             "GlymaFile": "File used for RPKM calculation",
             "Glyma Column": "Column in GlymaFile that contains the sequence",
             "Bowtie Column": "Column in Bowtie File that contains the sequence",
+            "Cache Path": "Folder for compiled indexes & caches",
+            "Store Path": "Folder for the columnar expression store (outside the RPKM folders), blank for none",
+            "Cache Size": "(GB) size of the RPKM result cache in the Cache Path, 0 or blank turns it off",
+            "Index Cache Size": "(GB) disk budget of the bowtie index cache in the Cache Path, 0 keeps every index",
+            "Max Cores": "(int) cores all concurrent bowtie jobs may use together, blank for all cores",
+            "Max Memory": "(GB) memory all concurrent bowtie jobs may use together, blank for no limit",
         }
         self.initializeSqlite()
 
     def initializeSqlite(self):
-        self.conn = db.connect(
-            os.path.join(
-                os.path.split(__file__)[0],
-                'rnaseq.sqlite'))
+        self.conn = db.connect(DB_FILE)
         self.curs = self.conn.cursor()
         self.initializeDatabase()
 
@@ -95,6 +102,9 @@ class DBM:
         return
 
     def checkOption(self, option):
+        if option in ["Max Cores", "Max Memory", "Cache Size", "Store Path"] and self.config[option] == '':
+            # blank means "no limit" to the bowtie scheduler, "off" for the result cache and no expression store
+            return True
         if self.config[option] is None or self.config[option] == '':
             return False
         if option.lower() in ["Bowtie Path", "Reference Path"]:
@@ -108,11 +118,26 @@ class DBM:
                 return 0 <= int(self.config[option]) <= 3
             except:
                 return False
-        if option == "-m" or option == "-p" or option == "Split":
+        if option == "Split":
+            try:
+                return all(int(cut) > 0 for cut in str(self.config[option]).split(','))
+            except:
+                return False
+        if option == "-m" or option == "-p" or option == "Max Cores":
             try:
                 return isinstance(int(self.config[option]), int)
             except:
                 return False
+        if option == "Cache Size" or option == "Index Cache Size":
+            try:
+                return float(self.config[option]) >= 0
+            except:
+                return False
+        if option == "Max Memory":
+            try:
+                return float(self.config[option]) > 0
+            except:
+                return False
         if option == "-a":
             if self.config[option].lower() in ['true', 't', 'y', 'yes']:
                 self.config[option] = True
@@ -127,5 +152,23 @@ class DBM:
             print "[%s]: %s" % (key, value)
         return
 
-DBM = DBM()
-config = DBM.config
+
+class LazyDBM(object):
+    '''stands in for the DBM of this process: the database is opened and the config read on first use,
+    so importing the package (worker processes, batch jobs without a terminal) costs nothing'''
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.dbm = None
+
+    def load(self):
+        if self.dbm is None:
+            self.dbm = self.factory()
+        return self.dbm
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.load(), name)
+
+DBM = LazyDBM(DBM)
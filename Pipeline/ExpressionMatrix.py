@@ -0,0 +1,158 @@
+import os
+import sys
+import multiprocessing
+
+from array import array
+
+from .ExpressionStore import HITS, RPKMS
+from .ParallelHelper import WorkerPool
+from .Metrics import usage
+
+
+'''dense model x library matrix of hits & rpkms used by MasterRPKM
+
+    models are interned once into a row index, every library is one hits column (unsigned long)
+    and one rpkm column (double), so ~90k models x 164 libraries cost a few hundred MB of numbers
+    instead of tens of millions of python strings.
+    '''
+
+
+# text RPKMs.writeRPKMs writes for a model without hits (rpkm 0.0 only ever happens without hits)
+RPKM_TEXT = {'0.0': '0'}
+
+
+def read_rpkm_file(filename):
+    '''parses a ".rpkm" file into (models, hits, rpkms)'''
+    models = list()
+    hits = array(HITS)
+    rpkms = array(RPKMS)
+    with open(filename) as fh:
+        fh.readline()
+        for line in fh:
+            sp = line.strip().split("\t")
+            models.append(sp[0])
+            rpkms.append(float(sp[1]))
+            hits.append(int(sp[2]))
+    return models, hits, rpkms
+
+
+def _load_rpkm_file(filename):
+    '''process pool entry point: the parsed file as compact columns and the peak RSS of the parsing
+    process so far, None if it cannot be read
+
+    models travel as one newline joined string and the values as native arrays, which pickle as
+    raw bytes rather than one object per cell (large ones go through shared memory, see WorkerPool)'''
+    try:
+        models, hits, rpkms = read_rpkm_file(filename)
+    except Exception:
+        return None
+    return '\n'.join(models), hits, rpkms, usage()[1]
+
+
+def read_rpkm_files(filenames, processes=None, peaks=None):
+    '''yields (models, hits, rpkms) or None (unreadable) for each file, in the order given
+
+    files are parsed in a process pool, results are handed back as soon as the next file in order is done
+    and only a few files per process are parsed ahead of the caller
+    peaks - optional list the peak RSS (bytes) of the parsing process is appended to for every file'''
+    processes = min(processes or multiprocessing.cpu_count(), len(filenames))
+    if processes <= 1:
+        results = (_load_rpkm_file(f) for f in filenames)
+    else:
+        pool = WorkerPool(processes)
+        results = pool.imap(_load_rpkm_file, filenames)
+    try:
+        for result in results:
+            if result is None:
+                yield None
+            else:
+                models, hits, rpkms, rss = result
+                if peaks is not None:
+                    peaks.append(rss)
+                yield models.split('\n') if models else [], hits, rpkms
+    finally:
+        if processes > 1:
+            pool.terminate()
+
+
+class ExpressionMatrix(object):
+
+    def __init__(self):
+        self.models = list()
+        self.index = dict()
+        self.libraries = dict()
+        self.hits = list()
+        self.rpkms = list()
+
+    def __len__(self):
+        return len(self.models)
+
+    def _add_models(self, models):
+        '''adds new rows, padding every existing column with zeros'''
+        new = [m for m in models if m not in self.index]
+        if not new:
+            return
+        for model in new:
+            if model not in self.index:
+                self.index[model] = len(self.models)
+                self.models.append(model)
+        padding = len(self.models) - len(self.hits[0]) if self.hits else 0
+        for column in self.hits:
+            column.extend(array(HITS, [0]) * padding)
+        for column in self.rpkms:
+            column.extend(array(RPKMS, [0.0]) * padding)
+
+    def add_library(self, name, models, hits, rpkms):
+        '''adds (or replaces) the columns of a library, models/hits/rpkms are parallel sequences'''
+        self._add_models(models)
+        if models == self.models:
+            hitcol = array(HITS, hits)
+            rpkmcol = array(RPKMS, rpkms)
+        else:
+            hitcol = array(HITS, [0]) * len(self.models)
+            rpkmcol = array(RPKMS, [0.0]) * len(self.models)
+            index = self.index
+            for model, hit, rpkm in zip(models, hits, rpkms):
+                hitcol[index[model]] = hit
+                rpkmcol[index[model]] = rpkm
+        if name in self.libraries:
+            col = self.libraries[name]
+            self.hits[col] = hitcol
+            self.rpkms[col] = rpkmcol
+        else:
+            self.libraries[name] = len(self.hits)
+            self.hits.append(hitcol)
+            self.rpkms.append(rpkmcol)
+        return
+
+    def iter_text(self, kind, libraries, models, block=4096):
+        '''yields the tab joined values ("hits" or "rpkms") of the given libraries for each model
+
+        values are formatted a column block at a time (map/zip run in C) rather than cell by cell'''
+        columns = [getattr(self, kind)[self.libraries[name]] for name in libraries]
+        index = self.index
+        for start in xrange(0, len(models), block):
+            rows = [index[m] for m in models[start:start + block]]
+            if not columns:
+                for row in rows:
+                    yield ''
+                continue
+            texts = list()
+            for column in columns:
+                text = map(str, map(column.__getitem__, rows))
+                if kind == "rpkms":
+                    text = map(RPKM_TEXT.get, text, text)
+                texts.append(text)
+            for values in zip(*texts):
+                yield '\t'.join(values)
+
+    def values(self, kind, libraries, model):
+        '''formatted values ("hits" or "rpkms") of a single model, "0" where the model is missing'''
+        row = self.index.get(model)
+        if row is None:
+            return ['0'] * len(libraries)
+        columns = getattr(self, kind)
+        text = [str(columns[self.libraries[name]][row]) for name in libraries]
+        if kind == "rpkms":
+            text = map(RPKM_TEXT.get, text, text)
+        return text
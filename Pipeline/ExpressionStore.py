@@ -0,0 +1,187 @@
+import os
+import sys
+import json
+import fcntl
+
+from array import array
+
+from . import CacheHelper
+
+
+'''columnar on-disk store of per-library hits & rpkms
+
+    every library written by RPKMs is appended as two binary columns over one shared model axis,
+    so aggregation reads plain numbers instead of re-parsing every ".rpkm" file.
+
+    layout of the store folder:
+        manifest.json   - model count, column typecodes and one entry per library
+        models.axis     - newline separated model names (the row order of every column)
+        columns/        - <key>.hits (unsigned long) & <key>.rpkm (double) per library, raw native arrays
+                          that can be read (or memory mapped) without any parsing
+
+    libraries are keyed by the basename of their ".rpkm" file, the same name MasterRPKM finds in the
+    rpkm folder. The size & mtime of that file are recorded so a stale column is never used.
+    '''
+
+
+HITS = 'L'
+RPKMS = 'd'
+
+
+def format_rpkm(rpkm, hits):
+    '''same text RPKMs.writeRPKMs writes: models without hits were never given a float rpkm'''
+    if hits == 0:
+        return '0'
+    return str(rpkm)
+
+
+class ExpressionStore(object):
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.manifestfile = os.path.join(folder, 'manifest.json')
+        self.axisfile = os.path.join(folder, 'models.axis')
+        self.columnfolder = os.path.join(folder, 'columns')
+        self._axis = None
+        self._index = None
+        self.manifest = self._read_manifest()
+
+    def _read_manifest(self):
+        if not os.path.isfile(self.manifestfile):
+            return {"version": 1, "models": 0, "hits": HITS,
+                    "rpkm": RPKMS, "libraries": {}}
+        with open(self.manifestfile) as fh:
+            return json.load(fh)
+
+    def _lock(self):
+        CacheHelper.cache_folder('columns', self.folder)
+        fh = open(os.path.join(self.folder, '.lock'), 'a')
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        return fh
+
+    def _unlock(self, fh):
+        fcntl.flock(fh, fcntl.LOCK_UN)
+        fh.close()
+
+    def models(self):
+        '''the shared model axis'''
+        if self._axis is None:
+            if os.path.isfile(self.axisfile):
+                with open(self.axisfile, 'rb') as fh:
+                    data = fh.read()
+                self._axis = data.split('\n') if data else []
+            else:
+                self._axis = []
+        return self._axis
+
+    def index(self):
+        if self._index is None:
+            self._index = dict((m, i) for i, m in enumerate(self.models()))
+        return self._index
+
+    def libraries(self):
+        return self.manifest["libraries"]
+
+    def __contains__(self, key):
+        return key in self.manifest["libraries"]
+
+    def is_current(self, key, rpkmfile):
+        '''True if the column for key was written from rpkmfile as it is on disk now'''
+        entry = self.manifest["libraries"].get(key)
+        if entry is None:
+            return False
+        try:
+            st = os.stat(rpkmfile)
+        except OSError:
+            return False
+        return entry["size"] == st.st_size and entry["mtime"] == st.st_mtime
+
+    def _column_path(self, key, kind):
+        return os.path.join(self.columnfolder, '%s.%s' % (key, kind))
+
+    def append(self, key, models, hits, rpkms, source):
+        '''adds (or replaces) the columns of one library
+            models/hits/rpkms - parallel sequences in the library's own order
+            source - the ".rpkm" file the values were written to'''
+        lock = self._lock()
+        try:
+            self.manifest = self._read_manifest()
+            self._axis = None
+            self._index = None
+            axis = self.models()
+            if not axis:
+                axis = list(models)
+                with CacheHelper.atomic_open(self.axisfile) as fh:
+                    fh.write('\n'.join(axis))
+                self._axis = axis
+                self.manifest["models"] = len(axis)
+            hitcol = array(HITS, [0]) * len(axis)
+            rpkmcol = array(RPKMS, [0.0]) * len(axis)
+            if list(models) == axis:
+                hitcol = array(HITS, hits)
+                rpkmcol = array(RPKMS, rpkms)
+            else:
+                index = self.index()
+                for model, hit, rpkm in zip(models, hits, rpkms):
+                    if model not in index:
+                        raise ValueError(
+                            "%s is not on the model axis of %s (was the GlymaFile changed?)" %
+                            (model, self.folder))
+                    hitcol[index[model]] = hit
+                    rpkmcol[index[model]] = rpkm
+            for kind, column in (("hits", hitcol), ("rpkm", rpkmcol)):
+                with CacheHelper.atomic_open(self._column_path(key, kind)) as fh:
+                    column.tofile(fh.fh)
+            st = os.stat(source)
+            self.manifest["libraries"][key] = {
+                "source": os.path.abspath(source),
+                "size": st.st_size,
+                "mtime": st.st_mtime,
+                "records": int(sum(hitcol)),
+            }
+            with CacheHelper.atomic_open(self.manifestfile, 'w') as fh:
+                json.dump(self.manifest, fh, indent=1, sort_keys=True)
+        finally:
+            self._unlock(lock)
+        return
+
+    def column(self, key, kind):
+        '''reads one column ("hits" or "rpkm") of a library straight into an array'''
+        column = array(self.manifest[kind])
+        try:
+            with open(self._column_path(key, kind), 'rb') as fh:
+                column.fromfile(fh, self.manifest["models"])
+        except EOFError:
+            raise ValueError("column %s.%s does not match the model axis" % (key, kind))
+        return column
+
+    def import_rpkm(self, rpkmfile):
+        '''adds an existing ".rpkm" file; returns False if its text would not be reproduced exactly'''
+        models, hits, rpkms = [], [], []
+        with open(rpkmfile) as fh:
+            fh.readline()
+            for line in fh:
+                sp = line.strip().split("\t")
+                hit = int(sp[2])
+                rpkm = float(sp[1])
+                if format_rpkm(rpkm, hit) != sp[1]:
+                    return False
+                models.append(sp[0])
+                hits.append(hit)
+                rpkms.append(rpkm)
+        self.append(os.path.basename(rpkmfile), models, hits, rpkms, rpkmfile)
+        return True
+
+
+def main():
+    '''python -m Pipeline.ExpressionStore <store folder> <rpkm files...>'''
+    store = ExpressionStore(sys.argv[1])
+    for rpkmfile in sys.argv[2:]:
+        if store.is_current(os.path.basename(rpkmfile), rpkmfile):
+            continue
+        if not store.import_rpkm(rpkmfile):
+            print "%s: values do not round trip, left as text" % rpkmfile
+    print "%s libraries x %s models in %s" % (len(store.libraries()), store.manifest["models"], store.folder)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+import os
+import sys
+import gzip
+import time
+import zlib
+import stat
+
+
+'''local stand-in for the bowtie & bowtie-build executables (benchmarks & tests without real data)
+
+    bowtie-build <fasta> <prefix>
+        writes <prefix>.{1,2,3,4,rev.1,rev.2}.ebwt, the .1.ebwt holds the name & length of every
+        sequence, the .2.ebwt the sequences (so the index is about as large as the reference)
+    bowtie [-q|-f] [-p n] [-v n] [-a] [-m n] <prefix> <reads|-> [output]
+        reads FASTQ/FASTA (optionally gzip compressed, "-" for stdin) and writes one line per
+        alignment in bowtie's default output format to output (or stdout), the summary to stderr
+
+    every read's alignments are derived from the crc32 of its sequence alone, so the output is the
+    same on every run and however the reads are split across processes: ~15% of the reads do not
+    align, most align once, some to a few models and ~3% are repeats suppressed by -m.
+    Models are picked with a skew towards the first models of the index (a few highly expressed
+    models, a long tail of rarely hit ones).
+
+    FAKE_BOWTIE_RATE (reads per second & process, 0 or unset = as fast as possible) throttles
+    bowtie to mimic a real aligner's throughput; FAKE_BOWTIE_BUILD_RATE (reference bytes per
+    second) does the same for bowtie-build.
+    '''
+
+
+INDEX_MAGIC = 'FAKEBWT1'
+INDEX_SUFFIXES = ['1', '2', '3', '4', 'rev.1', 'rev.2']
+VALUE_OPTIONS = set(['-p', '-v', '-m', '-k', '-n', '-l', '-e', '-3', '-5', '-s', '-u', '--threads'])
+REPEATS = 30
+BLOCK = 1000
+
+
+def _open(filename):
+    if filename == '-':
+        return sys.stdin
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rb')
+    return open(filename, 'rb')
+
+
+def _throttle(started, count, rate):
+    if rate:
+        wait = count / rate - (time.time() - started)
+        if wait > 0:
+            time.sleep(wait)
+
+
+def read_fasta(filename):
+    '''yields (name, sequence) of a FASTA file'''
+    name, seq = None, []
+    with _open(filename) as fh:
+        for line in fh:
+            line = line.strip()
+            if line.startswith('>'):
+                if name is not None:
+                    yield name, ''.join(seq)
+                name, seq = line[1:].split()[0], []
+            elif line:
+                seq.append(line)
+    if name is not None:
+        yield name, ''.join(seq)
+
+
+def read_reads(filename, fastq=True):
+    '''yields (name, sequence, qualities) of a FASTQ or FASTA reads file'''
+    if not fastq:
+        for name, seq in read_fasta(filename):
+            yield name, seq, 'I' * len(seq)
+        return
+    with _open(filename) as fh:
+        while True:
+            header = fh.readline()
+            if not header:
+                break
+            seq = fh.readline().strip()
+            fh.readline()
+            quals = fh.readline().strip()
+            yield header.strip()[1:], seq, quals
+
+
+def bowtie_build(fasta, prefix):
+    rate = float(os.environ.get('FAKE_BOWTIE_BUILD_RATE') or 0)
+    started = time.time()
+    folder = os.path.dirname(prefix)
+    if folder and not os.path.isdir(folder):
+        os.makedirs(folder)
+    total = 0
+    with open(prefix + '.1.ebwt', 'w') as names:
+        with open(prefix + '.2.ebwt', 'w') as seqs:
+            names.write(INDEX_MAGIC + '\n')
+            for name, seq in read_fasta(fasta):
+                names.write('%s\t%s\n' % (name, len(seq)))
+                seqs.write(seq + '\n')
+                total += len(seq)
+                _throttle(started, total, rate)
+    for suffix in INDEX_SUFFIXES[2:]:
+        open('%s.%s.ebwt' % (prefix, suffix), 'w').close()
+    print "Total time for forward call to driver() for forward index: %s" % (time.time() - started)
+    return 0
+
+
+def load_index(prefix):
+    '''[(name, length)] of the indexed sequences'''
+    with open(prefix + '.1.ebwt') as fh:
+        if fh.readline().strip() != INDEX_MAGIC:
+            raise ValueError("%s is not a fake bowtie index" % prefix)
+        return [(name, int(length)) for name, length in (line.rstrip('\n').split('\t') for line in fh)]
+
+
+def alignments(seq, models, mismatches=2):
+    '''[(strand, model, offset, mismatch text)] of a read, decided by the crc32 of its sequence'''
+    h = zlib.crc32(seq) & 0xffffffff
+    r = h % 100
+    if r < 15:
+        return []
+    elif r < 75:
+        n = 1
+    elif r < 90:
+        n = 2
+    elif r < 97:
+        n = 3 + (h >> 7) % 3
+    else:
+        n = REPEATS
+    u = ((h >> 8) & 0xffff) / 65536.0
+    first = int(len(models) * u ** 3)
+    hits = list()
+    for k in xrange(n):
+        name, length = models[(first + k * 7919) % len(models)]
+        offset = (h >> (k % 16)) % max(1, length - len(seq))
+        wrong = (h >> 20) % (int(mismatches) + 1)
+        text = ','.join('%d:A>G' % ((h >> (2 * i)) % max(1, len(seq))) for i in xrange(wrong))
+        hits.append(('+' if (h >> k) & 1 else '-', name, offset, text))
+    return hits
+
+
+def bowtie(args):
+    fastq = '-f' not in args
+    values = dict()
+    positional = list()
+    i = 0
+    while i < len(args):
+        if args[i] in VALUE_OPTIONS:
+            values[args[i]] = args[i + 1]
+            i += 2
+            continue
+        if args[i] == '-' or not args[i].startswith('-'):
+            positional.append(args[i])
+        i += 1
+    prefix, query = positional[0], positional[1]
+    output = positional[2] if len(positional) > 2 else None
+    suppress = int(values.get('-m', 0))
+    models = load_index(prefix)
+    rate = float(os.environ.get('FAKE_BOWTIE_RATE') or 0)
+    out = open(output, 'w') if output else sys.stdout
+    started = time.time()
+    reads = aligned = suppressed = reported = 0
+    try:
+        for name, seq, quals in read_reads(query, fastq):
+            reads += 1
+            hits = alignments(seq, models, values.get('-v', 2))
+            if suppress and len(hits) > suppress:
+                suppressed += 1
+                hits = []
+            if hits:
+                aligned += 1
+                reported += len(hits)
+            for strand, model, offset, text in hits:
+                out.write('%s\t%s\t%s\t%d\t%s\t%s\t%d\t%s\n' % (
+                    name, strand, model, offset, seq, quals, len(hits) - 1, text))
+            if reads % BLOCK == 0:
+                _throttle(started, reads, rate)
+    finally:
+        if output:
+            out.close()
+        else:
+            out.flush()
+    percent = lambda n: 100.0 * n / reads if reads else 0
+    sys.stderr.write("# reads processed: %d\n" % reads)
+    sys.stderr.write("# reads with at least one reported alignment: %d (%.2f%%)\n" % (aligned, percent(aligned)))
+    sys.stderr.write("# reads that failed to align: %d (%.2f%%)\n" % (
+        reads - aligned - suppressed, percent(reads - aligned - suppressed)))
+    sys.stderr.write("# reads with alignments suppressed due to -m: %d (%.2f%%)\n" % (suppressed, percent(suppressed)))
+    sys.stderr.write("Reported %d alignments to 1 output stream(s)\n" % reported)
+    return 0
+
+
+def install(folder, rate=0, build_rate=0):
+    '''writes "bowtie" & "bowtie-build" scripts running this module into folder (usable as the "Bowtie Path")'''
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    for name in ['bowtie', 'bowtie-build']:
+        script = os.path.join(folder, name)
+        with open(script, 'w') as fh:
+            fh.write('#!/bin/sh\n')
+            fh.write('FAKE_BOWTIE_RATE=${FAKE_BOWTIE_RATE:-%s} FAKE_BOWTIE_BUILD_RATE=${FAKE_BOWTIE_BUILD_RATE:-%s} '
+                     'PYTHONPATH="%s${PYTHONPATH:+:$PYTHONPATH}" exec "%s" -m Pipeline.FakeBowtie %s "$@"\n' %
+                     (rate, build_rate, root, sys.executable, name))
+        os.chmod(script, os.stat(script).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return folder
+
+
+def main():
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    if command == 'bowtie-build':
+        sys.exit(bowtie_build(sys.argv[2], sys.argv[3]))
+    elif command == 'bowtie':
+        sys.exit(bowtie(sys.argv[2:]))
+    elif command == 'install' and len(sys.argv) > 2:
+        print install(sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else 0)
+    else:
+        print "usage: python -m Pipeline.FakeBowtie bowtie|bowtie-build <arguments>"
+        print "       python -m Pipeline.FakeBowtie install <folder> [reads per second]"
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
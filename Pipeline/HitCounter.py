@@ -0,0 +1,181 @@
+import os
+import sys
+import gzip
+
+from collections import defaultdict
+from itertools import repeat
+from operator import contains
+
+
+'''counts bowtie alignments per model without splitting every alignment line
+
+    bowtie output (-a -m 25) runs to tens of GB per library, so the file is read in large
+    byte chunks. When every line of a chunk has the same number of columns the chunk is
+    split on tabs once and the model column is sliced straight out of the token list;
+    otherwise it falls back to cutting the model column out of each line. Models are
+    interned to integer ids and counted into a list indexed by those ids.
+    '''
+
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class HitCounter(object):
+    '''chunked hit counter for a single library
+
+    feed() accepts raw bytes in any chunking (e.g. straight from a bowtie pipe),
+    count_file() reads an alignment file (.albwt or .albwt.gz)'''
+
+    def __init__(self, bowtie_model_column=2, chunk_size=CHUNK_SIZE):
+        self.column = int(bowtie_model_column)
+        self.chunk_size = chunk_size
+        self.models = list()
+        self.ids = dict()
+        self.counts = list()
+        self.records = 0
+        self.bytes = 0
+        self.stopped = False
+        # the first malformed line (cut to 200 characters), reported once by count_file
+        self.malformed = None
+        self._partial = ''
+
+    def _intern(self, model):
+        idx = len(self.models)
+        self.ids[model] = idx
+        self.models.append(model)
+        self.counts.append(0)
+        return idx
+
+    def _count_models(self, models):
+        ids = self.ids
+        counts = self.counts
+        for model in models:
+            try:
+                counts[ids[model]] += 1
+            except KeyError:
+                ids[model] = len(counts)
+                self.models.append(model)
+                counts.append(1)
+        self.records += len(models)
+
+    def _count_body(self, body):
+        '''counts a block of complete lines (without the final newline)'''
+        column = self.column
+        newlines = body.count('\n')
+        first = body.find('\n')
+        ntabs = body.count('\t', 0, first if first != -1 else len(body))
+        if 0 < column < ntabs and body.count('\t') == ntabs * (newlines + 1):
+            tokens = body.split('\t')
+            # the last column of a line and the first column of the next share a token;
+            # every one of those tokens must hold exactly one newline for the slice to be valid
+            joins = tokens[ntabs:-1:ntabs]
+            if len(joins) == newlines and all(
+                    map(contains, joins, repeat('\n', newlines))):
+                self._count_models(tokens[column::ntabs])
+                return
+        self._count_lines(body.split('\n'))
+
+    def _count_lines(self, lines):
+        '''counts the model column line by line'''
+        column = self.column
+        split = column + 1
+        ids = self.ids
+        counts = self.counts
+        intern = self._intern
+        for line in lines:
+            sp = line.split('\t', split)
+            if len(sp) <= column:
+                # same behaviour as the original getHits: stop at the first malformed line
+                self.malformed = line[:200]
+                self.stopped = True
+                return
+            model = sp[column]
+            if len(sp) == split:
+                model = model.rstrip()
+            if column == 0:
+                model = model.lstrip()
+            idx = ids.get(model)
+            if idx is None:
+                idx = intern(model)
+            counts[idx] += 1
+            self.records += 1
+
+    def feed(self, data):
+        '''counts every complete line in data and keeps the trailing partial line'''
+        if self.stopped or not data:
+            return
+        self.bytes += len(data)
+        if self._partial:
+            data = self._partial + data
+        end = data.rfind('\n')
+        if end == -1:
+            self._partial = data
+            return
+        self._partial = data[end + 1:]
+        self._count_body(data[:end])
+
+    def close(self):
+        '''counts a final line without a trailing newline'''
+        if self._partial and not self.stopped:
+            self._count_body(self._partial)
+        self._partial = ''
+        return self
+
+    def count_stream(self, fh, digest=None):
+        '''digest - a hashlib object updated with every chunk read (e.g. to hash the file while counting it)'''
+        read = fh.read
+        size = self.chunk_size
+        # after a malformed line the rest is only read for the digest
+        while digest is not None or not self.stopped:
+            chunk = read(size)
+            if not chunk:
+                break
+            if digest is not None:
+                digest.update(chunk)
+            self.feed(chunk)
+        return self.close()
+
+    def count_file(self, filename, digest=None):
+        if filename.endswith('.gz'):
+            fh = gzip.open(filename, 'rb')
+        else:
+            fh = open(filename, 'rb')
+        try:
+            self.count_stream(fh, digest)
+        finally:
+            fh.close()
+        if self.stopped:
+            print "malformed alignment line in %s, stopped counting: %r" % (filename, self.malformed)
+        return self
+
+    def merge(self, other):
+        '''adds the counts of another HitCounter (e.g. a shard of the same library)'''
+        for model, count in zip(other.models, other.counts):
+            idx = self.ids.get(model)
+            if idx is None:
+                idx = self._intern(model)
+            self.counts[idx] += count
+        self.records += other.records
+        self.bytes += other.bytes
+        return self
+
+    def hits(self):
+        '''returns the counts in the same form as RPKMs.getHits always has'''
+        hitDict = defaultdict(lambda: 0)
+        for model, count in zip(self.models, self.counts):
+            hitDict[model] = count
+        return hitDict
+
+
+def count_hits(bowtiefile, bowtie_model_column=2):
+    return HitCounter(bowtie_model_column).count_file(bowtiefile).hits()
+
+
+def main():
+    counter = HitCounter(sys.argv[2] if len(sys.argv) > 2 else 2)
+    counter.count_file(sys.argv[1])
+    for model, count in zip(counter.models, counter.counts):
+        print "%s\t%s" % (model, count)
+
+if __name__ == '__main__':
+    main()
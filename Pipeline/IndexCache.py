@@ -0,0 +1,184 @@
+import os
+import sys
+import json
+import fcntl
+import shutil
+import subprocess
+
+from datetime import datetime
+
+from . import CacheHelper
+
+
+'''shared cache of the bowtie indexes built from reference FASTA files
+
+    an index is keyed by the sha1 of its FASTA, so every job and every run aligning against the
+    same sequences uses one index, whatever the FASTA is called or wherever it lies.
+    <key>.lock serializes the build: the first job takes it exclusively and runs bowtie-build into a
+    hidden temporary folder that is renamed to <key> once the build succeeded, every other job waits
+    on the lock and then finds the published index. A job using an index keeps holding the lock
+    shared, so an index is never evicted from under a running alignment.
+
+    layout of the cache folder:
+        <key>/index.*.ebwt  - the published index
+        <key>/source.json   - fingerprint of the FASTA the index was built from & the build time
+        <key>.lock          - build & use lock of the index (never removed)
+        hashes.json         - path -> [size, mtime, sha1] of the hashed FASTA files
+    indexes are evicted least recently used first (the mtime of <key> is its last use) once the
+    folder grows beyond max_size, 0 keeps every index.
+    '''
+
+
+INDEX_NAME = 'index'
+
+
+def folder_size(folder):
+    total = 0
+    for root, dirs, files in os.walk(folder):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+class IndexCache(object):
+
+    def __init__(self, folder=None, max_size=0):
+        self.folder = CacheHelper.cache_folder('indexes', folder)
+        self.max_size = max_size or 0
+        self.hashfile = os.path.join(self.folder, 'hashes.json')
+        # key -> shared lock of the indexes handed out by this cache
+        self.held = dict()
+
+    def key(self, fasta):
+        return CacheHelper.memo_hash(fasta, self.hashfile)
+
+    def _published(self, key):
+        return os.path.join(self.folder, key)
+
+    def _prefix(self, key):
+        return os.path.join(self._published(key), INDEX_NAME)
+
+    def _is_published(self, key):
+        return os.path.isfile(self._prefix(key) + '.1.ebwt')
+
+    def find(self, fasta):
+        '''True if an index of the FASTA is published, nothing is built or locked'''
+        return self._is_published(self.key(fasta))
+
+    def get(self, fasta, builder):
+        '''index prefix (for bowtie) of the FASTA, built with the bowtie-build at builder if no run built it yet
+        the index stays locked against eviction until release (or the end of the process)'''
+        key = self.key(fasta)
+        if key in self.held:
+            return self._prefix(key)
+        lock = CacheHelper.lock_file(os.path.join(self.folder, key + '.lock'), shared=True)
+        try:
+            if not self._is_published(key):
+                # converting the lock lets go of it first, another job may have built the index meanwhile
+                self._relock(lock, shared=False)
+                if not self._is_published(key):
+                    self._build(key, fasta, builder)
+                self._relock(lock, shared=True)
+                self.evict(keep=key)
+        except:
+            CacheHelper.unlock_file(lock)
+            raise
+        # the mtime of an index is its last use
+        os.utime(self._published(key), None)
+        self.held[key] = lock
+        return self._prefix(key)
+
+    def _relock(self, fh, shared):
+        fcntl.flock(fh, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+
+    def _build(self, key, fasta, builder):
+        '''runs bowtie-build into a temporary folder and renames it to <key>, only ever called under the exclusive lock'''
+        for name in os.listdir(self.folder):
+            if name.startswith('.%s.' % key):
+                # left behind by a builder that died
+                shutil.rmtree(os.path.join(self.folder, name), ignore_errors=True)
+        tmp = os.path.join(self.folder, '.%s.%s.tmp' % (key, os.getpid()))
+        os.mkdir(tmp)
+        print "building the bowtie index of %s into %s" % (fasta, self.folder)
+        try:
+            returncode = subprocess.call([builder, fasta, os.path.join(tmp, INDEX_NAME)])
+            if returncode != 0:
+                raise subprocess.CalledProcessError(returncode, builder)
+            with open(os.path.join(tmp, 'source.json'), 'w') as fh:
+                json.dump({"fasta": list(CacheHelper.file_stat(fasta)) + [key],
+                           "built": datetime.now().isoformat(' ')}, fh, indent=1)
+            os.rename(tmp, self._published(key))
+        except:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        return
+
+    def release(self, fasta=None):
+        '''lets go of the lock on the index of fasta (of every index handed out if None)'''
+        keys = [self.key(fasta)] if fasta is not None else self.held.keys()
+        for key in keys:
+            lock = self.held.pop(key, None)
+            if lock is not None:
+                CacheHelper.unlock_file(lock)
+        return
+
+    def entries(self):
+        '''[(last use, size, key)] of every published index, oldest first'''
+        entries = list()
+        for name in os.listdir(self.folder):
+            path = os.path.join(self.folder, name)
+            if name.startswith('.') or not os.path.isdir(path):
+                continue
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                continue
+            entries.append((mtime, folder_size(path), name))
+        return sorted(entries)
+
+    def evict(self, keep=None):
+        '''removes the least recently used indexes nobody is using until the cache fits into max_size, returns how many'''
+        if not self.max_size:
+            return 0
+        entries = [e for e in self.entries() if e[2] != keep]
+        total = sum(size for mtime, size, key in entries) + (folder_size(self._published(keep)) if keep else 0)
+        evicted = 0
+        while entries and total > self.max_size:
+            mtime, size, key = entries.pop(0)
+            lock = CacheHelper.lock_file(os.path.join(self.folder, key + '.lock'), blocking=False)
+            if lock is None:
+                # in use by a running job
+                continue
+            try:
+                # renamed first, so a half removed index is never taken for a published one
+                doomed = os.path.join(self.folder, '.%s.%s.evicted' % (key, os.getpid()))
+                os.rename(self._published(key), doomed)
+                shutil.rmtree(doomed, ignore_errors=True)
+            except OSError:
+                continue
+            finally:
+                CacheHelper.unlock_file(lock)
+            total -= size
+            evicted += 1
+        return evicted
+
+    def printStats(self):
+        entries = self.entries()
+        print "index cache: %s" % self.folder
+        print "indexes: %s (%.1f MB%s)" % (
+            len(entries), sum(size for mtime, size, key in entries) / 1024.0 ** 2,
+            " of %.1f MB" % (self.max_size / 1024.0 ** 2) if self.max_size else "")
+        for mtime, size, key in reversed(entries):
+            source = CacheHelper.read_json(os.path.join(self.folder, key, 'source.json')).get("fasta", [key])
+            print "%s\t%.1f MB\t%s" % (key, size / 1024.0 ** 2, source[0])
+        return
+
+
+def main():
+    IndexCache(sys.argv[1] if len(sys.argv) > 1 else None).printStats()
+
+if __name__ == '__main__':
+    main()
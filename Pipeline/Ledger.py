@@ -0,0 +1,153 @@
+import os
+import sys
+import json
+import threading
+import sqlite3 as db
+
+from datetime import datetime
+
+from . import CacheHelper
+from .DBManager import DB_FILE
+
+
+'''per-library stage ledger kept in rnaseq.sqlite
+
+    every stage a library goes through (align, count, aggregate) gets one row with its state
+    (running, done or failed), the fingerprints of its inputs & outputs and its timings.
+    A stage counts as done only while its inputs are unchanged and its outputs are still on disk
+    exactly as they were written, so a rerun picks up after the last stage that really finished.
+    Outputs are written under a temporary name and renamed into place (CacheHelper.AtomicFile),
+    a file at its final name is therefore never a truncated one.
+
+    fingerprints are (path, size, mtime): hashing every raw library on each run would cost as
+    much as aligning it.
+    '''
+
+
+STAGES = ["align", "count", "aggregate"]
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+def fingerprints(filenames):
+    '''[(path, size, mtime)] of the files, None for a file that does not exist'''
+    prints = list()
+    for filename in filenames:
+        try:
+            prints.append(list(CacheHelper.file_stat(filename)))
+        except (OSError, TypeError):
+            prints.append([filename, None, None])
+    return prints
+
+
+def _timestamp(text):
+    '''datetime of an isoformat(' ') text (which has no fraction on a whole second)'''
+    try:
+        return datetime.strptime(text, "%Y-%m-%d %H:%M:%S.%f")
+    except ValueError:
+        return datetime.strptime(text, "%Y-%m-%d %H:%M:%S")
+
+
+class StageLedger(object):
+    '''stage rows of every library, safe to use from the scheduler's worker threads'''
+
+    def __init__(self, dbfile=DB_FILE):
+        self.dbfile = dbfile
+        self.lock = threading.Lock()
+        self.conn = db.connect(dbfile, timeout=60, check_same_thread=False)
+        self.conn.execute(
+            "create table if not exists stageledger ("
+            "library VARCHAR(100), stage VARCHAR(20), state VARCHAR(20), "
+            "inputs TEXT, outputs TEXT, started VARCHAR(30), finished VARCHAR(30), "
+            "seconds REAL, error TEXT, primary key (library, stage));")
+        self.conn.commit()
+
+    def _execute(self, sql, args=()):
+        with self.lock:
+            rows = self.conn.execute(sql, args).fetchall()
+            self.conn.commit()
+        return rows
+
+    def get(self, library, stage):
+        '''the row of a library's stage as a dict or None'''
+        rows = self._execute(
+            "select state, inputs, outputs, started, finished, seconds, error "
+            "from stageledger where library = ? and stage = ?", (library, stage))
+        if not rows:
+            return None
+        state, inputs, outputs, started, finished, seconds, error = rows[0]
+        return {"state": state, "inputs": json.loads(inputs or '[]'),
+                "outputs": json.loads(outputs or '[]'), "started": started,
+                "finished": finished, "seconds": seconds, "error": error}
+
+    def start(self, library, stage, inputs=()):
+        self._execute(
+            "insert or replace into stageledger values (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (library, stage, RUNNING, json.dumps(fingerprints(inputs)), '[]',
+             datetime.now().isoformat(' '), None, None, None))
+        return
+
+    def _finish(self, library, stage, state, outputs, error):
+        now = datetime.now()
+        row = self.get(library, stage)
+        seconds = None
+        if row is not None and row["started"]:
+            seconds = (now - _timestamp(row["started"])).total_seconds()
+        self._execute(
+            "update stageledger set state = ?, outputs = ?, finished = ?, seconds = ?, error = ? "
+            "where library = ? and stage = ?",
+            (state, json.dumps(fingerprints(outputs)), now.isoformat(' '), seconds, error,
+             library, stage))
+        return
+
+    def finish(self, library, stage, outputs=()):
+        '''marks a started stage done, outputs must already be at their final names'''
+        self._finish(library, stage, DONE, outputs, None)
+
+    def fail(self, library, stage, error):
+        self._finish(library, stage, FAILED, (), error)
+
+    def record(self, library, stage, inputs=(), outputs=()):
+        '''a stage that was done outside of start/finish (e.g. by an earlier aggregate)'''
+        self.start(library, stage, inputs)
+        self.finish(library, stage, outputs)
+
+    def is_done(self, library, stage, inputs=None):
+        '''True if the stage finished, its outputs are untouched and (if given) the inputs are unchanged'''
+        row = self.get(library, stage)
+        if row is None or row["state"] != DONE:
+            return False
+        if inputs is not None and fingerprints(inputs) != row["inputs"]:
+            return False
+        return all(fingerprints([path]) == [[path, size, mtime]] and size is not None
+                   for path, size, mtime in row["outputs"])
+
+    def outputs(self, library, stage):
+        row = self.get(library, stage)
+        return [path for path, size, mtime in row["outputs"]] if row else []
+
+    def rows(self):
+        return self._execute(
+            "select library, stage, state, started, finished, seconds, error "
+            "from stageledger order by library, stage")
+
+    def report(self):
+        '''prints one line per library & stage'''
+        order = dict((stage, i) for i, stage in enumerate(STAGES))
+        rows = sorted(self.rows(), key=lambda r: (r[0], order.get(r[1], len(order))))
+        for library, stage, state, started, finished, seconds, error in rows:
+            print "\t".join([library, stage, state, started or '', finished or '',
+                             "%.1fs" % seconds if seconds is not None else '',
+                             (error or '').strip().split('\n')[-1]])
+        return
+
+    def close(self):
+        self.conn.close()
+
+
+def main():
+    StageLedger(sys.argv[1] if len(sys.argv) > 1 else DB_FILE).report()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+import os
+import sys
+import struct
+
+from array import array
+from collections import defaultdict
+
+from . import CacheHelper
+
+
+'''compiled model length index for the GlymaFile
+
+    the GlymaFile holds the full sequence of every model but RPKMs only needs the lengths,
+    so the file is parsed once into a compact binary index and memory mapped on every later run.
+    The numbers are read in place from the mapping (see CacheHelper.view) and shared_index keeps
+    one index per process, so the counting workers forked after the parent loaded it all read the
+    same pages instead of holding a length dict each.
+
+    layout:
+        header      - magic, model count, size & mtime of the GlymaFile, path length, names length
+        path        - absolute path of the GlymaFile
+        sha1        - content hash of the GlymaFile (40 hex chars)
+        offsets     - (count + 1) uint32 offsets into names
+        lengths     - count uint32 sequence lengths (GlymaFile order)
+        order       - count uint32 positions sorted by model name (binary search)
+        dictorder   - count uint32 positions in the order a dict of the models iterates them, the
+                      order the rpkm files have always listed the models in
+        names       - concatenated model names
+    '''
+
+
+MAGIC = 'RNALIDX2'
+HEADER = struct.Struct('<8sIQdII')
+
+# (GlymaFile, folder) -> LengthIndex of this process
+_loaded = dict()
+
+
+def _uint32():
+    a = array('I')
+    if a.itemsize != 4:
+        a = array('L')
+    return a
+
+
+class LengthIndex(object):
+    '''read only view of a compiled length index'''
+
+    def __init__(self, glymafile, folder=None):
+        self.glymafile = glymafile
+        self.indexfile = os.path.join(
+            CacheHelper.cache_folder('lengths', folder),
+            CacheHelper.key_name(os.path.abspath(glymafile)) + '.lidx')
+        if not self._load():
+            self.build()
+            self._load()
+
+    def _load(self):
+        '''maps the index file, returns False if it is missing or stale'''
+        if not os.path.isfile(self.indexfile):
+            return False
+        self.mm = CacheHelper.map_file(self.indexfile)
+        magic, count, size, mtime, pathlen, nameslen = HEADER.unpack_from(
+            self.mm, 0)
+        pos = HEADER.size
+        path = self.mm[pos:pos + pathlen]
+        pos += pathlen
+        sha = self.mm[pos:pos + 40]
+        pos += 40
+        if magic != MAGIC or not self._is_current(path, size, mtime, sha):
+            self.mm.close()
+            return False
+        self.count = count
+        self.stat = CacheHelper.file_stat(self.glymafile)
+        self.offsets, pos = CacheHelper.view(self.mm, pos, count + 1)
+        self.lengthlist, pos = CacheHelper.view(self.mm, pos, count)
+        self.order, pos = CacheHelper.view(self.mm, pos, count)
+        self.dictorder, pos = CacheHelper.view(self.mm, pos, count)
+        self.names_start = pos
+        return True
+
+    def is_current(self):
+        '''True while the GlymaFile keeps the path, size & mtime it had when the index was loaded'''
+        try:
+            return CacheHelper.file_stat(self.glymafile) == self.stat
+        except OSError:
+            return False
+
+    def _is_current(self, path, size, mtime, sha):
+        '''path, size & mtime are checked first, the content hash only when the stat changed'''
+        cpath, csize, cmtime = CacheHelper.file_stat(self.glymafile)
+        if cpath != path:
+            return False
+        if csize == size and cmtime == mtime:
+            return True
+        if csize != size or CacheHelper.content_hash(self.glymafile) != sha:
+            return False
+        # touched but unchanged, record the new mtime so the hash is not recomputed next time
+        self._write_header_stat(csize, cmtime)
+        return True
+
+    def _write_header_stat(self, size, mtime):
+        try:
+            with open(self.indexfile, 'r+b') as fh:
+                header = HEADER.unpack(fh.read(HEADER.size))
+                fh.seek(0)
+                fh.write(HEADER.pack(header[0], header[1], size, mtime,
+                                     header[4], header[5]))
+        except IOError:
+            pass
+
+    def build(self):
+        '''parses the GlymaFile the same way RPKMs.getLengths always has'''
+        positions = dict()
+        names = list()
+        lengths = _uint32()
+        path, size, mtime = CacheHelper.file_stat(self.glymafile)
+        with open(self.glymafile) as fh:
+            for line in fh:
+                sp = line.strip().split('\t')
+                model = sp[0]
+                try:
+                    length = len(sp[1])
+                except IndexError:
+                    raise ValueError(
+                        "Cannot get lengths from %s: %r" % (self.glymafile, line[:100]))
+                if model in positions:
+                    lengths[positions[model]] = length
+                else:
+                    positions[model] = len(names)
+                    names.append(model)
+                    lengths.append(length)
+        sha = CacheHelper.content_hash(self.glymafile)
+        offsets = _uint32()
+        total = 0
+        for name in names:
+            offsets.append(total)
+            total += len(name)
+        offsets.append(total)
+        order = _uint32()
+        order.extend(sorted(xrange(len(names)), key=names.__getitem__))
+        dictorder = _uint32()
+        dictorder.extend(positions[name] for name in dict.fromkeys(names))
+        with CacheHelper.atomic_open(self.indexfile) as fh:
+            fh.write(HEADER.pack(MAGIC, len(names), size, mtime, len(path), total))
+            fh.write(path)
+            fh.write(sha)
+            fh.write(offsets.tostring())
+            fh.write(lengths.tostring())
+            fh.write(order.tostring())
+            fh.write(dictorder.tostring())
+            fh.write(''.join(names))
+        return
+
+    def name(self, i):
+        start = self.names_start
+        return self.mm[start + self.offsets[i]:start + self.offsets[i + 1]]
+
+    def names(self):
+        start = self.names_start
+        blob = self.mm[start:start + self.offsets[self.count]]
+        offsets = self.offsets
+        return [blob[offsets[i]:offsets[i + 1]] for i in xrange(self.count)]
+
+    def find(self, model):
+        '''position of model in the GlymaFile order or -1'''
+        lo, hi = 0, self.count
+        order = self.order
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.name(order[mid]) < model:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count and self.name(order[lo]) == model:
+            return order[lo]
+        return -1
+
+    def get(self, model, default=0):
+        i = self.find(model)
+        if i == -1:
+            return default
+        return self.lengthlist[i]
+
+    def __getitem__(self, model):
+        return self.get(model)
+
+    def __contains__(self, model):
+        return self.find(model) != -1
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        '''models in the order of the length dict this index replaces'''
+        return (self.name(i) for i in self.dictorder)
+
+    def iteritems(self):
+        '''(model, length) in the order of the length dict this index replaces'''
+        for i in self.dictorder:
+            yield self.name(i), self.lengthlist[i]
+
+    def lengths(self):
+        '''returns the lengths in the same form as RPKMs.getLengths always has'''
+        lengthDict = defaultdict(lambda: 0)
+        for model, length in zip(self.names(), self.lengthlist):
+            lengthDict[model] = length
+        return lengthDict
+
+    def close(self):
+        '''drops the mapping, it is unmapped once no view of it is left'''
+        self.offsets = self.lengthlist = self.order = self.dictorder = self.mm = None
+
+
+def shared_index(glymafile, folder=None):
+    '''the LengthIndex of a GlymaFile for this process (and the workers it forks), reloaded when the file changed'''
+    key = (os.path.abspath(glymafile), folder)
+    index = _loaded.get(key)
+    if index is None or not index.is_current():
+        index = _loaded[key] = LengthIndex(glymafile, folder)
+    return index
+
+
+def get_lengths(glymafile, folder=None):
+    index = LengthIndex(glymafile, folder)
+    lengthDict = index.lengths()
+    index.close()
+    return lengthDict
+
+
+def main():
+    index = LengthIndex(sys.argv[1])
+    print "%s: %s models indexed in %s" % (index.glymafile, len(index), index.indexfile)
+
+if __name__ == '__main__':
+    main()
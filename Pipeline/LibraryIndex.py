@@ -0,0 +1,112 @@
+import os
+import sys
+import json
+import time
+
+from . import CacheHelper
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+'''library id -> file names of a raw/rpkm folder, from a single scan
+
+    a library's files are named <id>_..., e.g. R01_RNASeq1_W43.fastq. The folder is scanned once
+    (scandir where available, which also skips sub folders without a stat each, else listdir)
+    and the ids are kept in a json file in the cache folder together with the folder's mtime.
+    Adding, removing or renaming a file changes the folder's mtime, so the cached index is reused
+    until the folder changes. A scan within the mtime's own second is not trusted (the folder may
+    still have changed in that second without a new mtime) and is redone on the next load.
+    Within a process every folder is loaded once and then only checked with a single stat.
+    '''
+
+
+# folder -> LibraryIndex of this process
+_loaded = dict()
+
+
+def library_id(filename):
+    return filename.split('_')[0].strip()
+
+
+def scan(folder):
+    '''names of the entries of folder (sub folders are left out where scandir tells them apart)'''
+    if scandir is None:
+        return os.listdir(folder)
+    return [entry.name for entry in scandir(folder) if not entry.is_dir()]
+
+
+class LibraryIndex(object):
+
+    def __init__(self, folder, cache=None):
+        self.folder = os.path.abspath(folder)
+        self.indexfile = os.path.join(
+            CacheHelper.cache_folder('libraries', cache),
+            CacheHelper.key_name(self.folder) + '.json')
+        self.mtime = os.stat(self.folder).st_mtime
+        if not self._load():
+            self.build()
+
+    def _load(self):
+        stored = CacheHelper.read_json(self.indexfile)
+        if stored.get("folder") != self.folder or stored.get("mtime") != self.mtime or \
+                stored.get("scanned", 0) - self.mtime < 1:
+            return False
+        # json hands back unicode, the names are used as the byte strings listdir returns
+        self.files = dict((id.encode('utf-8'), [name.encode('utf-8') for name in names])
+                          for id, names in stored["files"].iteritems())
+        self.scanned = stored["scanned"]
+        return True
+
+    def build(self):
+        self.scanned = scanned = time.time()
+        self.files = dict()
+        for name in scan(self.folder):
+            self.files.setdefault(library_id(name), []).append(name)
+        for names in self.files.itervalues():
+            names.sort()
+        try:
+            with CacheHelper.atomic_open(self.indexfile, 'w') as fh:
+                json.dump({"folder": self.folder, "mtime": self.mtime, "scanned": scanned,
+                           "files": self.files}, fh)
+        except (IOError, OSError, ValueError):
+            # a read only cache (or names json can not hold) only costs the next process a scan
+            pass
+        return
+
+    def is_current(self):
+        if self.scanned - self.mtime < 1:
+            return False
+        try:
+            return os.stat(self.folder).st_mtime == self.mtime
+        except OSError:
+            return False
+
+    def get(self, id):
+        '''file names of a library id (empty if there are none)'''
+        return self.files.get(id.strip(), [])
+
+    def ids(self):
+        return sorted(self.files)
+
+
+def library_index(folder, cache=None):
+    '''the LibraryIndex of a folder, rescanned only when the folder changed'''
+    index = _loaded.get(os.path.abspath(folder))
+    if index is None or not index.is_current():
+        index = _loaded[os.path.abspath(folder)] = LibraryIndex(folder, cache)
+    return index
+
+
+def main():
+    index = LibraryIndex(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None)
+    for id in index.ids():
+        print "%s\t%s" % (id, "\t".join(index.get(id)))
+
+if __name__ == '__main__':
+    main()
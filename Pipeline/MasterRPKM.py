@@ -3,14 +3,68 @@ import os
 import sys
 
 from collections import defaultdict
+from itertools import izip
 from datetime import datetime
 import gc
+import json
 
 from . import DBManager as DB
-from .DefaultList import DefaultList
+from .AnnotationIndex import AnnotationIndex, ANNOTATION_FILES, EMPTY
 from . import PathCheck
+from . import CacheHelper
+from .ExpressionStore import ExpressionStore
+from .ExpressionMatrix import ExpressionMatrix, read_rpkm_files
+from .Catalog import LibraryCatalog, folder_files
+from .ModelTable import shared_table
 
-import pdb
+
+PRE_HEADER = ["Model", "cds Length", "cDNA Length", "Hit Number"]
+APP_HEADER = [
+    "Keywords",
+    "nr Annotation",
+    "Swiss annotation",
+    "trEMBL annotation",
+    "PFAM annotation",
+    "Panther annotation",
+    "KOG annotation",
+    "KEGG ec",
+    "KEGG Orthology",
+    "Best Arabidopsis Hit name",
+    "Best Arabidopsis Hit symbol",
+    "Best Arabidopsis Hit defline",
+    "PFAM Annotation"]
+TRANSCRIPT_ROWS = range(1, 11)
+
+
+def widen(expressionfile, annotationfile, outputfile):
+    '''joins a normalized expression file and its annotation table back into the wide aggregate layout
+
+    both files are in the same model order, so the join streams them side by side and holds a single
+    model's annotation rows at a time. Transcript rows without an annotation row get empty columns.'''
+    with open(expressionfile) as efh:
+        with open(annotationfile) as afh:
+            with CacheHelper.atomic_open(outputfile, 'w') as out:
+                header = efh.readline().rstrip('\n').split('\t')
+                app_header = afh.readline().rstrip('\n').split('\t')[2:]
+                out.write('\t'.join(header[:3] + [PRE_HEADER[3]] + header[3:] + app_header) + '\n')
+                pending = afh.readline()
+                for line in efh:
+                    sp = line.rstrip('\n').split('\t', 3)
+                    model = sp[0]
+                    annotated = dict()
+                    while pending:
+                        amodel, i, annotation = pending.rstrip('\n').split('\t', 2)
+                        if amodel != model:
+                            break
+                        annotated[int(i)] = annotation
+                        pending = afh.readline()
+                    for i in TRANSCRIPT_ROWS:
+                        out.write('\t'.join(sp[:3] + [str(i)] + sp[3:] +
+                                             [annotated.get(i, EMPTY)]) + '\n')
+                if pending:
+                    raise ValueError("%s is not in the model order of %s (at %s)" %
+                                     (annotationfile, expressionfile, pending.split('\t', 1)[0]))
+    return outputfile
 
 
 class MasterRPKM(object):
@@ -26,7 +80,14 @@ class MasterRPKM(object):
                     datetime.now().strftime("%H%M-%m%d%y"))),
             'annotationpath': self.config["Annotation Path"],
             'rpkm_path': self.config["RPKM Path"],
-            'newest_library': latest_lib,
+            'store_path': self.config["Store Path"],
+            'cache_path': self.config["Cache Path"],
+            'processes': self.config["Max Cores"],
+            'layout': 'wide',
+            'aggregate_manifest': os.path.join(
+                self.config["Aggregate Output"],
+                'aggregate.manifest.json'),
+            'newest_library': 0,
             'masterHit': str(
                 os.path.join(
                     os.path.join(
@@ -46,7 +107,11 @@ class MasterRPKM(object):
         self.defaultInit()
         self.manageKwargs()
         self.missinglibraries = list()
+        self.outputs = list()
         self.sortedlibraries = list()
+        self.sortedids = list()
+        # peak RSS (bytes) of the processes that parsed the rpkm files, see read_rpkm_files
+        self.parse_peaks = list()
 
     def defaultInit(self):
         '''sets default for various attributes from the given dictionary'''
@@ -64,151 +129,134 @@ class MasterRPKM(object):
 
     def _get_RNASeq_Dict(self):
         """"returns a dictionary with the keys being RNASeq Library Numbers and the values being a tuple of the id # and filename
-            e.g., RNASeqDict['R01'] = (01, 'R01_RNASeq1_W43')"""
+            e.g., RNASeqDict['R01'] = (01, 'R01_RNASeq1_W43')
+            the files come from the library catalog (see _rpkm_files), only a changed folder is rescanned"""
         RNASeqDict = defaultdict(lambda: (' ', ' '))
-        for key in os.listdir(self.rpkm_path):
+        for library, filepath in self._rpkm_files():
+            key = os.path.basename(filepath)
             sp = key.split('_')
             id_number = int(sp[0].lstrip('R'))
-            if id_number > self.newest_library:
-                self.newest_library = id_number
             RNASeqDict[sp[0]] = ("_".join(sp[:3]), key)
             if id_number > self.newest_library:
                 self.newest_library = id_number
         return RNASeqDict
 
-    def _get_annotation_Dicts(self):
-        '''creates dictionaries for each annotation file except for the phytozome file "Gmax_109_annotation_info.txt" which contains a unique annotation format'''
-        annotation_ref = {
-            "nr": "nr_annotation.tsv",
-            "swiss": "Swiss_annotation.tsv",
-            "trembl": "trEMBL_annotation.tsv",
-            "keyword": "Keywords.tsv",
-            "pfam": "PFAMAnnotation.tsv",
-            "phyto": "v6/Gmax_109_annotation_info.txt"
-        }
-        annotation_files = dict(zip(annotation_ref.keys(), [
-                                os.path.join(self.annotationpath, f) for f in annotation_ref.values()]))
-        annotation_dict = defaultdict(
-            lambda: defaultdict(
-                lambda: defaultdict(
-                    lambda: DefaultList(
-                        default="None"))))
-        annotation_dict = self._get_phytozome_annotations(
-            annotation_files["phyto"],
-            annotation_dict)
-        for annogroup, filename in annotation_files.iteritems():
-            if annogroup != "phyto":
-                with open(filename) as fh:
-                    fh.readline()
-                    lmodel = ''
-                    for line in fh:
-                        annotation = "None"
-                        sp = line.strip().partition("\t")
-                        model, content = sp[0].strip(), sp[2].strip()
-                        if model != lmodel:
-                            i = 1
-                            lmodel = model
-                        if content != "" or content != " ":
-                            annotation = content
-                        annotation_dict[model][i][annogroup].append(annotation)
-                        i += 1
-            else:
-                continue
-        for model in annotation_dict:
-            for it in annotation_dict[model]:
-                if 'phyto' not in annotation_dict[model][it]:
-                    annotation_dict[model][it]['phyto'] = ["None"] * 8
-        return annotation_dict
-
-    def _get_phytozome_annotations(self, filename, annotations_dict):
-        with open(filename) as fh:
-            fh.readline()
-            anno = ["None"] * 8
-            for line in fh:
-                sp = line.strip().split('\t')
-                model = sp[0]
-                for i, x in enumerate(sp[1:]):
-                    if x.strip() != '':
-                        anno[i] = x
-                annostring = '\t'.join(anno)
-                for i in range(1, 11):
-                    annotations_dict[model][i]["phyto"] = anno
-        return annotations_dict
+    def _rpkm_files(self):
+        '''[(library id, rpkm file)] by id: the catalog's rpkm files when rpkm_path is the configured RPKM Path,
+        else the files of rpkm_path looked up as the catalog does, without rewriting the catalog'''
+        if self.config["RPKM Path"] and os.path.abspath(self.rpkm_path) == os.path.abspath(self.config["RPKM Path"]):
+            catalog = LibraryCatalog(cache=self.cache_path)
+            try:
+                catalog.refresh(rpkm_folder=self.rpkm_path)
+                return catalog.files("rpkm")
+            finally:
+                catalog.close()
+        return sorted(folder_files("rpkm", self.rpkm_path, self.cache_path).items())
+
+    def library_files(self):
+        '''[(library id, rpkm file)] of every library in the rpkm folder, by id'''
+        return [(RNASeq_id, os.path.join(self.rpkm_path, filename))
+                for RNASeq_id, (name, filename) in sorted(self._get_RNASeq_Dict().items())]
+
+    def _get_annotation_index(self):
+        '''compiled (model, transcript index) -> annotation columns, recompiled only when an annotation file changes'''
+        return AnnotationIndex(self.annotationpath, self.cache_path)
 
     def _get_model_lengths(self):
+        '''cds & cDNA length of every model, compiled once into shared tables read in place (see ModelTable)'''
         cds_file = os.path.join(self.annotationpath, "cds_Length.tsv")
         cdna_file = os.path.join(self.annotationpath, "cDNA_Length.tsv")
-        cds_dict = defaultdict(lambda: 0)
-        cdna_dict = defaultdict(lambda: 0)
-        with open(cds_file) as fh:
-            fh.readline()
-            for l in fh:
-                sp = l.strip().split("\t")
-                cds_dict[sp[0]] = sp[1]
-        with open(cdna_file) as fh:
-            fh.readline()
-            for l in fh:
-                sp = l.strip().split("\t")
-                cdna_dict[sp[0]] = sp[1]
-        return cds_dict, cdna_dict
-
-    def _get_rpkm_dict(self):
+        return shared_table(cds_file, self.cache_path), shared_table(cdna_file, self.cache_path)
+
+    def _get_store(self):
+        if not self.store_path or self.store_path == 'None':
+            return None
+        return ExpressionStore(self.store_path)
+
+    def _read_libraries(self, store, libraries):
+        """yields (models, hits, rpkms) or None (unreadable) for each (key, filepath), in order
+
+        libraries with a current column in the expression store are read from it, the others are
+        parsed in a process pool (see ExpressionMatrix.read_rpkm_files) and added to the store"""
+        parse = [filepath for key, filepath in libraries
+                 if store is None or not store.is_current(key, filepath)]
+        parsed = read_rpkm_files(parse, self._processes(), self.parse_peaks)
+        parse = set(parse)
+        for key, filepath in libraries:
+            if filepath in parse:
+                library = next(parsed)
+                if library is not None and store is not None:
+                    # parsed once, read as columns from the next aggregation on
+                    try:
+                        store.append(key, library[0], library[1], library[2], filepath)
+                    except ValueError as e:
+                        print e
+                yield library
+                continue
+            try:
+                yield store.models(), store.column(key, "hits"), store.column(key, "rpkm")
+            except (IOError, ValueError):
+                yield None
+
+    def _processes(self):
+        """processes parsing rpkm files, "Max Cores" or every core"""
+        try:
+            return int(self.processes) or None
+        except (TypeError, ValueError):
+            return None
+
+    def _get_rpkm_matrix(self, wanted=None):
+        """reads every library into an ExpressionMatrix, libraries are added in order R01...Rnn
+            wanted - optional set of library ids to read, the others are only listed in sortedlibraries"""
         RNASeq_libs = self._get_RNASeq_Dict()
-        rpkm_dict = dict(zip([r[0] for r in RNASeq_libs.values()], [
-                         defaultdict(lambda:0) for r in RNASeq_libs.values()]))
-        hit_dict = dict(zip([r[0] for r in RNASeq_libs.values()], [
-                        defaultdict(lambda:0) for r in RNASeq_libs.values()]))
-        LibNum = 1
+        store = self._get_store()
+        matrix = ExpressionMatrix()
+        # rows are written in the order the aggregate has always used: the model order of the
+        # first library in a dict of library names (dict.fromkeys reproduces that order)
+        first = None
+        if RNASeq_libs:
+            first = dict.fromkeys([r[0] for r in RNASeq_libs.values()]).keys()[0]
+        self.model_order = list()
         print self.newest_library
-        while LibNum <= self.newest_library:
-            try:
-                RNASeq_id = "R%s" % str(LibNum).zfill(2)
-                RNASeq_name = RNASeq_libs[RNASeq_id][0]
-                RNASeq_filepath = os.path.join(
-                    self.rpkm_path,
-                    RNASeq_libs[RNASeq_id][1])
-                with open(os.path.join(RNASeq_filepath)) as fh:
-                    fh.readline()
-                    for line in fh:
-                        sp = line.strip().split("\t")
-                        model, rpkm, hit = sp[0], sp[1], sp[2]
-                        rpkm_dict[RNASeq_name][model] = rpkm
-                        hit_dict[RNASeq_name][model] = hit
-                self.sortedlibraries.append(RNASeq_name)
-            except:
-                self.missinglibraries.append("R%s" % str(LibNum).zfill(2))
-            LibNum += 1
-        return rpkm_dict, hit_dict
+        entries = list()
+        for LibNum in xrange(1, self.newest_library + 1):
+            RNASeq_id = "R%s" % str(LibNum).zfill(2)
+            RNASeq_name, key = RNASeq_libs[RNASeq_id]
+            entries.append((RNASeq_id, RNASeq_name, key, os.path.join(self.rpkm_path, key)))
+        read = [(key, filepath) for RNASeq_id, name, key, filepath in entries
+                if wanted is None or RNASeq_id in wanted]
+        libraries = self._read_libraries(store, read)
+        for RNASeq_id, RNASeq_name, key, RNASeq_filepath in entries:
+            if wanted is None or RNASeq_id in wanted:
+                library = next(libraries)
+                if library is None:
+                    self.missinglibraries.append(RNASeq_id)
+                    continue
+                models, hits, rpkms = library
+                matrix.add_library(RNASeq_name, models, hits, rpkms)
+                if RNASeq_name == first:
+                    self.model_order = dict.fromkeys(models).keys()
+            elif not os.path.isfile(RNASeq_filepath):
+                self.missinglibraries.append(RNASeq_id)
+                continue
+            self.sortedlibraries.append(RNASeq_name)
+            self.sortedids.append(RNASeq_id)
+        return matrix
 
     def _run_Aggregate(self):
-        '''create aggregate files depending on if writeHits & writeRPKM are True'''
-        annotation_dict = self._get_annotation_Dicts()
+        '''create aggregate files depending on if writeHits & writeRPKM are True
+        layout "normalized" writes one expression row per model plus a separate annotation table (see _run_Normalized)'''
+        if self.layout == "normalized":
+            return self._run_Normalized()
+        annotations = self._get_annotation_index()
         cds_dict, cdna_dict = self._get_model_lengths()
-        rpkmdicts, hitdicts = self._get_rpkm_dict()
-        pre_header = ["Model", "cds Length", "cDNA Length", "Hit Number"]
-        sorted_annotation = [
-            "keyword",
-            "nr",
-            "swiss",
-            "trembl",
-            "phyto",
-            "pfam"]
-        app_header = [
-            "Keywords",
-            "nr Annotation",
-            "Swiss annotation",
-            "trEMBL annotation",
-            "PFAM annotation",
-            "Panther annotation",
-            "KOG annotation",
-            "KEGG ec",
-            "KEGG Orthology",
-            "Best Arabidopsis Hit name",
-            "Best Arabidopsis Hit symbol",
-            "Best Arabidopsis Hit defline",
-            "PFAM Annotation"]
-        with open(self.masterHit + ".Hits.R%s.tsv" % str(self.newest_library).zfill(2), 'w') as Hitfh:
-            with open(self.masterRPKM + ".RPKM.R%s.tsv" % str(self.newest_library).zfill(2), 'w') as RPKMfh:
+        matrix = self._get_rpkm_matrix()
+        hitfile = self.masterHit + ".Hits.R%s.tsv" % str(self.newest_library).zfill(2)
+        rpkmfile = self.masterRPKM + ".RPKM.R%s.tsv" % str(self.newest_library).zfill(2)
+        pre_header = PRE_HEADER
+        app_header = APP_HEADER
+        with CacheHelper.atomic_open(hitfile, 'w') as Hitfh:
+            with CacheHelper.atomic_open(rpkmfile, 'w') as RPKMfh:
                 Hitfh.write("\t".join(pre_header +
                                       [l +
                                        " Hits" for l in self.sortedlibraries] +
@@ -216,16 +264,195 @@ class MasterRPKM(object):
                             "\n")
                 RPKMfh.write("\t".join(
                     pre_header + [l + " RPKMs" for l in self.sortedlibraries] + app_header) + "\n")
-                for model in rpkmdicts[rpkmdicts.keys()[0]].keys():
-                    for i in range(1, 11):
-                        Hitfh.write("\t".join([model, cds_dict[model], cdna_dict[model], str(i)] +
-                                              [hitdicts[k][model] for k in self.sortedlibraries] +
-                                              ['\t'.join(annotation_dict[model][i][k]) for k in sorted_annotation]) +
+                hit_rows = matrix.iter_text("hits", self.sortedlibraries, self.model_order)
+                rpkm_rows = matrix.iter_text("rpkms", self.sortedlibraries, self.model_order)
+                for model, hits, rpkms in izip(self.model_order, hit_rows, rpkm_rows):
+                    # the expression values of a model are formatted once and shared by its 10 rows
+                    hits = [hits] if self.sortedlibraries else []
+                    rpkms = [rpkms] if self.sortedlibraries else []
+                    # the length tables are read in place, a model's lengths are looked up once for its rows
+                    cds, cdna = cds_dict[model], cdna_dict[model]
+                    for i in TRANSCRIPT_ROWS:
+                        annotation = [annotations.get(model, i)]
+                        Hitfh.write("\t".join([model, cds, cdna, str(i)] +
+                                              hits + annotation) +
                                     "\n")
-                        RPKMfh.write("\t".join([model, cds_dict[model], cdna_dict[model], str(i)] +
-                                               [rpkmdicts[k][model] for k in self.sortedlibraries] +
-                                               ['\t'.join(annotation_dict[model][i][k]) for k in sorted_annotation]) +
+                        RPKMfh.write("\t".join([model, cds, cdna, str(i)] +
+                                               rpkms + annotation) +
                                      "\n")
+        annotations.close()
+        self._write_manifest(hitfile, rpkmfile, self._read_manifest())
         gc.collect()
 
         return
+
+    def _run_Normalized(self):
+        '''writes the aggregate without the 10x per-model row expansion
+
+            Hits/RPKM expression files - one row per model: model, cds & cDNA length and the library values
+            annotation table - (model, transcript index) rows with the annotation columns, only where annotated
+        the wide layout can be rebuilt from them at any time with widen()'''
+        annotations = self._get_annotation_index()
+        cds_dict, cdna_dict = self._get_model_lengths()
+        matrix = self._get_rpkm_matrix()
+        suffix = ".R%s.expression.tsv" % str(self.newest_library).zfill(2)
+        hitfile = self.masterHit + ".Hits" + suffix
+        rpkmfile = self.masterRPKM + ".RPKM" + suffix
+        annotationfile = self.masterfile + ".Annotation.R%s.tsv" % str(self.newest_library).zfill(2)
+        pre_header = PRE_HEADER[:3]
+        with CacheHelper.atomic_open(hitfile, 'w') as Hitfh:
+            with CacheHelper.atomic_open(rpkmfile, 'w') as RPKMfh:
+                Hitfh.write("\t".join(pre_header + [l + " Hits" for l in self.sortedlibraries]) + "\n")
+                RPKMfh.write("\t".join(pre_header + [l + " RPKMs" for l in self.sortedlibraries]) + "\n")
+                hit_rows = matrix.iter_text("hits", self.sortedlibraries, self.model_order)
+                rpkm_rows = matrix.iter_text("rpkms", self.sortedlibraries, self.model_order)
+                for model, hits, rpkms in izip(self.model_order, hit_rows, rpkm_rows):
+                    hits = [hits] if self.sortedlibraries else []
+                    rpkms = [rpkms] if self.sortedlibraries else []
+                    cds, cdna = cds_dict[model], cdna_dict[model]
+                    Hitfh.write("\t".join([model, cds, cdna] + hits) + "\n")
+                    RPKMfh.write("\t".join([model, cds, cdna] + rpkms) + "\n")
+        with CacheHelper.atomic_open(annotationfile, 'w') as fh:
+            fh.write("\t".join(["Model", "Hit Number"] + APP_HEADER) + "\n")
+            for model in self.model_order:
+                for i, annotation in annotations.items(model):
+                    if i in TRANSCRIPT_ROWS:
+                        fh.write("\t".join([model, str(i), annotation]) + "\n")
+        annotations.close()
+        print hitfile
+        print rpkmfile
+        print annotationfile
+        self._write_manifest(hitfile, rpkmfile, self._read_manifest(), annotationfile)
+        gc.collect()
+        return
+
+    def _annotation_files(self):
+        '''every annotation & length file the aggregate's non-expression columns are built from'''
+        return [os.path.join(self.annotationpath, f) for f in
+                sorted(ANNOTATION_FILES.values()) + ["cds_Length.tsv", "cDNA_Length.tsv"]]
+
+    def _read_manifest(self):
+        '''manifest of the last aggregate or None'''
+        try:
+            with open(self.aggregate_manifest) as fh:
+                return json.load(fh)
+        except (IOError, ValueError):
+            return None
+
+    def _file_record(self, filename, previous=None):
+        '''size, mtime & sha1 of a file, the hash is only recomputed when size or mtime changed'''
+        path, size, mtime = CacheHelper.file_stat(filename)
+        if previous and previous["size"] == size and previous["mtime"] == mtime:
+            sha = previous["sha1"]
+        else:
+            sha = CacheHelper.content_hash(filename)
+        return {"path": path, "size": size, "mtime": mtime, "sha1": sha}
+
+    def _is_unchanged(self, filename, record):
+        try:
+            return self._file_record(filename, record)["sha1"] == record["sha1"]
+        except OSError:
+            return False
+
+    def _write_manifest(self, hitfile, rpkmfile, previous, annotationfile=None):
+        '''records which libraries (and which annotation files) went into the aggregate files'''
+        self.outputs = [f for f in (hitfile, rpkmfile, annotationfile) if f]
+        known = dict()
+        if previous:
+            known = dict((lib["id"], lib) for lib in previous["libraries"])
+        RNASeq_libs = self._get_RNASeq_Dict()
+        libraries = list()
+        for RNASeq_id, RNASeq_name in zip(self.sortedids, self.sortedlibraries):
+            filename = RNASeq_libs[RNASeq_id][1]
+            record = self._file_record(
+                os.path.join(self.rpkm_path, filename), known.get(RNASeq_id))
+            record.update({"id": RNASeq_id, "name": RNASeq_name, "file": filename})
+            libraries.append(record)
+        manifest = {
+            "hits": os.path.abspath(hitfile),
+            "rpkms": os.path.abspath(rpkmfile),
+            "newest_library": self.newest_library,
+            "layout": "normalized" if annotationfile else "wide",
+            "annotation_table": os.path.abspath(annotationfile) if annotationfile else None,
+            "libraries": libraries,
+            "annotations": [self._file_record(f) for f in self._annotation_files()],
+        }
+        with CacheHelper.atomic_open(self.aggregate_manifest, 'w') as fh:
+            json.dump(manifest, fh, indent=1, sort_keys=True)
+        return
+
+    def _run_Incremental(self):
+        '''merges new or changed libraries into the last aggregate files instead of rebuilding them
+
+        the model, length & annotation columns and the unchanged libraries are copied from the last
+        aggregate; only the libraries whose rpkm file is new (or whose contents changed) are read.
+        Falls back to a full _run_Aggregate when there is no usable previous aggregate.'''
+        previous = self._read_manifest()
+        outputs = ["hits", "rpkms"]
+        if self.layout == "normalized":
+            outputs.append("annotation_table")
+        if previous is None or previous.get("layout", "wide") != self.layout or not all(
+                previous.get(k) and os.path.isfile(previous[k]) for k in outputs) or not all(
+                self._is_unchanged(record["path"], record) for record in previous["annotations"]):
+            print "no usable previous aggregate, rebuilding from scratch"
+            return self._run_Aggregate()
+        RNASeq_libs = self._get_RNASeq_Dict()
+        old = dict((lib["id"], lib) for lib in previous["libraries"])
+        wanted = set()
+        for RNASeq_id, (name, filename) in RNASeq_libs.items():
+            record = old.get(RNASeq_id)
+            if record is None or record["file"] != filename or not self._is_unchanged(
+                    os.path.join(self.rpkm_path, filename), record):
+                wanted.add(RNASeq_id)
+        matrix = self._get_rpkm_matrix(wanted=wanted)
+        if not wanted and self.sortedids == [lib["id"] for lib in previous["libraries"]]:
+            print "aggregate is up to date: %s" % previous["hits"]
+            self.outputs = [previous[k] for k in outputs]
+            return
+        print "merging %s new or changed libraries: %s" % (len(wanted), ", ".join(sorted(wanted)))
+        # each column of the new aggregate either comes from the old file (its position) or the matrix
+        old_positions = dict((lib["id"], i) for i, lib in enumerate(previous["libraries"]))
+        plan = [(name, None if RNASeq_id in wanted else old_positions[RNASeq_id])
+                for RNASeq_id, name in zip(self.sortedids, self.sortedlibraries)]
+        suffix = ".R%s.tsv" % str(self.newest_library).zfill(2)
+        start = len(PRE_HEADER)
+        annotationfile = None
+        if self.layout == "normalized":
+            # the annotation table does not depend on the libraries, the old one is kept
+            suffix = ".R%s.expression.tsv" % str(self.newest_library).zfill(2)
+            start = len(PRE_HEADER) - 1
+            annotationfile = previous["annotation_table"]
+        hitfile = self.masterHit + ".Hits" + suffix
+        rpkmfile = self.masterRPKM + ".RPKM" + suffix
+        self._merge_aggregate(previous["hits"], hitfile, "hits", " Hits",
+                              plan, len(previous["libraries"]), matrix, start)
+        self._merge_aggregate(previous["rpkms"], rpkmfile, "rpkms", " RPKMs",
+                              plan, len(previous["libraries"]), matrix, start)
+        self._write_manifest(hitfile, rpkmfile, previous, annotationfile)
+        gc.collect()
+        return
+
+    def _merge_aggregate(self, oldfile, newfile, kind, suffix, plan, nold, matrix, start=4):
+        '''streams the old aggregate into the new one, splicing the library columns by plan
+            start - column of the first library (4 in the wide layout, 3 in the normalized one)'''
+        end = start + nold
+        new_libraries = [name for name, position in plan if position is None]
+        with open(oldfile) as fh:
+            with CacheHelper.atomic_open(newfile, 'w') as out:
+                header = fh.readline().rstrip('\n').split('\t')
+                out.write('\t'.join(header[:start] + [name + suffix for name, position in plan] +
+                                    header[end:]) + '\n')
+                lmodel = None
+                for line in fh:
+                    sp = line.rstrip('\n').split('\t')
+                    if sp[0] != lmodel:
+                        lmodel = sp[0]
+                        values = iter(matrix.values(kind, new_libraries, lmodel))
+                        values = dict((name, next(values)) for name in new_libraries)
+                    out.write('\t'.join(
+                        sp[:start] +
+                        [sp[start + position] if position is not None else values[name]
+                         for name, position in plan] +
+                        sp[end:]) + '\n')
+        print newfile
+        return
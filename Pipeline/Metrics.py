@@ -0,0 +1,205 @@
+import os
+import sys
+import time
+import errno
+import resource
+import threading
+import sqlite3 as db
+
+from datetime import datetime
+
+from .DBManager import DB_FILE
+from .Ledger import _timestamp
+
+
+'''per-library stage metrics kept in rnaseq.sqlite
+
+    every Pipeline is a run (pipelineruns) and every stage a library goes through in a run gets a
+    stagemetrics row with its wall & cpu time, the bytes & records it processed and the peak RSS of
+    the process(es) doing the work:
+        align       - the bowtie process(es), measured by wait4 (bytes of the query, records are the
+                      reads bowtie reports to have processed)
+        count       - the counting worker (bytes of the alignment file, records are the alignments),
+                      a pool worker counts many libraries so its peak RSS is the worker's peak so far
+        aggregate   - one row for all libraries ("all"): the aggregating process & its parse workers
+                      (bytes of the rpkm files, records are the library x model values)
+    cpu & peak RSS are None where they cannot be told apart from other work in the same process.
+    '''
+
+
+ALL = "all"
+STAGES = ["align", "count", "aggregate"]
+
+
+def usage(children=False):
+    '''(cpu seconds, peak RSS bytes) of this process or of its terminated & waited for children'''
+    ru = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    return ru.ru_utime + ru.ru_stime, ru.ru_maxrss * 1024
+
+
+def wait(proc):
+    '''proc.wait() that also returns the (cpu seconds, peak RSS bytes) of the process: (returncode, usage)'''
+    while True:
+        try:
+            pid, status, ru = os.wait4(proc.pid, 0)
+            break
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
+    proc.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    return proc.returncode, (ru.ru_utime + ru.ru_stime, ru.ru_maxrss * 1024)
+
+
+def file_size(filename):
+    try:
+        return os.path.getsize(filename)
+    except (OSError, TypeError):
+        return None
+
+
+class Measure(object):
+    '''wall & cpu time and peak RSS of a block of work done by this process (and the children it waits for)
+
+    the cpu time of the children is what the ones waited for during the block used, their peak RSS is
+    not: the kernel only keeps the largest of every child ever waited for, so the peak RSS of children
+    is left to the caller (see stop)'''
+
+    def __init__(self, children=False):
+        self.children = children
+        self.started = time.time()
+        self.start_usage = self._usage()
+
+    def _usage(self):
+        cpu, rss = usage()
+        if self.children:
+            cpu += usage(children=True)[0]
+        return cpu, rss
+
+    def stop(self, peaks=()):
+        '''(wall seconds, cpu seconds, peak RSS bytes)
+        peaks - peak RSS of the children that did part of the work, e.g. from wait or read_rpkm_files'''
+        cpu, rss = self._usage()
+        return time.time() - self.started, cpu - self.start_usage[0], max([rss] + [p for p in peaks if p])
+
+
+class StageMetrics(object):
+    '''metrics rows of a run, safe to use from the scheduler's worker threads
+    run - id of an existing run (e.g. in a count worker), see start_run'''
+
+    def __init__(self, dbfile=DB_FILE, run=None):
+        self.dbfile = dbfile
+        self.lock = threading.Lock()
+        self.conn = db.connect(dbfile, timeout=60, check_same_thread=False)
+        self.conn.execute(
+            "create table if not exists pipelineruns ("
+            "run INTEGER PRIMARY KEY AUTOINCREMENT, command TEXT, started VARCHAR(30), "
+            "finished VARCHAR(30), seconds REAL);")
+        self.conn.execute(
+            "create table if not exists stagemetrics ("
+            "run INTEGER, library VARCHAR(100), stage VARCHAR(20), started VARCHAR(30), "
+            "wall REAL, cpu REAL, bytes INTEGER, records INTEGER, peak_rss INTEGER, ok INTEGER);")
+        self.conn.commit()
+        self.run = run
+
+    def _execute(self, sql, args=(), lastrowid=False):
+        with self.lock:
+            cursor = self.conn.execute(sql, args)
+            rows = cursor.lastrowid if lastrowid else cursor.fetchall()
+            self.conn.commit()
+        return rows
+
+    def start_run(self, command=None):
+        '''starts a new run (the command line by default), the metrics recorded from now on belong to it'''
+        self.run = self._execute(
+            "insert into pipelineruns (command, started) values (?, ?)",
+            (command or ' '.join(sys.argv), datetime.now().isoformat(' ')), lastrowid=True)
+        return self.run
+
+    def record(self, library, stage, wall, cpu=None, bytes=None, records=None, peak_rss=None, ok=True):
+        started = datetime.fromtimestamp(time.time() - wall) if wall is not None else None
+        self._execute(
+            "insert into stagemetrics values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (self.run, library, stage, started.isoformat(' ') if started else None,
+             wall, cpu, bytes, records, peak_rss, int(bool(ok))))
+        return
+
+    def record_bowtie(self, library, bowtie, ok=True):
+        '''align row of a Bowtie that ran (its duration, the usage of its bowtie processes & the reads they aligned)'''
+        cpu, rss = bowtie.usage or (None, None)
+        wall = bowtie.duration.total_seconds() if bowtie.duration else None
+        self.record(library, "align", wall, cpu, file_size(bowtie.query), bowtie.reads, rss, ok)
+        return
+
+    def finish(self):
+        '''marks the run finished'''
+        row = self._execute("select started from pipelineruns where run = ?", (self.run, ))
+        now = datetime.now()
+        seconds = None
+        if row and row[0][0]:
+            seconds = (now - _timestamp(row[0][0])).total_seconds()
+        self._execute("update pipelineruns set finished = ?, seconds = ? where run = ?",
+                      (now.isoformat(' '), seconds, self.run))
+        return
+
+    def slowest(self, limit=10):
+        '''[(run, library, stage, wall, cpu, bytes, records, peak_rss)] of the latest run of every library's stages,
+        slowest first'''
+        return self._execute(
+            "select run, library, stage, wall, cpu, bytes, records, peak_rss from stagemetrics m "
+            "where ok = 1 and library != ? and run = (select max(run) from stagemetrics "
+            "where library = m.library and stage = m.stage and ok = 1) order by wall desc limit ?", (ALL, limit))
+
+    def throughput(self):
+        '''[(run, stage, libraries, wall, records, bytes, peak_rss)] summed per run & stage'''
+        return self._execute(
+            "select run, stage, count(*), sum(wall), sum(records), sum(bytes), max(peak_rss) "
+            "from stagemetrics where ok = 1 group by run, stage order by run, stage")
+
+    def runs(self, limit=10):
+        '''[(run, command, started, seconds)] of the last runs with metrics, oldest first'''
+        rows = self._execute(
+            "select run, command, started, seconds from pipelineruns "
+            "where run in (select distinct run from stagemetrics) order by run desc limit ?", (limit, ))
+        return list(reversed(rows))
+
+    def report(self, limit=10):
+        '''prints the slowest libraries, the throughput of each stage's latest run and the trend over the last runs'''
+        rows = self.throughput()
+        if not rows:
+            print "no metrics recorded yet"
+            return
+        rate = lambda amount, wall, fmt="%.0f": fmt % (amount / wall) if amount is not None and wall else "-"
+        mb = lambda amount: "%.1f" % (amount / 1024.0 ** 2) if amount is not None else "-"
+        print "slowest libraries:"
+        print "\t".join(["run", "library", "stage", "wall", "cpu", "records/s", "MB/s", "peak MB"])
+        for run, library, stage, wall, cpu, size, records, rss in self.slowest(limit):
+            print "\t".join([str(run), library, stage, "%.1fs" % wall, "%.1fs" % cpu if cpu is not None else "-",
+                             rate(records, wall), rate(size and size / 1024.0 ** 2, wall, "%.2f"), mb(rss)])
+        print
+        print "latest run of each stage:"
+        print "\t".join(["stage", "run", "libraries", "wall", "records/s", "MB/s", "peak MB"])
+        latest = dict((stage, row) for row in rows for stage in [row[1]])
+        order = dict((stage, i) for i, stage in enumerate(STAGES))
+        for stage in sorted(latest, key=lambda stage: order.get(stage, len(order))):
+            run, stage, count, wall, records, size, rss = latest[stage]
+            print "\t".join([stage, str(run), str(count), "%.1fs" % wall, rate(records, wall),
+                             rate(size and size / 1024.0 ** 2, wall, "%.2f"), mb(rss)])
+        print
+        print "records/s per stage over the last %s runs:" % limit
+        print "\t".join(["run", "started"] + STAGES)
+        rates = dict(((run, stage), rate(records, wall))
+                     for run, stage, count, wall, records, size, rss in rows)
+        for run, command, started, seconds in self.runs(limit):
+            print "\t".join([str(run), (started or '').partition('.')[0]] +
+                            [rates.get((run, stage), "-") for stage in STAGES])
+        return
+
+    def close(self):
+        self.conn.close()
+
+
+def main():
+    StageMetrics(sys.argv[1] if len(sys.argv) > 1 else DB_FILE).report()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+import os
+import sys
+import json
+import zlib
+import struct
+
+from . import CacheHelper
+
+
+'''compiled model -> value table of a tab separated file (the cds & cDNA length files)
+
+    the aggregate looks up a model's cds & cDNA length for every row. Instead of a dict in every
+    process the file is compiled once into a table in the cache folder that every process maps and
+    reads in place (see CacheHelper.view), a hash table stored in the file does the lookups.
+    The table is recompiled only when the source file changes.
+
+    layout:
+        header      - magic, model count, slot count, length of the json source fingerprint
+        source      - json (path, size, mtime, sha1) of the source file
+        names       - per model + 1: offset into the names text (uint32)
+        values      - per model + 1: offset into the values text (uint32)
+        slots       - crc32(model) open addressing slots: model position + 1, 0 is empty (uint32)
+        names text  - concatenated model names
+        values text - concatenated values
+    '''
+
+
+MAGIC = 'RNAMTBL1'
+HEADER = struct.Struct('<8sIII')
+
+# (filename, folder) -> ModelTable of this process
+_loaded = dict()
+
+
+def _hash(model):
+    return zlib.crc32(model) & 0xffffffff
+
+
+def _offsets(texts):
+    offsets = [0]
+    for text in texts:
+        offsets.append(offsets[-1] + len(text))
+    return struct.pack('<%sI' % len(offsets), *offsets)
+
+
+def parse_table(filename):
+    '''(models, values) of a file with a header line, the last line of a model wins (as in a dict filled line by line)'''
+    positions = dict()
+    models = list()
+    values = list()
+    with open(filename) as fh:
+        fh.readline()
+        for line in fh:
+            sp = line.strip().split("\t")
+            if sp[0] in positions:
+                values[positions[sp[0]]] = sp[1]
+            else:
+                positions[sp[0]] = len(models)
+                models.append(sp[0])
+                values.append(sp[1])
+    return models, values
+
+
+class ModelTable(object):
+    '''read only view of a compiled table, missing models get default (as the defaultdicts it replaces)'''
+
+    def __init__(self, filename, folder=None, default=0):
+        self.filename = filename
+        self.default = default
+        self.indexfile = os.path.join(
+            CacheHelper.cache_folder('tables', folder),
+            CacheHelper.key_name(os.path.abspath(filename)) + '.mtbl')
+        if not self._load():
+            self.build()
+            self._load()
+
+    def _load(self):
+        if not os.path.isfile(self.indexfile):
+            return False
+        self.mm = CacheHelper.map_file(self.indexfile)
+        magic, count, nslots, sourcelen = HEADER.unpack_from(self.mm, 0)
+        pos = HEADER.size
+        if magic != MAGIC or not self._is_current(json.loads(self.mm[pos:pos + sourcelen])):
+            self.mm.close()
+            return False
+        pos += sourcelen
+        self.count = count
+        self.nslots = nslots
+        self.stat = CacheHelper.file_stat(self.filename)
+        self.names, pos = CacheHelper.view(self.mm, pos, count + 1)
+        self.values, pos = CacheHelper.view(self.mm, pos, count + 1)
+        self.slots, pos = CacheHelper.view(self.mm, pos, nslots)
+        self.names_start = pos
+        self.values_start = pos + self.names[count]
+        return True
+
+    def _is_current(self, source):
+        '''stat first, content hash only when the size or mtime changed'''
+        path, size, mtime, sha = source
+        try:
+            cpath, csize, cmtime = CacheHelper.file_stat(self.filename)
+        except OSError:
+            return False
+        if cpath != path:
+            return False
+        if (csize, cmtime) == (size, mtime):
+            return True
+        return csize == size and CacheHelper.content_hash(self.filename) == sha
+
+    def is_current(self):
+        '''True while the source keeps the path, size & mtime it had when the table was loaded'''
+        try:
+            return CacheHelper.file_stat(self.filename) == self.stat
+        except OSError:
+            return False
+
+    def build(self):
+        source = CacheHelper.fingerprint(self.filename)
+        models, values = parse_table(self.filename)
+        nslots = 8
+        while nslots < 2 * len(models):
+            nslots *= 2
+        slots = [0] * nslots
+        for position, model in enumerate(models):
+            slot = _hash(model) & (nslots - 1)
+            while slots[slot]:
+                slot = (slot + 1) & (nslots - 1)
+            slots[slot] = position + 1
+        sourcejson = json.dumps(source)
+        with CacheHelper.atomic_open(self.indexfile) as fh:
+            fh.write(HEADER.pack(MAGIC, len(models), nslots, len(sourcejson)))
+            fh.write(sourcejson)
+            fh.write(_offsets(models))
+            fh.write(_offsets(values))
+            fh.write(struct.pack('<%sI' % nslots, *slots))
+            fh.write(''.join(models))
+            fh.write(''.join(values))
+        return
+
+    def name(self, i):
+        return self.mm[self.names_start + self.names[i]:self.names_start + self.names[i + 1]]
+
+    def value(self, i):
+        return self.mm[self.values_start + self.values[i]:self.values_start + self.values[i + 1]]
+
+    def find(self, model):
+        '''position of model or -1'''
+        mask = self.nslots - 1
+        slot = _hash(model) & mask
+        while True:
+            position = self.slots[slot]
+            if not position:
+                return -1
+            if self.name(position - 1) == model:
+                return position - 1
+            slot = (slot + 1) & mask
+
+    def get(self, model, default=None):
+        i = self.find(model)
+        if i == -1:
+            return self.default if default is None else default
+        return self.value(i)
+
+    def __getitem__(self, model):
+        return self.get(model)
+
+    def __contains__(self, model):
+        return self.find(model) != -1
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return (self.name(i) for i in xrange(self.count))
+
+    def close(self):
+        '''drops the mapping, it is unmapped once no view of it is left'''
+        self.names = self.values = self.slots = self.mm = None
+
+
+def shared_table(filename, folder=None):
+    '''the ModelTable of a file for this process (and the workers it forks), reloaded when the file changed'''
+    key = (os.path.abspath(filename), folder)
+    table = _loaded.get(key)
+    if table is None or not table.is_current():
+        table = _loaded[key] = ModelTable(filename, folder)
+    return table
+
+
+def main():
+    table = ModelTable(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None)
+    print "%s: %s models in %s" % (table.filename, len(table), table.indexfile)
+
+if __name__ == '__main__':
+    main()
@@ -1,29 +1,281 @@
-from multiprocessing import Process, Pipe
-from itertools import izip
+import os
+import array
+import tempfile
+import itertools
+import traceback
+import multiprocessing
+import cPickle as pickle
 
+from Queue import Empty
 
-def spawn(f):
-    def fun(pipe, x):
-        pipe.send(f(x))
-        pipe.close()
-    return fun
+
+'''bounded process pool mapping a function over many items
+
+    a WorkerPool keeps the same worker processes for its whole life. Items are sent in chunks and at
+    most "backlog" chunks are in flight (sent but not yet handed to the caller), so a slow consumer
+    holds the dispatch back instead of piling results up in memory, and items may come from a
+    generator. imap yields the results in the order of the items, imap_unordered as they are done.
+    A function raising in a worker raises WorkerError in the caller with the worker's traceback, a
+    worker that dies raises WorkerError instead of waiting forever.
+    Arrays (array.array) of SHARED_BYTES or more, as a result or in a result tuple/list, are
+    written to a file in shared memory (/dev/shm) and read back by the caller instead of being
+    pickled through the result pipe.
+    '''
+
+
+SHARED_BYTES = 256 * 1024
+SHM_FOLDER = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+# seconds between checks that the workers are still alive while waiting for a result
+POLL = 1.0
+
+
+class WorkerError(Exception):
+    '''a function raised in a worker or a worker died (the worker's traceback is kept in .traceback)'''
+
+    def __init__(self, message, traceback=None):
+        Exception.__init__(self, message + ('\n' + traceback if traceback else ''))
+        self.traceback = traceback
+
+
+class SharedArray(object):
+    '''an array.array handed from a worker to the caller through a file in shared memory'''
+
+    def __init__(self, values):
+        fd, self.path = tempfile.mkstemp(prefix='rnaseq-', suffix='.array', dir=SHM_FOLDER)
+        with os.fdopen(fd, 'wb') as fh:
+            values.tofile(fh)
+        self.typecode = values.typecode
+        self.length = len(values)
+
+    def get(self):
+        '''the array, the file is removed'''
+        values = array.array(self.typecode)
+        try:
+            with open(self.path, 'rb') as fh:
+                values.fromfile(fh, self.length)
+        finally:
+            self.discard()
+        return values
+
+    def discard(self):
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+def _share(value):
+    if isinstance(value, array.array) and value.itemsize * len(value) >= SHARED_BYTES:
+        return SharedArray(value)
+    return value
+
+
+def share(result):
+    '''the result with its large arrays (also those in a tuple or list) moved to shared memory'''
+    if type(result) in (tuple, list):
+        return type(result)(_share(value) for value in result)
+    return _share(result)
+
+
+def unshare(result):
+    '''the result with its shared arrays read back'''
+    if type(result) in (tuple, list):
+        return type(result)(unshare(value) for value in result)
+    return result.get() if isinstance(result, SharedArray) else result
+
+
+def discard(result):
+    '''removes the shared arrays of a result that is not handed out'''
+    for value in (result if type(result) in (tuple, list) else [result]):
+        if isinstance(value, SharedArray):
+            value.discard()
+    return
+
+
+def _worker(tasks, results):
+    '''worker process loop: (job, index, function, items) tasks in, (job, index, results, error) out'''
+    for task in iter(tasks.get, None):
+        job, index, function, items = pickle.loads(task)
+        values = list()
+        try:
+            for item in items:
+                values.append(share(function(item)))
+            # pickled here, an unpicklable result is an error of this chunk rather than a lost message
+            results.put((job, index, pickle.dumps(values, pickle.HIGHEST_PROTOCOL), None))
+        except Exception:
+            for value in values:
+                discard(value)
+            results.put((job, index, None, traceback.format_exc()))
+    return
+
+
+def _chunks(items, chunksize):
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, chunksize))
+        if not chunk:
+            return
+        yield chunk
+
+
+class WorkerPool(object):
+    '''processes worker processes (all cores by default), backlog chunks in flight (2 per process by default)'''
+
+    def __init__(self, processes=None, backlog=None):
+        self.processes = max(1, processes or multiprocessing.cpu_count())
+        self.backlog = max(1, backlog or 2 * self.processes)
+        self.tasks = multiprocessing.Queue()
+        self.results = multiprocessing.Queue()
+        self.jobs = itertools.count()
+        # job -> results of an active imap that another imap received first
+        self.stash = dict()
+        self.workers = list()
+        for i in xrange(self.processes):
+            worker = multiprocessing.Process(target=_worker, args=(self.tasks, self.results))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, tb):
+        if kind is None:
+            self.close()
+        else:
+            self.terminate()
+        return False
+
+    def _check_workers(self):
+        for worker in self.workers:
+            if not worker.is_alive():
+                code = worker.exitcode
+                self.terminate()
+                raise WorkerError("worker process %s exited with %s" % (worker.pid, code))
+        return
+
+    def _receive(self, job):
+        while True:
+            if self.stash.get(job):
+                return self.stash[job].pop(0)
+            try:
+                other, index, payload, error = self.results.get(timeout=POLL)
+            except Empty:
+                self._check_workers()
+                continue
+            if other == job:
+                return index, payload, error
+            if other in self.stash:
+                self.stash[other].append((index, payload, error))
+            else:
+                # a chunk of an imap that was left early (or failed)
+                self._discard(payload)
+
+    def _discard(self, payload):
+        if payload is not None:
+            for value in pickle.loads(payload):
+                discard(value)
+        return
+
+    def _imap(self, function, items, chunksize, ordered):
+        job = next(self.jobs)
+        # anything unpicklable fails here, in the caller, not in the queue's feeder thread
+        pickle.dumps(function, pickle.HIGHEST_PROTOCOL)
+        self.stash[job] = list()
+        chunks = _chunks(items, chunksize)
+        sent = 0
+        outstanding = 0
+        following = 0
+        done = dict()
+        try:
+            while True:
+                while outstanding < self.backlog:
+                    chunk = next(chunks, None)
+                    if chunk is None:
+                        break
+                    self.tasks.put(pickle.dumps((job, sent, function, chunk), pickle.HIGHEST_PROTOCOL))
+                    sent += 1
+                    outstanding += 1
+                if not outstanding:
+                    return
+                index, payload, error = self._receive(job)
+                if error is not None:
+                    raise WorkerError("%s failed in the chunk starting at item %s" % (
+                        getattr(function, '__name__', function), index * chunksize), error)
+                values = [unshare(value) for value in pickle.loads(payload)]
+                if not ordered:
+                    outstanding -= 1
+                    for value in values:
+                        yield value
+                    continue
+                done[index] = values
+                while following in done:
+                    values = done.pop(following)
+                    following += 1
+                    outstanding -= 1
+                    for value in values:
+                        yield value
+        finally:
+            for index, payload, error in self.stash.pop(job, []):
+                self._discard(payload)
+
+    def imap(self, function, items, chunksize=1):
+        '''yields function(item) for every item, in the order of the items'''
+        return self._imap(function, items, chunksize, True)
+
+    def imap_unordered(self, function, items, chunksize=1):
+        '''yields function(item) for every item, in the order they are done'''
+        return self._imap(function, items, chunksize, False)
+
+    def map(self, function, items, chunksize=1):
+        return list(self.imap(function, items, chunksize))
+
+    def close(self):
+        '''lets the workers finish the tasks sent so far and waits for them'''
+        for worker in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            # a worker only exits once the results it put are read
+            while worker.is_alive():
+                self._drain()
+                worker.join(0.1)
+        self._drain()
+        return
+
+    def terminate(self):
+        '''stops the workers at once, results not handed out yet are dropped'''
+        for worker in self.workers:
+            if worker.is_alive():
+                worker.terminate()
+        for worker in self.workers:
+            worker.join()
+        # tasks nobody will read again must not hold up this process' exit
+        self.tasks.cancel_join_thread()
+        self._drain()
+        return
+
+    def _drain(self):
+        while True:
+            try:
+                job, index, payload, error = self.results.get(timeout=0.1)
+            except Exception:
+                # empty, or a message cut off by a terminated worker
+                break
+            self._discard(payload)
+        for job in self.stash:
+            for index, payload, error in self.stash[job]:
+                self._discard(payload)
+            self.stash[job] = list()
+        return
 
 
 def parmap(f, X):
-    pipe = [Pipe() for x in X]
-    proc = [Process(target=spawn(f), args=(c, x))
-            for x, (p, c) in izip(X, pipe)]
-    [p.start() for p in proc]
-    [p.join() for p in proc]
-    return [p.recv() for (p, c) in pipe]
+    '''[f(x) for x in X] in one worker per item (at most one per core)'''
+    with WorkerPool(min(len(X), multiprocessing.cpu_count())) as pool:
+        return pool.map(f, X)
 
 
 def pparmap(f, X, num_procs):
-    res = []
-    num_parts = int(len(X) / num_procs) + 1
-    for i in range(num_parts):
-        if ((i + 1) * num_procs) >= len(X):
-            res += parmap(f, X[i * num_procs:])
-        else:
-            res += parmap(f, X[i * num_procs:((i + 1) * num_procs)])
-    return res
+    '''[f(x) for x in X] in num_procs workers'''
+    with WorkerPool(num_procs) as pool:
+        return pool.map(f, X)
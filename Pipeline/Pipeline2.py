@@ -4,19 +4,29 @@ import os
 import sys
 import gc
 import subprocess
-import multiprocessing
 import argparse
 
 from multiprocessing.dummy import Pool
 from datetime import datetime
 import signal
+import traceback
+import json
 
 from . import DBManager as DB
 from .RNASeq import RNASeqManager
 from .Bowtie import Bowtie
+from .IndexCache import IndexCache
 from .RPKM import RPKMs
-from .MasterRPKM import MasterRPKM
-from .tsv_splitter import Splitter
+from .HitCounter import HitCounter
+from .Scheduler import DataflowScheduler
+from . import Scheduler
+from .Ledger import StageLedger
+from .Metrics import StageMetrics, Measure, file_size, ALL
+from . import Catalog
+from .LibraryIndex import library_id
+from .MasterRPKM import MasterRPKM, widen
+from .ParallelHelper import WorkerPool
+from .tsv_splitter import Splitter, ExcelSplitter, EXCEL_ROWS, EXCEL_COLUMNS
 from . import fs_autocomplete
 
 
@@ -31,40 +41,107 @@ class Pipeline():
     3. The Hit values of each model are counted in order to calculate the RPKM values.
     4. The RPKM/Hit values are written into their own respective files as well as an aggregate ".tsv" file.
     (5.) The User may choose to then apply their tsv_splitter function to allow for the import restraints of microsoft excel.
+         (-shard picks the row & column shards from excel's limits and lists them in a ".shards.tsv" index)
+
+    Steps 2-4 run as a dataflow: each library's RPKM is counted in a process pool as soon as its own bowtie finishes
+    and the aggregate files are written once the last library is counted.
+
+    STREAMING
+    with stream=True steps 2 & 3 are merged: bowtie's stdout is counted as the alignments arrive and no ".albwt" file is written.
+    tee=True additionally keeps a gzip compressed copy of the alignments (".albwt.gz") in the bowtie output folder.
+    shards=N splits every library's reads across N bowtie processes (fed through their stdin, nothing is copied to disk)
+    and merges their hit counts, so a single huge library no longer runs on a handful of threads at the end.
+
+    METRICS
+    the wall & cpu time, bytes & records and peak RSS of every library's stages are recorded per run in
+    rnaseq.sqlite (see Metrics), -metrics prints the slowest libraries, the throughput per stage and its trend.
+    A run is started by the work itself (runPipeline, RPKMbyDirectory or runAggregate) and marked finished when it is done.
+
+    RESUMING
+    every library's align, count & aggregate stage is recorded in a ledger in rnaseq.sqlite (-ledger prints it).
+    The library catalog in rnaseq.sqlite keeps every library's files, sizes, read count and latest stage
+    (-catalog prints it, -catalog realign only the libraries that still need to be aligned).
+    A rerun reuses the alignments & counts an interrupted run finished, and all outputs are written under a temporary
+    name and renamed into place, so a truncated file is never taken for a finished one.
 
     ALL FUNCTIONS MAY BE RUN INDIVIDUALLY
     as the amount of data and the time necessary to process each library has drastically increased, errors with storage space & memory have become increasingly
     problematic. For this reason, all functions of the pipeline can be run individually to avoid wasting time on redundant functions.
     '''
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, stream=False, tee=False, incremental=False, normalized=False,
+                 batch=False, manifest=None, shards=1, *args, **kwargs):
         self.config = DB.DBM.config
         self.pool = Pool(processes=3)
         self.manager = dict()
+        self.stream = stream
+        self.tee = tee
+        self.incremental = incremental
+        self.normalized = normalized
+        self.shards = shards
+        self.batch = batch or manifest is not None
+        self.manifest = read_manifest(manifest) if manifest else dict()
+        self.ledger = StageLedger()
+        self.metrics = StageMetrics()
         self.RNA = RNASeqManager()
 
     def runPipeline(self):
         startTime = datetime.now()
-        self.queueBowties()
-        self.queueRPKMs()
-        self.Aggregate()
+        self.metrics.start_run()
+        if self.stream:
+            self.queueStreams()
+            self.Aggregate()
+        else:
+            self.runDataflow()
         duration = datetime.now() - startTime
+        self.metrics.finish()
         print "Pipeline took:"
         print(duration)
 
     def queueBowties(self):
-        self.bowtiePool = Pool(processes=3)
+        '''bowtie jobs share the host's cores & memory (capped by "Max Cores"/"Max Memory"), see Scheduler.BowtieScheduler'''
         self.manager = self.getBowties()
-        results = []
-        startTime = datetime.now()
-        for lib, bwt in self.manager.iteritems():
-            print lib
-            result = self.bowtiePool.apply_async(bwt.runBowtie)
-            results.append(result)
-        self.bowtiePool.close()
-        self.bowtiePool.join()
+        self.resolveReference(self.manager)
+        Scheduler.from_config(self.config).run(self.manager, callback=self.bowtieFinished)
+
+    def bowtieFinished(self, lib, error):
+        self.metrics.record_bowtie(lib, self.manager[lib], ok=error is None)
         return
 
+    def runDataflow(self):
+        '''aligns the missing libraries and counts each one as soon as its alignment is done, then aggregates
+        every stage is recorded in the ledger, a rerun skips what an earlier (interrupted) run already finished'''
+        bowties = self.getBowties()
+        rpkms = self.getRPKMs()
+        self.resolveReference(bowties)
+        aligned = list()
+        for lib in bowties.keys():
+            state = self.resumeState(lib, bowties[lib], rpkms[lib],
+                                     [rpkms[lib].bowtiefile, rpkms[lib].glymafile])
+            if state == "counted":
+                print "%s: already aligned & counted" % lib
+                del bowties[lib]
+            elif state == "aligned":
+                print "%s: already aligned, counting" % lib
+                del bowties[lib]
+                aligned.append(lib)
+        scheduler = DataflowScheduler(aligner=Scheduler.from_config(self.config), ledger=self.ledger,
+                                      metrics=self.metrics)
+        scheduler.run(bowties, rpkms, finish=lambda: self.Aggregate(resume=True), aligned=aligned)
+        return
+
+    def resumeState(self, lib, bowtie, rpkm, count_inputs):
+        '''"counted", "aligned" or None: how far earlier runs got with a library (see Ledger.StageLedger)
+        count_inputs - the inputs the count records on this path, an rpkm counted from others is stale'''
+        if not self.ledger.is_done(lib, "align", [bowtie.query]):
+            return None
+        if self.ledger.is_done(lib, "count", count_inputs) and \
+                self.ledger.outputs(lib, "count") == [os.path.abspath(rpkm.outputfile)]:
+            return "counted"
+        if self.ledger.outputs(lib, "align") == [os.path.abspath(bowtie.output)]:
+            return "aligned"
+        return None
+
     def getBowties(self):
         cmds = dict()
         for lib in self.RNA.MissingLibraries:
@@ -82,44 +159,132 @@ class Pipeline():
                 query=query_path,
                 reference=self.config["Reference Path"],
                 output=output_path,
+                bowtieFolder=self.config["Bowtie Path"],
+                indexFolder=os.path.dirname(self.config["Reference Path"]),
+                threads=self.config["-p"] or 8,
+                interactive=not self.batch,
+                build_index=self.manifest.get("build_index", False),
+                build_folder=self.manifest.get("index_folder"),
+                build_name=self.manifest.get("index_name"),
+                shards=self.shards,
+                cache_folder=self.config["Cache Path"],
+                cache_size=self.config["Index Cache Size"],
             )
             cmds[lib] = bowtie
         return cmds
 
+    def resolveReference(self, bowties):
+        '''finds (or builds) the bowtie index once before any job starts, so no job stops to ask for it'''
+        if not bowties:
+            return
+        first = bowties.values()[0]
+        first.checkReference(first.reference)
+        for bowtie in bowties.values():
+            # the index cache holds the index against eviction for as long as any job may use it
+            bowtie.reference = first.reference
+            bowtie.index_cache = first.index_cache
+        return
+
+    def getRPKM(self, library):
+        return RPKMs(bowtiefile=library.bowtie_file,
+                     glymafile=self.config["GlymaFile"],
+                     outputfile=os.path.join(self.config["RPKM Output"],
+                                             library.bowtie_file.rpartition('/')[-1].rstrip('.albwt') + '.rpkm'),
+                     libraryname=library.name,
+                     bowtie_model_column=self.config["Bowtie Column"],
+                     glyma_model_column=self.config["Glyma Column"],
+                     index_folder=self.config["Cache Path"],
+                     store_folder=self.config["Store Path"],
+                     cache_size=self.config["Cache Size"],
+                     )
+
     def getRPKMs(self):
         cmds = dict()
         for lib in self.RNA.MissingLibraries:
-            library = self.RNA.RNASeqDir[lib]
-            rpkm = RPKMs(bowtiefile=library.bowtie_file,
-                         glymafile=self.config["GlymaFile"],
-                         outputfile=os.path.join(self.config["RPKM Output"],
-                                                 library.bowtie_file.rpartition('/')[-1].rstrip('.albwt') + '.rpkm'),
-                         libraryname=library.name,
-                         bowtie_model_column=self.config["Bowtie Column"],
-                         glyma_model_column=self.config["Glyma Column"],
-                         )
-            cmds[lib] = rpkm
+            cmds[lib] = self.getRPKM(self.RNA.RNASeqDir[lib])
         return cmds
 
+    def queueStreams(self):
+        '''aligns every missing library with its bowtie output piped straight into the hit counter'''
+        bowties = self.getBowties()
+        for lib in bowties.keys():
+            rpkm = self.getRPKM(self.RNA.RNASeqDir[lib])
+            if self.resumeState(lib, bowties[lib], rpkm, [bowties[lib].query, rpkm.glymafile]) == "counted":
+                print "%s: already aligned & counted" % lib
+                del bowties[lib]
+        self.resolveReference(bowties)
+        Scheduler.from_config(self.config).run(
+            bowties, callback=self.streamFinished, run=self.streamLibrary)
+        return
+
+    def streamFinished(self, lib, error):
+        if error is not None:
+            print "%s failed:" % lib
+            print error
+
+    def streamLibrary(self, lib, bwt):
+        library = self.RNA.RNASeqDir[lib]
+        tee = None
+        if self.tee:
+            tee = bwt.output + '.gz'
+        rpkm = self.getRPKM(library)
+        counter = HitCounter(bowtie_model_column=self.config["Bowtie Column"])
+        self.ledger.start(lib, "align", [bwt.query])
+        self.ledger.start(lib, "count", [bwt.query, rpkm.glymafile])
+        try:
+            if bwt.shards > 1:
+                bwt.shardBowtie(counter, bwt.shards, tee=tee)
+            else:
+                bwt.streamBowtie(counter, tee=tee)
+            self.ledger.finish(lib, "align", [tee] if tee else [])
+            self.metrics.record_bowtie(lib, bwt)
+            # counted in this process next to the other streams, so only the wall time is its own
+            measure = Measure()
+            rpkm.runRPKM(counter.hits())
+            self.metrics.record(lib, "count", measure.stop()[0], records=rpkm.records)
+        except Exception:
+            error = traceback.format_exc()
+            if self.ledger.get(lib, "align")["state"] != "done":
+                self.ledger.fail(lib, "align", error)
+            self.ledger.fail(lib, "count", error)
+            raise
+        self.ledger.finish(lib, "count", [rpkm.outputfile])
+        return
+
     def queueRPKMs(self):
+        '''counts every missing library in this process, a library that fails is reported and skipped'''
+        failed = list()
         for lib, rpkm in self.getRPKMs().iteritems():
             try:
                 rpkm.runRPKM()
-            except:
-                pdb.set_trace()
-        return
+            except Exception:
+                failed.append(lib)
+                print "%s failed:" % lib
+                print traceback.format_exc()
+        return failed
 
     def RPKMbyDirectory(self, directory=None):
-        '''finds all bowtie files in a directory and turns them into rpkm files'''
+        '''finds all bowtie files (.albwt or the compressed .albwt.gz copies) in a directory and turns them into rpkm files
+        every library name is settled first (manifest, prompt or the file's id in batch mode), then the files are counted in parallel'''
+        if directory is None:
+            directory = self.manifest.get("directory")
         if directory is None:
+            if self.batch:
+                raise ValueError("batch mode needs the bowtie directory (-input or \"directory\" in the manifest)")
             directory = fs_autocomplete.get_input(
                 "Please enter the bowtie directory: ")
-        for key in os.listdir(directory):
-            if key.rpartition('.')[-1] == 'albwt':
-                print self.config["RPKM Output"]
-                if self.config["RPKM Output"] is None or self.config == '':
-                    print "no RPKM directory"
-                    break
+        print self.config["RPKM Output"]
+        if self.config["RPKM Output"] is None or self.config["RPKM Output"] == '':
+            print "no RPKM directory"
+            return
+        self.metrics.start_run()
+        jobs = list()
+        for key in sorted(os.listdir(directory)):
+            if key.endswith('.albwt.gz'):
+                name = key[:-len('.gz')]
+            else:
+                name = key
+            if name.rpartition('.')[-1] == 'albwt':
                 rpkm = RPKMs(
                     bowtiefile=os.path.join(
                         directory,
@@ -127,18 +292,50 @@ class Pipeline():
                     glymafile=self.config["GlymaFile"],
                     outputfile=os.path.join(
                         self.config["RPKM Output"],
-                        key.rpartition('.')[0] +
+                        name.rpartition('.')[0] +
                         '.rpkm'),
-                    libraryname=self.cmdlibname(key),
+                    libraryname=self.libraryName(key),
                     bowtie_model_column=self.config["Bowtie Column"],
                     glyma_model_column=self.config["Glyma Column"],
+                    index_folder=self.config["Cache Path"],
+                    store_folder=self.config["Store Path"],
+                    cache_size=self.config["Cache Size"],
                 )
                 print rpkm.outputfile
-                rpkm.runRPKM()
+                # the metrics of a library are recorded under its id, as the pipeline's are
+                jobs.append((library_id(key), rpkm, self.metrics.run))
+        self.countRPKMs(jobs)
         self.pool.close()
         self.pool.join()
+        self.metrics.finish()
         return
 
+    def libraryName(self, entry):
+        '''name of a bowtie file's library: from the manifest, the file's id in batch mode, else asked for'''
+        names = self.manifest.get("libraries", {})
+        if entry in names:
+            return names[entry]
+        if self.batch:
+            return entry.partition('_')[0]
+        return self.cmdlibname(entry)
+
+    def countRPKMs(self, jobs):
+        '''runs [(name, RPKMs, metrics run)] in a process pool of "Max Cores" processes'''
+        if not jobs:
+            return
+        # the workers inherit the length indexes loaded here (see RPKMs.publish)
+        for job in jobs:
+            job[1].publish()
+        failed = list()
+        with WorkerPool(min(len(jobs), Scheduler.count_processes(self.config))) as countPool:
+            for lib, error in countPool.imap_unordered(Scheduler.run_count_job, jobs):
+                if error is not None:
+                    failed.append(lib)
+                    print "%s failed:" % lib
+                    print error
+        print "counted %s of %s files" % (len(jobs) - len(failed), len(jobs))
+        return failed
+
     def alarmHandler(self, selfsignum, frame):
         raise AlarmException
 
@@ -157,12 +354,49 @@ class Pipeline():
         signal.signal(signal.SIGALRM, signal.SIG_IGN)
         return libname
 
-    def Aggregate(self):
+    def runAggregate(self):
+        '''Aggregate on its own as a metrics run'''
+        self.metrics.start_run()
+        self.Aggregate()
+        self.metrics.finish()
+        return
+
+    def Aggregate(self, resume=False):
+        '''with incremental=True only new or changed libraries are merged into the last aggregate files
+        with normalized=True the aggregate is written as expression files plus an annotation table
+        with resume=True nothing is done when the ledger shows every library's rpkm file already aggregated'''
         master = MasterRPKM(
             annotationpath=self.config["Annotation Path"],
             rpkm_path=self.config["RPKM Path"],
+            layout="normalized" if self.normalized else "wide",
         )
-        master._run_Aggregate()
+        libraries = master.library_files()
+        if resume and libraries and all(
+                self.ledger.is_done(lib, "aggregate", [rpkmfile]) for lib, rpkmfile in libraries):
+            print "aggregate is up to date: %s" % ", ".join(self.ledger.outputs(libraries[0][0], "aggregate"))
+            return
+        for lib, rpkmfile in libraries:
+            self.ledger.start(lib, "aggregate", [rpkmfile])
+        measure = Measure(children=True)
+        try:
+            if self.incremental:
+                master._run_Incremental()
+            else:
+                master._run_Aggregate()
+        except Exception:
+            error = traceback.format_exc()
+            for lib, rpkmfile in libraries:
+                self.ledger.fail(lib, "aggregate", error)
+            self.metrics.record(ALL, "aggregate", measure.stop()[0], ok=False)
+            raise
+        wall, cpu, rss = measure.stop(master.parse_peaks)
+        self.metrics.record(ALL, "aggregate", wall, cpu, sum(file_size(f) or 0 for lib, f in libraries),
+                            len(getattr(master, 'model_order', [])) * len(master.sortedlibraries), rss)
+        for lib, rpkmfile in libraries:
+            if lib in master.missinglibraries:
+                self.ledger.fail(lib, "aggregate", "could not be read")
+            else:
+                self.ledger.finish(lib, "aggregate", master.outputs)
         return
 
 
@@ -170,6 +404,20 @@ class AlarmException(Exception):
     pass
 
 
+def read_manifest(filename):
+    '''batch manifest (json), every key is optional:
+        directory   - folder of bowtie files for -RPKM -dir
+        libraries   - bowtie file name -> library name
+        build_index - build a missing bowtie index instead of failing (default false)
+        index_folder, index_name - where a built index goes (default: the shared index cache in the "Cache Path")'''
+    with open(filename) as fh:
+        manifest = json.load(fh)
+    unknown = set(manifest) - set(["directory", "libraries", "build_index", "index_folder", "index_name"])
+    if unknown:
+        raise ValueError("unknown keys in %s: %s" % (filename, ", ".join(sorted(unknown))))
+    return manifest
+
+
 class PipeArgs:
 
     '''manages command line input to determine what functions to run'''
@@ -199,7 +447,15 @@ class PipeArgs:
             "-split",
             "-Split",
             action="store_true",
-            help="splits a provided aggregate file at the default library")
+            help="splits a provided aggregate file at the default library (or the \"Split\" libraries)")
+        functions.add_argument(
+            "-shard",
+            action="store_true",
+            help="splits a provided aggregate file into shards within excel's row & column limits")
+        functions.add_argument(
+            "-widen",
+            action="store_true",
+            help="joins a normalized expression file and its annotation table into the wide aggregate layout")
         functions.add_argument(
             "-update",
             "-updateDB",
@@ -220,6 +476,68 @@ class PipeArgs:
             '-viewoptions',
             action="store_true",
             help="print the default options for the pipeline stored in the SQLdatabase")
+        parser.add_argument(
+            '-ledger',
+            action="store_true",
+            help="print the stage (align, count, aggregate) of every library recorded by earlier runs")
+        parser.add_argument(
+            '-catalog',
+            nargs='?',
+            const="all",
+            choices=Catalog.FILTERS,
+            help="print the library catalog: all libraries, the ones missing an rpkm file or the ones needing realignment")
+        parser.add_argument(
+            '-metrics',
+            action="store_true",
+            help="print the slowest libraries, records per second per stage and their trend over the last runs")
+        parser.add_argument(
+            '-cachestats',
+            action="store_true",
+            help="print the size & hit rate of the RPKM result cache and the indexes in the bowtie index cache")
+        parser.add_argument(
+            '-batch',
+            action="store_true",
+            help="never prompt: library names default to the file's id and a missing bowtie index is an error")
+        parser.add_argument(
+            '-manifest',
+            help="json batch manifest (directory, libraries, build_index, index_folder, index_name), implies -batch")
+        parser.add_argument(
+            '-input',
+            nargs='+',
+            help="the file(s) or directory -dir, -split, -shard & -widen would otherwise ask for")
+        parser.add_argument(
+            '-stream',
+            action="store_true",
+            help="with -pipeline: count bowtie's output as it is produced instead of writing .albwt files")
+        parser.add_argument(
+            '-shards',
+            type=int,
+            default=1,
+            help="with -pipeline: align every library with this many bowtie processes at once (implies -stream)")
+        parser.add_argument(
+            '-tee',
+            action="store_true",
+            help="with -stream: also keep a gzip compressed copy of the alignments (.albwt.gz)")
+        parser.add_argument(
+            '-incremental',
+            '-inc',
+            action="store_true",
+            help="with -aggregate/-pipeline: merge only new or changed libraries into the last aggregate files")
+        parser.add_argument(
+            '-normalized',
+            '-norm',
+            action="store_true",
+            help="with -aggregate/-pipeline: write one row per model and a separate annotation table (see -widen)")
+        parser.add_argument(
+            '-rows',
+            type=int,
+            default=EXCEL_ROWS,
+            help="with -shard: rows per shard, header included (default %(default)s)")
+        parser.add_argument(
+            '-columns',
+            type=int,
+            default=EXCEL_COLUMNS,
+            help="with -shard: columns per shard (default %(default)s)")
         if len(sys.argv) == 1:
             parser.print_help()
             sys.exit(1)
@@ -229,25 +547,65 @@ class PipeArgs:
         p = self.parser
         if p.view:
             DB.DBM.printOptions()
+        if p.ledger:
+            StageLedger().report()
+        if p.catalog:
+            catalog = Catalog.from_config(DB.DBM.config)
+            catalog.report(None if p.catalog == "all" else getattr(catalog, p.catalog)())
+        if p.metrics:
+            StageMetrics().report()
+        if p.cachestats:
+            cache = RPKMs(index_folder=DB.DBM.config["Cache Path"],
+                          cache_size=DB.DBM.config["Cache Size"]).getCache()
+            if cache is None:
+                print "the RPKM result cache is turned off (Cache Size 0 or blank)"
+            else:
+                cache.printStats()
+            IndexCache(DB.DBM.config["Cache Path"],
+                       float(DB.DBM.config["Index Cache Size"] or 0) * 1024 ** 3).printStats()
         if p.pipeline:
-            Pipeline().runPipeline()
+            Pipeline(stream=p.stream or p.shards > 1, tee=p.tee, incremental=p.incremental,
+                     normalized=p.normalized, batch=p.batch, manifest=p.manifest,
+                     shards=p.shards).runPipeline()
         if p.RPKM:
             if p.dir:
-                Pipeline().RPKMbyDirectory()
+                Pipeline(batch=p.batch, manifest=p.manifest).RPKMbyDirectory(self.inputs(p, 1)[0])
             elif p.single:
+                if p.batch or p.manifest:
+                    raise SystemExit("batch mode: -RPKM -single prompts for its files, use -RPKM -dir with -input")
                 rpkm = RPKMs()
                 rpkm.cmdRPKM()
         if p.aggregate:
-            Pipeline().Aggregate()
+            Pipeline(incremental=p.incremental, normalized=p.normalized).runAggregate()
         if p.split:
-            resp = fs_autocomplete.get_input(
-                "Please enter the file you wish to split: ")
-            Splitter(entryfile=resp)
+            resp = self.inputs(p, 1, "Please enter the file you wish to split: ")[0]
+            cuts = [int(cut) for cut in str(DB.DBM.config["Split"]).split(',') if cut.strip()]
+            print "\n".join(Splitter(entryfile=resp, cutpoints=cuts or None)._get_list())
+        if p.shard:
+            resp = self.inputs(p, 1, "Please enter the file you wish to shard: ")[0]
+            print ExcelSplitter(entryfile=resp, max_rows=p.rows, max_columns=p.columns).indexfile
+        if p.widen:
+            expressionfile, annotationfile = self.inputs(
+                p, 2, "Please enter the normalized Hits or RPKM file: ", "Please enter its annotation table: ")
+            outputfile = expressionfile[:-len(".expression.tsv")] + ".tsv" if expressionfile.endswith(
+                ".expression.tsv") else expressionfile + ".wide.tsv"
+            print widen(expressionfile, annotationfile, outputfile)
         if p.update:
+            if p.batch or p.manifest:
+                raise SystemExit("batch mode: -update prompts for every option")
             DB.DBM.getOptions()
         gc.collect()
         return
 
+    def inputs(self, p, count, *prompts):
+        '''the -input paths, prompting for missing ones unless in batch mode (None when there is no prompt)'''
+        given = list(p.input or [])[:count]
+        for prompt in prompts[len(given):]:
+            if p.batch or p.manifest:
+                raise SystemExit("batch mode: pass %s file(s) with -input" % count)
+            given.append(fs_autocomplete.get_input(prompt))
+        return given + [None] * (count - len(given))
+
 
 def main():
     PipeArgs().run()
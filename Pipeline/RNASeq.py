@@ -3,6 +3,8 @@ import sys
 
 from collections import defaultdict
 from . import DBManager as DB
+from .LibraryIndex import library_index
+from .Catalog import LibraryCatalog
 
 
 class RNASeq(object):
@@ -42,9 +44,8 @@ class RNASeq(object):
         return
 
     def get_file_by_id(self, folder):
-        file_list = os.listdir(folder)
-        related_files = [
-            x for x in file_list if self.id.strip() == x.split("_")[0].strip()]
+        '''the folder is scanned once for all libraries (see LibraryIndex)'''
+        related_files = library_index(folder, self.config["Cache Path"]).get(self.id)
         if len(related_files) > 1:
             print related_files
             print "Too many files associated with %s in %s. Exiting" % (self.id, folder)
@@ -63,11 +64,12 @@ class RNASeqManager:
 
     def __init__(self, *args, **kwargs):
         self.attrs = {
-            "raw_folder": None,
-            "rpkm_folder": None,
+            "raw_folder": DB.DBM.config["Raw Path"],
+            "rpkm_folder": DB.DBM.config["RPKM Path"],
         }
         self.manageKwargs(kwargs)
         self.initAttrs()
+        self.catalog = LibraryCatalog(cache=DB.DBM.config["Cache Path"])
         self.MissingLibraries = []
         self.RNASeqDir = self.get_complete_RNASeq()
 
@@ -85,10 +87,10 @@ class RNASeqManager:
         return
 
     def get_complete_RNASeq(self):
+        '''the raw libraries & the ones without an rpkm file come from the library catalog (see Catalog)'''
+        self.catalog.refresh(self.raw_folder, DB.DBM.config["Bowtie Output"] or None, self.rpkm_folder)
         RNASeqDict = dict()
-        for key in os.listdir(self.raw_folder):
-            id = key.split('_')[0]
+        for id in self.catalog.libraries("raw"):
             RNASeqDict[id] = RNASeq(id=id)
-            if not RNASeqDict[id].rpkm_file:
-                self.MissingLibraries.append(id)
+        self.MissingLibraries = self.catalog.missing()
         return RNASeqDict
@@ -4,6 +4,7 @@ import sys
 from collections import defaultdict
 
 from .RNASeq import RNASeq
+from .LibraryIndex import library_index
 
 
 class RNASeqManager:
@@ -33,7 +34,6 @@ class RNASeqManager:
         return
 
     def get_complete_RNASeq(self):
-        for key in os.listdir(self.raw_folder):
-            id = key.split('_')[0]
+        for id in library_index(self.raw_folder).ids():
             self.RNASeqDir[id] = RNASeq(id=id)
         return
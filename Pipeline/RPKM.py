@@ -1,12 +1,16 @@
 import os
 import sys
+import hashlib
 
 from collections import defaultdict
 
 from . import fs_autocomplete
 from . import PathCheck
-
-import pdb
+from . import CacheHelper
+from .HitCounter import HitCounter
+from . import LengthIndex
+from .ExpressionStore import ExpressionStore
+from .ResultCache import ResultCache
 
 
 '''calculates Hits & Rpkms for RNASeq Libraries
@@ -31,10 +35,14 @@ class RPKMs(object):
             "outputfile": None,
             "bowtie_model_column": 2,
             "glyma_model_column": 2,
-            "libraryname": None}
+            "libraryname": None,
+            "index_folder": None,
+            "store_folder": None,
+            "cache_size": None}
         self.defaultInitDict()
         self.kwargs = kwargs
         self.manageKwargs()
+        self.records = None
 
     def checklibname(self):
         if self.libraryname is None:
@@ -57,44 +65,40 @@ class RPKMs(object):
             setattr(self, key, value)
         return
 
-    def getHits(self):
-        ''' The hit for each glyma model is calculated by simple reading the alignment output and incrementing the number of successful alignments made by each model.'''
-        hitDict = defaultdict(lambda: 0)
-        with open(self.bowtiefile) as fh:
-            for line in fh:
-                try:
-                    model = line.strip().split('\t')[int(self.bowtie_model_column)]
-                    hitDict[model] += 1
-                except:
-                    print fh
-                    break
-        return hitDict
+    def getHits(self, digest=None):
+        ''' The hit for each glyma model is calculated by simple reading the alignment output and incrementing the number of successful alignments made by each model.
+        The alignment file is read in large chunks by the HitCounter, which only cuts out the model column.
+        digest - hashlib object the file is hashed into while it is read'''
+        counter = HitCounter(bowtie_model_column=self.bowtie_model_column)
+        return counter.count_file(self.bowtiefile, digest).hits()
 
     def getLengths(self):
         ''' The lengths of each sequence is necessary for calculating the RPKM value of each model and thus the file is read
-        for each sequence and recorded.'''
-        lengthDict = defaultdict(lambda: 0)
-        with open(self.glymafile) as fh:
-            for line in fh:
-                sp = line.strip().split('\t')
-                model = sp[0]
-                try:
-                    lengthDict[model] = len(sp[1])
-                except:
-                    raise "Cannot get lengths"
-        return lengthDict
+        for each sequence and recorded. The lengths are compiled once into a LengthIndex and memory mapped on every later run,
+        the index is shared with every RPKMs of the process (and the workers it forks, see publish).'''
+        return LengthIndex.shared_index(self.glymafile, self.index_folder)
 
     def getRPKMs(self, hitDict, lengthDict):
+        '''lengthDict is walked once in order (a LengthIndex is read in place, a lookup per model would search it)'''
         rpkmDict = defaultdict(lambda: 0)
         mappedReads = sum(hitDict.values())
         mappedReadsPerM = mappedReads / 1000000.0
-        for model in hitDict:
+        found = 0
+        for model, length in lengthDict.iteritems():
+            if model not in hitDict:
+                continue
+            found += 1
             try:
                 rpkmDict[model] = hitDict[model] / \
-                    (lengthDict[model] / 1000.0) / mappedReadsPerM
+                    (length / 1000.0) / mappedReadsPerM
             except:
                 print "can't create rpkm dict"
                 raise
+        if found != len(hitDict):
+            print "can't create rpkm dict"
+            missing = [model for model in hitDict if model not in rpkmDict][:5]
+            raise ValueError("models with hits but without a length in %s: %s" % (
+                self.glymafile, ", ".join(missing)))
         return rpkmDict
 
     def writeRPKMs(self, lengthDict, hitDict, rpkmDict):
@@ -102,7 +106,8 @@ class RPKMs(object):
         self.checklibname()
         if self.outputfile:
             PathCheck.check_folder(self.outputfile)
-        with open(self.outputfile, 'w') as fh:
+        # written under a temporary name, a crash never leaves a truncated ".rpkm" behind
+        with CacheHelper.atomic_open(self.outputfile, 'w') as fh:
             fh.write('\t'.join(["Model Name",
                                 self.libraryname + " rpkm ",
                                 self.libraryname + " hits " + "\n"]))
@@ -112,13 +117,74 @@ class RPKMs(object):
                 fh.write(os.linesep)
             print self.outputfile
         fh.close()
+        self.storeRPKMs(lengthDict, hitDict, rpkmDict)
+        return
+
+    def storeRPKMs(self, lengthDict, hitDict, rpkmDict):
+        '''appends the library as hit & rpkm columns to the expression store (if one is configured)'''
+        if not self.store_folder or self.store_folder == 'None':
+            return
+        models = list(lengthDict)
+        ExpressionStore(self.store_folder).append(
+            os.path.basename(self.outputfile),
+            models,
+            [hitDict[model] for model in models],
+            [rpkmDict[model] for model in models],
+            self.outputfile)
         return
 
-    def runRPKM(self):
-        hitDict = self.getHits()
+    def getCache(self):
+        '''the ResultCache in the index folder, None when "Cache Size" is 0 or blank'''
+        try:
+            size = float(self.cache_size) * 1024 ** 3
+        except (TypeError, ValueError):
+            return None
+        if size <= 0:
+            return None
+        return ResultCache(self.index_folder, size)
+
+    def runRPKM(self, hitDict=None):
+        '''hitDict may be given when the hits were already counted (e.g. streamed from bowtie)
+        otherwise the result of an earlier run on the same bowtie file, GlymaFile & model columns is reused
+        from the ResultCache and neither the hits nor the lengths are read again'''
+        cache, key, stat, digest = None, None, None, None
+        if hitDict is None:
+            cache = self.getCache()
+        if cache is not None:
+            key = cache.known_key(self.bowtiefile, self.glymafile,
+                                  self.bowtie_model_column, self.glyma_model_column)
+            cached = cache.get(key)
+            if cached is not None:
+                print "%s: reusing the cached result" % self.bowtiefile
+                models, hits, rpkms = cached
+                hitDict = dict(zip(models, hits))
+                # models without hits never had a float rpkm
+                rpkmDict = dict((m, r if h else 0) for m, h, r in zip(models, hits, rpkms))
+                self.records = sum(hits)
+                self.writeRPKMs(models, hitDict, rpkmDict)
+                return
+            if key is None:
+                # not hashed at its current size & mtime, hashed while it is counted instead of read twice
+                stat, digest = CacheHelper.file_stat(self.bowtiefile), hashlib.sha1()
+        if hitDict is None:
+            hitDict = self.getHits(digest)
+        # alignments counted, for the stage metrics
+        self.records = sum(hitDict.values())
         lengthDict = self.getLengths()
         rpkmDict = self.getRPKMs(hitDict, lengthDict)
         self.writeRPKMs(lengthDict, hitDict, rpkmDict)
+        if cache is not None:
+            if key is None:
+                key = cache.counted_key(stat, digest.hexdigest(), self.glymafile,
+                                        self.bowtie_model_column, self.glyma_model_column)
+            models = list(lengthDict)
+            cache.put(key, models, [hitDict[m] for m in models], [rpkmDict[m] for m in models])
+        return
+
+    def publish(self):
+        '''loads the length index in this process, workers forked afterwards read its pages instead of loading their own'''
+        if self.glymafile:
+            LengthIndex.shared_index(self.glymafile, self.index_folder)
         return
 
     def cmdRPKM(self):
@@ -131,9 +197,6 @@ class RPKMs(object):
         return
 
 
-RPKM = RPKMs()
-
-
 def main():
     RPKMs().cmdRPKM()
 
@@ -0,0 +1,191 @@
+import os
+import sys
+import json
+import fcntl
+import struct
+
+from array import array
+
+from . import CacheHelper
+from .ExpressionStore import HITS, RPKMS
+
+
+'''content addressed cache of RPKMs results
+
+    an entry holds the models, hits and rpkms computed for one alignment file and is keyed by the
+    content hashes of the bowtie file and the GlymaFile plus the two model column settings, so the
+    same alignment counted again (under any name) is read back instead of recounted.
+    Content hashes are remembered by (path, size, mtime) and only recomputed for a changed file; an
+    alignment file that is not hashed yet is hashed by the HitCounter while it is counted (see
+    known_key and counted_key), so a cache miss reads it once.
+
+    layout of the cache folder:
+        <key>.res       - header (magic, model count, names length), names, hits & rpkm arrays
+        hashes.json     - path -> [size, mtime, sha1] of the hashed input files
+        stats.json      - lookups, hits, stores & evictions since the cache was created
+    entries are evicted least recently used first (the mtime of an entry is its last use)
+    once the folder grows beyond max_size.
+    '''
+
+
+MAGIC = 'RNARES01'
+HEADER = struct.Struct('<8sIQ')
+MAX_SIZE = 10 * 1024 ** 3
+
+
+class ResultCache(object):
+
+    def __init__(self, folder=None, max_size=MAX_SIZE):
+        self.folder = CacheHelper.cache_folder('results', folder)
+        self.max_size = max_size or MAX_SIZE
+        self.hashfile = os.path.join(self.folder, 'hashes.json')
+        self.statsfile = os.path.join(self.folder, 'stats.json')
+
+    def _lock(self):
+        fh = open(os.path.join(self.folder, '.lock'), 'a')
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        return fh
+
+    def _unlock(self, fh):
+        fcntl.flock(fh, fcntl.LOCK_UN)
+        fh.close()
+
+    def _read_json(self, filename):
+        try:
+            with open(filename) as fh:
+                return json.load(fh)
+        except (IOError, ValueError):
+            return dict()
+
+    def _write_json(self, filename, data):
+        with CacheHelper.atomic_open(filename, 'w') as fh:
+            json.dump(data, fh, indent=1, sort_keys=True)
+
+    def _count(self, **counts):
+        lock = self._lock()
+        try:
+            stats = self._read_json(self.statsfile)
+            for name, n in counts.iteritems():
+                stats[name] = stats.get(name, 0) + n
+            self._write_json(self.statsfile, stats)
+        finally:
+            self._unlock(lock)
+
+    def file_hash(self, filename):
+        '''sha1 of a file, recomputed only when its size or mtime changed'''
+        return CacheHelper.memo_hash(filename, self.hashfile)
+
+    def key(self, bowtiefile, glymafile, bowtie_model_column, glyma_model_column):
+        return self._key(self.file_hash(bowtiefile), glymafile, bowtie_model_column, glyma_model_column)
+
+    def _key(self, bowtie_sha, glymafile, bowtie_model_column, glyma_model_column):
+        return CacheHelper.key_name(
+            MAGIC, bowtie_sha, self.file_hash(glymafile),
+            bowtie_model_column, glyma_model_column)
+
+    def known_key(self, bowtiefile, glymafile, bowtie_model_column, glyma_model_column):
+        '''the key of a bowtie file whose hash is remembered for its current size & mtime, None when the
+        file is to be hashed while it is counted (a .gz file is hashed here, it is counted decompressed)'''
+        if bowtiefile.endswith('.gz'):
+            return self.key(bowtiefile, glymafile, bowtie_model_column, glyma_model_column)
+        sha = CacheHelper.known_hash(bowtiefile, self.hashfile)
+        if sha is None:
+            return None
+        return self._key(sha, glymafile, bowtie_model_column, glyma_model_column)
+
+    def counted_key(self, stat, sha, glymafile, bowtie_model_column, glyma_model_column):
+        '''the key of a bowtie file hashed while it was counted, stat is its file_stat from before the count'''
+        CacheHelper.remember_hash(self.hashfile, stat, sha)
+        return self._key(sha, glymafile, bowtie_model_column, glyma_model_column)
+
+    def _entry(self, key):
+        return os.path.join(self.folder, key + '.res')
+
+    def get(self, key):
+        '''(models, hits, rpkms) stored under key or None (also for a None key)'''
+        if key is None:
+            self._count(lookups=1)
+            return None
+        entry = self._entry(key)
+        try:
+            with open(entry, 'rb') as fh:
+                magic, count, nameslen = HEADER.unpack(fh.read(HEADER.size))
+                if magic != MAGIC:
+                    raise ValueError(entry)
+                names = fh.read(nameslen)
+                hits = array(HITS)
+                rpkms = array(RPKMS)
+                hits.fromfile(fh, count)
+                rpkms.fromfile(fh, count)
+        except (IOError, EOFError, ValueError, struct.error):
+            self._count(lookups=1)
+            return None
+        # the mtime of an entry is its last use
+        os.utime(entry, None)
+        self._count(lookups=1, hits=1)
+        return names.split('\n') if count else [], hits, rpkms
+
+    def put(self, key, models, hits, rpkms):
+        names = '\n'.join(models)
+        with CacheHelper.atomic_open(self._entry(key)) as fh:
+            fh.write(HEADER.pack(MAGIC, len(models), len(names)))
+            fh.write(names)
+            array(HITS, hits).tofile(fh.fh)
+            array(RPKMS, rpkms).tofile(fh.fh)
+        self._count(stores=1, evictions=self.evict())
+        return
+
+    def entries(self):
+        '''[(last use, size, path)] of every entry, oldest first'''
+        entries = list()
+        for name in os.listdir(self.folder):
+            if name.endswith('.res'):
+                path = os.path.join(self.folder, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return sorted(entries)
+
+    def evict(self):
+        '''removes the least recently used entries until the cache fits into max_size, returns how many'''
+        entries = self.entries()
+        total = sum(size for mtime, size, path in entries)
+        evicted = 0
+        while entries and total > self.max_size:
+            mtime, size, path = entries.pop(0)
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            evicted += 1
+        return evicted
+
+    def stats(self):
+        stats = self._read_json(self.statsfile)
+        entries = self.entries()
+        stats.update({"folder": self.folder,
+                      "entries": len(entries),
+                      "size": sum(size for mtime, size, path in entries),
+                      "max_size": self.max_size})
+        return stats
+
+    def printStats(self):
+        stats = self.stats()
+        lookups = stats.get("lookups", 0)
+        print "result cache: %s" % stats["folder"]
+        print "entries: %s (%.1f of %.1f MB)" % (
+            stats["entries"], stats["size"] / 1024.0 ** 2, stats["max_size"] / 1024.0 ** 2)
+        print "lookups: %s, hits: %s (%.0f%%), stores: %s, evictions: %s" % (
+            lookups, stats.get("hits", 0), 100.0 * stats.get("hits", 0) / lookups if lookups else 0,
+            stats.get("stores", 0), stats.get("evictions", 0))
+        return
+
+
+def main():
+    ResultCache(sys.argv[1] if len(sys.argv) > 1 else None).printStats()
+
+if __name__ == '__main__':
+    main()
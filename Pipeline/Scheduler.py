@@ -0,0 +1,313 @@
+import os
+import sys
+import glob
+import threading
+import traceback
+import multiprocessing
+
+from datetime import datetime
+
+from . import Metrics
+
+
+'''schedules the per-library stages of the pipeline
+
+    BowtieScheduler - splits the host's cores & memory across concurrent bowtie jobs
+    DataflowScheduler - counts (RPKM) each library in a process pool as soon as its alignment is done,
+                        and runs the finish step (aggregation) once the last library has been counted.
+    '''
+
+
+JOB_OVERHEAD = 256 * 1024 * 1024
+MIN_THREADS = 2
+
+
+def host_cores():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def host_memory():
+    '''available memory in bytes (MemAvailable, falling back to free pages)'''
+    try:
+        with open('/proc/meminfo') as fh:
+            for line in fh:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def index_memory(reference):
+    '''bowtie loads the whole index into memory once per process'''
+    return sum(os.path.getsize(f) for f in glob.glob(str(reference) + '*.ebwt'))
+
+
+def _number(value, scale=1):
+    '''config values are stored as strings, blank means "no limit"'''
+    try:
+        return int(float(value) * scale)
+    except (TypeError, ValueError):
+        return None
+
+
+def run_count(lib, rpkm, run=None):
+    '''process pool entry point, returns (lib, traceback or None)
+    run - id of the Metrics run the count is recorded in (by the worker itself), the peak RSS it
+          records is the worker's peak so far: earlier libraries it counted & the memory it shares
+          with the process it was forked from included'''
+    measure = Metrics.Measure()
+    error = None
+    try:
+        rpkm.runRPKM()
+    except Exception:
+        error = traceback.format_exc()
+    if run is not None:
+        wall, cpu, rss = measure.stop()
+        Metrics.StageMetrics(run=run).record(
+            lib, "count", wall, cpu, Metrics.file_size(rpkm.bowtiefile), getattr(rpkm, 'records', None), rss,
+            ok=error is None)
+    return lib, error
+
+
+def run_count_job(job):
+    '''run_count for pool.imap, job is a (lib, rpkm) or (lib, rpkm, run) tuple'''
+    return run_count(*job)
+
+
+class BowtieScheduler(object):
+    '''runs bowtie jobs concurrently within a core & memory budget
+
+    max_cores/max_memory - caps on the host's cores and available memory (bytes)
+    max_threads - upper bound of threads for a single job (the "-p" option)
+
+    Jobs are started largest input first. Threads for a job are its share (by input size) of the
+    free cores among the jobs that can start right now, so once the queue drains the last jobs
+    are launched with the cores the finished jobs gave back.'''
+
+    def __init__(self, max_cores=None, max_memory=None, max_threads=None, min_threads=MIN_THREADS):
+        self.cores = host_cores()
+        if max_cores:
+            self.cores = max(1, min(self.cores, max_cores))
+        self.memory = host_memory()
+        if max_memory:
+            self.memory = min(self.memory or max_memory, max_memory)
+        self.max_threads = max_threads or self.cores
+        self.min_threads = min(min_threads, self.cores)
+        self.lock = threading.Condition()
+        self.thread = None
+
+    def _job_size(self, bowtie):
+        try:
+            return os.path.getsize(bowtie.query)
+        except (OSError, TypeError):
+            return 0
+
+    def _job_memory(self, bowtie):
+        '''every bowtie process (a sharded job runs several) loads its own copy of the index'''
+        return (index_memory(bowtie.reference) + JOB_OVERHEAD) * getattr(bowtie, 'shards', 1)
+
+    def start(self, jobs, callback=None, run=None):
+        '''starts dispatching in the background
+            jobs - dict of library -> Bowtie
+            callback(lib, error) - called after each job, error is a traceback or None
+            run(lib, bowtie) - what to run for a job, defaults to bowtie.runBowtie()'''
+        self.queue = sorted(jobs.items(), key=lambda job: self._job_size(job[1]), reverse=True)
+        self.callback = callback
+        self.run_job = run or (lambda lib, bowtie: bowtie.runBowtie())
+        self.free_cores = self.cores
+        self.free_memory = self.memory
+        self.running = 0
+        self.thread = threading.Thread(target=self._dispatch)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def join(self):
+        while self.thread.is_alive():
+            self.thread.join(1)
+
+    def run(self, jobs, callback=None, run=None):
+        self.start(jobs, callback, run)
+        self.join()
+
+    def _can_launch(self, memory):
+        if not self.queue:
+            return False
+        if self.running == 0:
+            return True
+        if self.free_cores < self.min_threads:
+            return False
+        return self.free_memory is None or self.free_memory >= memory
+
+    def _threads_for(self, bowtie):
+        '''share of the free cores by input size among the jobs that fit right now'''
+        fits = max(1, min(len(self.queue) + 1, self.free_cores // self.min_threads))
+        sizes = [self._job_size(bowtie)] + [self._job_size(b) for lib, b in self.queue[:fits - 1]]
+        total = float(sum(sizes))
+        if total:
+            threads = int(round(self.free_cores * sizes[0] / total))
+        else:
+            threads = self.free_cores // fits
+        return max(1, min(max(threads, self.min_threads), self.free_cores, self.max_threads))
+
+    def _dispatch(self):
+        with self.lock:
+            while self.queue or self.running:
+                while self.queue and self._can_launch(self._job_memory(self.queue[0][1])):
+                    lib, bowtie = self.queue.pop(0)
+                    memory = self._job_memory(bowtie)
+                    bowtie.threads = self._threads_for(bowtie)
+                    self.free_cores -= bowtie.threads
+                    if self.free_memory is not None:
+                        self.free_memory -= memory
+                    self.running += 1
+                    print "%s: bowtie with %s threads (%s cores free)" % (lib, bowtie.threads, self.free_cores)
+                    worker = threading.Thread(target=self._run, args=(lib, bowtie, memory))
+                    worker.daemon = True
+                    worker.start()
+                self.lock.wait(1)
+
+    def _run(self, lib, bowtie, memory):
+        error = None
+        try:
+            self.run_job(lib, bowtie)
+        except Exception:
+            error = traceback.format_exc()
+        with self.lock:
+            self.free_cores += bowtie.threads
+            if self.free_memory is not None:
+                self.free_memory += memory
+            self.running -= 1
+            self.lock.notify_all()
+        if self.callback is not None:
+            self.callback(lib, error)
+
+
+class DataflowScheduler(object):
+    '''starts each library's count job as soon as its alignment finishes
+
+    align_jobs - dict of library -> Bowtie, run through the BowtieScheduler
+    count_jobs - dict of library -> picklable object with a runRPKM() method
+    aligned - libraries whose alignment is already done, they are counted right away
+    ledger - optional Ledger.StageLedger the align & count stages are recorded in
+    metrics - optional Metrics.StageMetrics the align & count timings are recorded in'''
+
+    def __init__(self, aligner=None, count_processes=None, ledger=None, metrics=None):
+        self.aligner = aligner or BowtieScheduler()
+        self.count_processes = count_processes or host_cores()
+        self.ledger = ledger
+        self.metrics = metrics
+        self.failed = dict()
+        self.completed = list()
+
+    def run(self, align_jobs, count_jobs, finish=None, aligned=()):
+        startTime = datetime.now()
+        # the workers inherit the length indexes loaded here (see RPKMs.publish)
+        for rpkm in count_jobs.values():
+            rpkm.publish()
+        # the process pool forks, so it is created before any threads are started
+        self.countPool = multiprocessing.Pool(processes=self.count_processes)
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.remaining = set(align_jobs) | set(aligned)
+        self.pending = dict()
+        if not self.remaining:
+            self.done.set()
+        self.count_jobs = count_jobs
+        for lib in aligned:
+            self._aligned(lib, None)
+        self.aligner.start(align_jobs, callback=self._aligned, run=self._align)
+        # wait() with a timeout keeps the main thread responsive to KeyboardInterrupt
+        while not self.done.wait(1):
+            self._reap()
+        self.aligner.join()
+        self.countPool.close()
+        self.countPool.join()
+        for lib, error in sorted(self.failed.iteritems()):
+            print "%s failed:" % lib
+            print error
+        print "aligned & counted %s libraries in %s" % (len(self.completed), datetime.now() - startTime)
+        if finish is not None:
+            finish()
+        return self.completed
+
+    def _align(self, lib, bowtie):
+        if self.ledger is not None:
+            self.ledger.start(lib, "align", [bowtie.query])
+        try:
+            bowtie.runBowtie()
+        except Exception:
+            if self.metrics is not None:
+                self.metrics.record_bowtie(lib, bowtie, ok=False)
+            raise
+        if self.metrics is not None:
+            self.metrics.record_bowtie(lib, bowtie)
+        if self.ledger is not None:
+            self.ledger.finish(lib, "align", [bowtie.output])
+
+    def _aligned(self, lib, error):
+        if error is not None:
+            if self.ledger is not None:
+                self.ledger.fail(lib, "align", error)
+            self._finished((lib, "alignment: " + error))
+            return
+        print "%s aligned, counting" % lib
+        rpkm = self.count_jobs[lib]
+        if self.ledger is not None:
+            self.ledger.start(lib, "count", [rpkm.bowtiefile, rpkm.glymafile])
+        with self.lock:
+            self.pending[lib] = self.countPool.apply_async(
+                run_count, (lib, rpkm, self.metrics.run if self.metrics is not None else None),
+                callback=self._counted)
+
+    def _reap(self):
+        '''count jobs that could not even be dispatched (e.g. unpicklable) never reach their callback'''
+        with self.lock:
+            pending = self.pending.items()
+        for lib, result in pending:
+            if result.ready() and not result.successful():
+                try:
+                    result.get()
+                except Exception:
+                    self._counted((lib, traceback.format_exc()))
+
+    def _counted(self, result):
+        lib, error = result
+        if self.ledger is not None:
+            if error is None:
+                self.ledger.finish(lib, "count", [self.count_jobs[lib].outputfile])
+            else:
+                self.ledger.fail(lib, "count", error)
+        self._finished(result)
+
+    def _finished(self, result):
+        lib, error = result
+        with self.lock:
+            self.pending.pop(lib, None)
+            if error is None:
+                self.completed.append(lib)
+            else:
+                self.failed[lib] = error
+            self.remaining.discard(lib)
+            if not self.remaining:
+                self.done.set()
+
+
+def count_processes(config):
+    '''processes for counting, "Max Cores" or every core'''
+    return _number(config["Max Cores"]) or host_cores()
+
+
+def from_config(config):
+    '''BowtieScheduler limited by the "Max Cores", "Max Memory" (GB) and "-p" options'''
+    return BowtieScheduler(
+        max_cores=_number(config["Max Cores"]),
+        max_memory=_number(config["Max Memory"], 1024 ** 3),
+        max_threads=_number(config["-p"]))
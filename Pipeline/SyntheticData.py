@@ -0,0 +1,122 @@
+import os
+import sys
+import json
+import random
+import argparse
+
+from .AnnotationIndex import ANNOTATION_FILES, PHYTO_COLUMNS
+
+
+'''synthetic inputs for the whole pipeline at any scale (see Benchmark)
+
+    generate() writes into one folder:
+        reference.fa        - FASTA of every model (the "Reference Path", indexed by bowtie-build)
+        glyma.tsv           - model <tab> sequence (the "GlymaFile")
+        annotation/         - the annotation files & cds/cDNA length files (the "Annotation Path")
+        raw/                - R01_Synthetic1_W01_L001.fq ... one FASTQ per library (the "Raw Path")
+        synthetic.json      - the parameters the folder was generated with
+    reads are substrings of the model sequences, models are drawn with a skew so that a few models
+    get most of the reads. The same parameters (and seed) always generate the same files.
+    '''
+
+
+LINE_WIDTH = 60
+POOL_SIZE = 1024 * 1024
+
+
+def model_names(models):
+    return ['Glyma%02dg%05d.%d' % (i % 20 + 1, i // 2, i % 2 + 1) for i in xrange(models)]
+
+
+def _write_rows(filename, header, rows):
+    folder = os.path.dirname(filename)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    with open(filename, 'w') as fh:
+        fh.write(header + '\n')
+        for row in rows:
+            fh.write('\t'.join(row) + '\n')
+
+
+def write_annotations(folder, names, rand):
+    '''annotation files in the layout of AnnotationIndex.ANNOTATION_FILES plus the two length files'''
+    for group, filename in sorted(ANNOTATION_FILES.items()):
+        if group == "phyto":
+            continue
+        rows = list()
+        for name in names:
+            for i in xrange(rand.choice([0, 0, 1, 1, 1, 2, 3])):
+                rows.append([name, "%s %s annotation %s of %s" % (group, rand.randint(1, 99999), i + 1, name)])
+        _write_rows(os.path.join(folder, filename), "Model\tAnnotation", rows)
+    rows = list()
+    for name in names[::2]:
+        rows.append([name] + [rand.choice(['', 'PTHR%05d' % rand.randint(0, 99999)]) for i in xrange(PHYTO_COLUMNS)])
+    _write_rows(os.path.join(folder, ANNOTATION_FILES["phyto"]), "Model\t" + "\t".join(
+        ["Column%s" % (i + 1) for i in xrange(PHYTO_COLUMNS)]), rows)
+    return
+
+
+def generate(folder, libraries=4, reads=100000, models=2000, read_length=36, seed=1):
+    '''writes the synthetic inputs into folder, returns its parameters (unchanged files are not rewritten)'''
+    params = {"libraries": libraries, "reads": reads, "models": models,
+              "read_length": read_length, "seed": seed}
+    marker = os.path.join(folder, 'synthetic.json')
+    try:
+        with open(marker) as fh:
+            if json.load(fh) == params:
+                return params
+    except (IOError, ValueError):
+        pass
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    rand = random.Random(seed)
+    # models are slices of one random pool, generating every base on its own would dominate the run
+    pool = ''.join(rand.choice('ACGT') for i in xrange(POOL_SIZE))
+    names = model_names(models)
+    sequences = list()
+    for name in names:
+        length = rand.randint(max(read_length, 300), 3000)
+        start = rand.randint(0, POOL_SIZE - length)
+        sequences.append(pool[start:start + length])
+    with open(os.path.join(folder, 'reference.fa'), 'w') as fa:
+        with open(os.path.join(folder, 'glyma.tsv'), 'w') as glyma:
+            for name, seq in zip(names, sequences):
+                fa.write('>%s\n' % name)
+                for i in xrange(0, len(seq), LINE_WIDTH):
+                    fa.write(seq[i:i + LINE_WIDTH] + '\n')
+                glyma.write('%s\t%s\n' % (name, seq))
+    annotation = os.path.join(folder, 'annotation')
+    write_annotations(annotation, names, rand)
+    _write_rows(os.path.join(annotation, 'cds_Length.tsv'), "Model\tLength",
+                [[name, str(int(len(seq) * 0.7))] for name, seq in zip(names, sequences)])
+    _write_rows(os.path.join(annotation, 'cDNA_Length.tsv'), "Model\tLength",
+                [[name, str(len(seq))] for name, seq in zip(names, sequences)])
+    raw = os.path.join(folder, 'raw')
+    if not os.path.isdir(raw):
+        os.makedirs(raw)
+    quals = 'I' * read_length
+    for lib in xrange(1, libraries + 1):
+        filename = os.path.join(raw, 'R%s_Synthetic%s_W%s_L001.fq' % (str(lib).zfill(2), lib, str(lib).zfill(2)))
+        with open(filename, 'w') as fh:
+            for i in xrange(reads):
+                seq = sequences[int(models * rand.random() ** 2)]
+                start = rand.randint(0, len(seq) - read_length)
+                fh.write('@SYN%s:%s\n%s\n+\n%s\n' % (lib, i, seq[start:start + read_length], quals))
+    with open(marker, 'w') as fh:
+        json.dump(params, fh, indent=1, sort_keys=True)
+    return params
+
+
+def main():
+    parser = argparse.ArgumentParser(description="writes synthetic pipeline inputs")
+    parser.add_argument('folder')
+    parser.add_argument('-libraries', type=int, default=4)
+    parser.add_argument('-reads', type=int, default=100000, help="reads per library")
+    parser.add_argument('-models', type=int, default=2000)
+    parser.add_argument('-length', type=int, default=36, help="read length")
+    parser.add_argument('-seed', type=int, default=1)
+    p = parser.parse_args()
+    print generate(p.folder, p.libraries, p.reads, p.models, p.length, p.seed)
+
+if __name__ == '__main__':
+    main()
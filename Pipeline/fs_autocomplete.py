@@ -1,4 +1,3 @@
-import readline
 import os
 import re
 
@@ -45,6 +44,7 @@ class Completer(object):
 
     def complete(self, text, state):
         "Generic readline completion entry point."
+        import readline
         buffer = readline.get_line_buffer()
         line = readline.get_line_buffer().split()
         # show all commands
@@ -57,20 +57,35 @@ class Completer(object):
         cmd = line[0].strip()
         return self._complete_path(cmd)[state]
 
-comp = Completer()
-# we want to treat '/' as part of a word, so override the delimiters
-readline.set_completer_delims(' \t\n;')
-readline.parse_and_bind("tab: complete")
-readline.set_completer(comp.complete)
+comp = None
+
+
+def install():
+    '''binds the path completer to readline, done by the first prompt (importing readline
+    is left to the processes that prompt, workers & batch jobs never touch the terminal)'''
+    global comp
+    if comp is not None:
+        return comp
+    comp = Completer()
+    try:
+        import readline
+    except ImportError:
+        return comp
+    # we want to treat '/' as part of a word, so override the delimiters
+    readline.set_completer_delims(' \t\n;')
+    readline.parse_and_bind("tab: complete")
+    readline.set_completer(comp.complete)
+    return comp
 
 
 def get_input(prompt=''):
+    install()
     i = raw_input(prompt)
     return i
 
 
 def main():
-    a = raw_input('Enter section name: ')
+    a = get_input('Enter section name: ')
     print a
 
 if __name__ == '__main__':
@@ -2,38 +2,63 @@ import os
 import sys
 
 
+BUFFER_SIZE = 4 * 1024 * 1024
+EXCEL_ROWS = 1048576
+EXCEL_COLUMNS = 16384
+# joins the columns a row has beyond the header into its last column of an Excel shard
+OVERFLOW = '; '
+
+
 class Splitter(object):
     '''Once aggregate files became too cumbersome, it became necessary to split the output using varied split points
-    receives a tsv argument and library # to determine at which point the file should be divided'''
+    receives a tsv argument and library # to determine at which point the file should be divided
+
+    cutpoints - libraries that start a new file, e.g. [50, 100] writes R01-R49, R50-R99 and R100-Rnn
+                (defaults to [cutofflibrary], or nfiles even parts when nfiles is not 2)
+    every file repeats the leading (model, length) and the trailing (annotation) columns, all files
+    are written in a single pass over the entry file'''
 
     def __init__(
             self,
             entryfile=None,
             cutofflibrary=100,
             nfiles=2,
+            cutpoints=None,
             *args,
             **kwargs):
         self.entryfile = entryfile
         self.cutofflibrary = cutofflibrary
         self.nfiles = nfiles
+        self.cutpoints = cutpoints
         self.split_list = list()
-        self.leftend, self.splitpoint, self.rightstart = self._get_header_ranges(
-        )
+        with open(self.entryfile) as fh:
+            self.header = fh.readline().rstrip('\n').split('\t')
+        self.leftend, self.rightstart, self.ranges = self._get_header_ranges()
+        self.nfiles = len(self.ranges)
         self._get_new_files()
         self._write_files()
 
     def _write_files(self):
-        with open(self.entryfile) as fh:
-            with open(self.split_list[0], 'w') as fw1:
-                with open(self.split_list[1], 'w') as fw2:
-                    for line in fh:
-                        sp = line.strip().split('\t')
-                        fw1.write(
-                            '\t'.join(sp[:self.splitpoint] + sp[self.rightstart:] + ["\n"]))
-                        fw2.write(
-                            '\t'.join(sp[:self.leftend - 1] + sp[self.splitpoint:] + ["\n"]))
+        '''streams the entry file once, every line is cut into all files'''
+        outputs = [open(f, 'w', BUFFER_SIZE) for f in self.split_list]
+        try:
+            with open(self.entryfile, 'r', BUFFER_SIZE) as fh:
+                for line in fh:
+                    for fw, text in zip(outputs, self._cut(line)):
+                        fw.write(text)
+        finally:
+            for fw in outputs:
+                fw.close()
         return
 
+    def _cut(self, line):
+        '''the part of a line that goes into each file'''
+        sp = line.rstrip('\n').split('\t')
+        # leading & trailing columns are joined once per line and shared by every file
+        left = '\t'.join(sp[:self.leftend]) + '\t' if self.leftend else ''
+        right = '\t' + '\t'.join(sp[self.rightstart:]) + '\n' if self.rightstart < len(sp) else '\n'
+        return [left + '\t'.join(sp[start:end]) + right for start, end in self.ranges]
+
     def _get_new_files(self):
         i = 1
         while i <= self.nfiles:
@@ -46,35 +71,175 @@ class Splitter(object):
     def _get_list(self):
         return self.split_list
 
+    def _library_columns(self):
+        libraries = [i for i, key in enumerate(self.header) if self._is_library(key)]
+        if not libraries:
+            raise ValueError("no library columns in %s" % self.entryfile)
+        return libraries
+
     def _get_header_ranges(self):
-        leftend, splitpoint, rightstart = 1, 0, 0
-        with open(self.entryfile) as fh:
-            past_libraries = False
-            headers = fh.readline().split('\t')
-            for key in headers:
-                rightstart += 1
-                if "R%s" % self.cutofflibrary in key:
-                    splitpoint = headers.index(key)
-
-                if self._is_library(key):
-                    past_libraries = True
-                    continue
-                else:
-                    if past_libraries:
-                        return leftend, splitpoint, rightstart
-                    else:
-                        leftend += 1
+        '''(end of the leading columns, start of the trailing columns, [(start, end) of each file's libraries])'''
+        libraries = self._library_columns()
+        leftend, rightstart = libraries[0], libraries[-1] + 1
+        if self.cutpoints is None and self.nfiles != 2:
+            # nfiles even parts
+            size = -(-len(libraries) // max(1, self.nfiles))
+            starts = range(leftend, rightstart, size)
+        else:
+            starts = [leftend]
+            for cut in sorted(self.cutpoints or [self.cutofflibrary]):
+                start = next((i for i in libraries if self._library_number(self.header[i]) >= int(cut)),
+                             rightstart)
+                if starts[-1] < start < rightstart:
+                    starts.append(start)
+        ranges = zip(starts, starts[1:] + [rightstart])
+        return leftend, rightstart, ranges
+
+    def _library_number(self, header):
+        return int(header.split('_')[0][1:])
 
     def _is_library(self, header):
         '''checks if provided header is a library'''
         id = header.split('_')
         if len(id) < 2:
             return False
-        elif id[0][0] != 'R':
+        elif id[0][:1] != 'R':
             return False
         else:
             try:
-                id_num = int(id[0][1])
+                id_num = int(id[0][1:])
                 return True
             except:
                 return False
+
+
+class ExcelSplitter(Splitter):
+    '''shards an aggregate file so that every shard can be opened in excel
+
+    the library columns are divided into as few column shards as keep every shard (with the repeated
+    leading & trailing columns) within max_columns, and the rows into row shards of at most max_rows
+    (header included). A model's transcript rows are never split over two row shards.
+    Rows are cut to the header's width, so the header sets the column budget: the columns a row has
+    beyond the header (annotation text may hold tabs of its own) are joined with OVERFLOW into its
+    last trailing column, or dropped when the header has no trailing columns.
+    Shards are named <file>.<row shard>-<column shard>.tsv and listed in <file>.shards.tsv
+    with the models and libraries each one holds. Everything is written in one pass.'''
+
+    def __init__(
+            self,
+            entryfile=None,
+            max_rows=EXCEL_ROWS,
+            max_columns=EXCEL_COLUMNS,
+            *args,
+            **kwargs):
+        self.max_rows = max_rows
+        self.max_columns = max_columns
+        self.shards = list()
+        super(ExcelSplitter, self).__init__(entryfile, *args, **kwargs)
+
+    def _get_header_ranges(self):
+        libraries = self._library_columns()
+        leftend, rightstart = libraries[0], libraries[-1] + 1
+        per_file = self.max_columns - (len(self.header) - len(libraries))
+        if per_file < 1:
+            raise ValueError("%s: %s columns besides the libraries, more than the %s column limit" %
+                             (self.entryfile, len(self.header) - len(libraries), self.max_columns))
+        starts = range(leftend, rightstart, per_file)
+        return leftend, rightstart, zip(starts, starts[1:] + [rightstart])
+
+    def _cut(self, line):
+        '''the part of a line that goes into each shard, the line cut to the header's width first'''
+        width = len(self.header)
+        if line.count('\t') >= width:
+            sp = line.rstrip('\n').split('\t')
+            if self.rightstart < width:
+                sp[width - 1:] = [OVERFLOW.join(sp[width - 1:])]
+            line = '\t'.join(sp[:width]) + '\n'
+        return super(ExcelSplitter, self)._cut(line)
+
+    def _get_new_files(self):
+        '''row shards are opened as the rows arrive'''
+        fp = self.entryfile.rpartition('.')
+        self.indexfile = "%s.shards.%s" % (fp[0], fp[2])
+        return
+
+    def _shard_name(self, row, column):
+        fp = self.entryfile.rpartition('.')
+        return "%s.%s-%s.%s" % (fp[0], row, column, fp[2])
+
+    def _next_shard(self):
+        self._close_shard()
+        row = len(self.shards) / len(self.ranges) + 1
+        self.outputs = list()
+        for column in range(1, len(self.ranges) + 1):
+            name = self._shard_name(row, column)
+            self.split_list.append(name)
+            self.outputs.append(open(name, 'w', BUFFER_SIZE))
+            self.shards.append([name, 0, 0, None, None, column - 1])
+        for fw, text in zip(self.outputs, self.header_text):
+            fw.write(text)
+        self.rows = 0
+        return
+
+    def _close_shard(self):
+        for fw in getattr(self, 'outputs', []):
+            fw.close()
+        self.outputs = list()
+
+    def _write_model(self, lines):
+        limit = self.max_rows - 1
+        if not self.outputs or (self.rows and self.rows + len(lines) > limit):
+            self._next_shard()
+        model = lines[0].partition('\t')[0]
+        for line in lines:
+            if self.rows >= limit:
+                # a single model with more rows than a shard holds
+                self._tally(model)
+                self._next_shard()
+            for fw, text in zip(self.outputs, self._cut(line)):
+                fw.write(text)
+            self.rows += 1
+        self._tally(model)
+        return
+
+    def _tally(self, model):
+        '''records the rows & models written into the current row shard'''
+        for shard in self.shards[-len(self.ranges):]:
+            shard[1] = self.rows
+            if shard[4] != model:
+                shard[2] += 1
+                shard[3] = shard[3] or model
+                shard[4] = model
+        return
+
+    def _write_files(self):
+        self.outputs = list()
+        try:
+            with open(self.entryfile, 'r', BUFFER_SIZE) as fh:
+                self.header_text = self._cut(fh.readline())
+                lines = list()
+                lmodel = None
+                for line in fh:
+                    model = line.partition('\t')[0]
+                    if model != lmodel and lines:
+                        self._write_model(lines)
+                        lines = list()
+                    lmodel = model
+                    lines.append(line)
+                if lines:
+                    self._write_model(lines)
+                elif not self.shards:
+                    self._next_shard()
+        finally:
+            self._close_shard()
+        self._write_index()
+        return
+
+    def _write_index(self):
+        with open(self.indexfile, 'w') as fh:
+            fh.write('\t'.join(["Shard", "Rows", "Models", "First Model", "Last Model", "Libraries"]) + '\n')
+            for name, rows, models, first, last, column in self.shards:
+                start, end = self.ranges[column]
+                fh.write('\t'.join([os.path.basename(name), str(rows), str(models), first or '', last or '',
+                                     ','.join(self.header[start:end])]) + '\n')
+        return
@@ -0,0 +1,108 @@
+import os
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+from Pipeline.Catalog import LibraryCatalog, folder_files
+from Pipeline.Ledger import StageLedger
+
+
+'''LibraryCatalog: rows refreshed from the raw, bowtie & rpkm folders and the filters on them'''
+
+
+class LibraryCatalogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='rnaseq-test-')
+        self.dbfile = os.path.join(self.folder, 'catalog.sqlite')
+        self.cache = os.path.join(self.folder, 'cache')
+        self.raw, self.bowtie, self.rpkm = [os.path.join(self.folder, kind) for kind in ("raw", "bowtie", "rpkm")]
+        for folder in (self.raw, self.bowtie, self.rpkm):
+            os.mkdir(folder)
+        self.write(self.raw, "R01_a.fq", mtime=1000000000)
+        self.write(self.raw, "R02_b.fq", mtime=1000000000)
+        self.write(self.raw, "R03_c.fq", mtime=1000000000)
+        self.write(self.bowtie, "R01_a.fq.albwt")
+        self.write(self.bowtie, "R02_b.fq.albwt", mtime=900000000)
+        self.write(self.rpkm, "R01_a.fq.rpkm")
+        self.catalog = LibraryCatalog(self.dbfile, self.cache)
+        self.refresh()
+
+    def tearDown(self):
+        self.catalog.close()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def write(self, folder, name, text="", mtime=None):
+        path = os.path.join(folder, name)
+        with open(path, 'w') as fh:
+            fh.write(text or name)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+        return path
+
+    def refresh(self):
+        self.catalog.refresh(self.raw, self.bowtie, self.rpkm)
+
+    def test_refresh(self):
+        self.assertEqual(self.catalog.libraries("raw"), ["R01", "R02", "R03"])
+        self.assertEqual(self.catalog.files("rpkm"), [("R01", os.path.join(self.rpkm, "R01_a.fq.rpkm"))])
+        row = self.catalog.get("R02")
+        self.assertEqual((row["bowtie_size"], row["bowtie_mtime"]), (len("R02_b.fq.albwt"), 900000000))
+        self.assertEqual([row["stage"] for row in self.catalog.rows()], ["counted", "aligned", "raw"])
+
+    def test_missing(self):
+        self.assertEqual(self.catalog.missing(), ["R02", "R03"])
+        self.write(self.rpkm, "R02_b.fq.rpkm")
+        self.refresh()
+        self.assertEqual(self.catalog.missing(), ["R03"])
+        os.remove(os.path.join(self.rpkm, "R01_a.fq.rpkm"))
+        self.refresh()
+        self.assertEqual(self.catalog.missing(), ["R01", "R03"])
+        self.assertEqual(self.catalog.get("R01")["stage"], "aligned")
+
+    def test_realign(self):
+        '''R02's alignment is older than its reads, R03 has none'''
+        self.assertEqual(self.catalog.realign(), ["R02", "R03"])
+        self.write(self.bowtie, "R02_b.fq.albwt")
+        self.refresh()
+        self.assertEqual(self.catalog.realign(), ["R03"])
+        ledger = StageLedger(self.dbfile)
+        try:
+            ledger.start("R02", "align", [os.path.join(self.raw, "R02_b.fq")])
+            ledger.fail("R02", "align", "Traceback")
+        finally:
+            ledger.close()
+        self.refresh()
+        self.assertEqual(self.catalog.get("R02")["stage"], "align failed")
+        self.assertEqual(self.catalog.realign(), ["R02", "R03"])
+
+    def test_partial_refresh(self):
+        '''a refresh of one folder leaves the other kinds as they are'''
+        self.write(self.rpkm, "R03_c.fq.rpkm")
+        os.remove(os.path.join(self.raw, "R01_a.fq"))
+        self.catalog.refresh(rpkm_folder=self.rpkm)
+        self.assertEqual(self.catalog.libraries("raw"), ["R01", "R02", "R03"])
+        self.assertEqual(self.catalog.libraries("rpkm"), ["R01", "R03"])
+
+    def test_checksum(self):
+        path = os.path.join(self.rpkm, "R01_a.fq.rpkm")
+        self.assertEqual(self.catalog.checksum("R01", "rpkm"), hashlib.sha1("R01_a.fq.rpkm").hexdigest())
+        self.write(self.rpkm, "R01_a.fq.rpkm", "other counts", mtime=os.stat(path).st_mtime + 5)
+        self.refresh()
+        self.assertEqual(self.catalog.get("R01")["rpkm_sha1"], None)
+        self.assertEqual(self.catalog.checksum("R01", "rpkm"), hashlib.sha1("other counts").hexdigest())
+        self.assertEqual(self.catalog.checksum("R03", "rpkm"), None)
+
+    def test_folder_files(self):
+        '''the files of another folder are listed without touching the catalog'''
+        other = os.path.join(self.folder, "other")
+        os.mkdir(other)
+        self.write(other, "R05_e.fq.rpkm")
+        self.assertEqual(folder_files("rpkm", other, self.cache), {"R05": os.path.join(other, "R05_e.fq.rpkm")})
+        self.assertEqual(self.catalog.get("R05"), None)
+        self.assertEqual(folder_files("rpkm", os.path.join(self.folder, "none")), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from Pipeline.Ledger import StageLedger, RUNNING, FAILED
+from Pipeline.Pipeline2 import Pipeline
+
+
+'''StageLedger: when a stage counts as done for a rerun (see also test_pipeline.test_resume)'''
+
+
+class LedgerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='rnaseq-test-')
+        self.ledger = StageLedger(os.path.join(self.folder, 'ledger.sqlite'))
+        self.raw = self.write('R01_raw.fq', 'reads')
+        self.albwt = self.write('R01_raw.fq.albwt', 'alignments')
+
+    def tearDown(self):
+        self.ledger.close()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def write(self, name, text, mtime=1000000000):
+        path = os.path.join(self.folder, name)
+        with open(path, 'w') as fh:
+            fh.write(text)
+        os.utime(path, (mtime, mtime))
+        return path
+
+
+class StageLedgerTest(LedgerTest):
+
+    def test_done(self):
+        self.ledger.start("R01", "align", [self.raw])
+        self.assertEqual(self.ledger.get("R01", "align")["state"], RUNNING)
+        self.assertFalse(self.ledger.is_done("R01", "align", [self.raw]))
+        self.ledger.finish("R01", "align", [self.albwt])
+        self.assertTrue(self.ledger.is_done("R01", "align", [self.raw]))
+        self.assertEqual(self.ledger.outputs("R01", "align"), [self.albwt])
+        self.assertFalse(self.ledger.is_done("R02", "align"))
+
+    def test_changed_input(self):
+        self.ledger.record("R01", "align", [self.raw], [self.albwt])
+        self.write('R01_raw.fq', 'other reads')
+        self.assertFalse(self.ledger.is_done("R01", "align", [self.raw]))
+        # without inputs only the outputs are checked
+        self.assertTrue(self.ledger.is_done("R01", "align"))
+
+    def test_changed_output(self):
+        self.ledger.record("R01", "align", [self.raw], [self.albwt])
+        self.write('R01_raw.fq.albwt', 'alignments', mtime=1000000001)
+        self.assertFalse(self.ledger.is_done("R01", "align", [self.raw]))
+
+    def test_missing_output(self):
+        self.ledger.record("R01", "align", [self.raw], [self.albwt])
+        os.remove(self.albwt)
+        self.assertFalse(self.ledger.is_done("R01", "align", [self.raw]))
+
+    def test_failed(self):
+        self.ledger.start("R01", "count", [self.albwt])
+        self.ledger.fail("R01", "count", "Traceback")
+        row = self.ledger.get("R01", "count")
+        self.assertEqual((row["state"], row["error"]), (FAILED, "Traceback"))
+        self.assertFalse(self.ledger.is_done("R01", "count"))
+
+    def test_reopened(self):
+        '''a later run reads the rows an earlier one left'''
+        self.ledger.record("R01", "align", [self.raw], [self.albwt])
+        other = StageLedger(self.ledger.dbfile)
+        try:
+            self.assertTrue(other.is_done("R01", "align", [self.raw]))
+        finally:
+            other.close()
+
+
+class Job(object):
+
+    def __init__(self, **attrs):
+        self.__dict__.update(attrs)
+
+
+class ResumeStateTest(LedgerTest):
+    '''Pipeline.resumeState: an rpkm file is only kept while the inputs its count recorded are unchanged'''
+
+    def setUp(self):
+        LedgerTest.setUp(self)
+        self.glyma = self.write('glyma.tsv', 'lengths')
+        self.rpkmfile = self.write('R01_raw.fq.rpkm', 'rpkms')
+        self.bowtie = Job(query=self.raw, output=self.albwt)
+        self.rpkm = Job(bowtiefile=self.albwt, glymafile=self.glyma, outputfile=self.rpkmfile)
+        self.ledger.record("R01", "align", [self.raw], [self.albwt])
+
+    def state(self, inputs):
+        return Pipeline.resumeState.im_func(Job(ledger=self.ledger), "R01", self.bowtie, self.rpkm, inputs)
+
+    def test_counted(self):
+        self.ledger.record("R01", "count", [self.albwt, self.glyma], [self.rpkmfile])
+        self.assertEqual(self.state([self.albwt, self.glyma]), "counted")
+
+    def test_stale_rpkm(self):
+        self.ledger.record("R01", "count", [self.albwt, self.glyma], [self.rpkmfile])
+        self.write('glyma.tsv', 'other lengths')
+        self.assertEqual(self.state([self.albwt, self.glyma]), "aligned")
+
+    def test_streamed_count(self):
+        '''a count streamed from the raw reads is not taken for one of the alignment file'''
+        self.ledger.record("R01", "count", [self.raw, self.glyma], [self.rpkmfile])
+        self.assertEqual(self.state([self.raw, self.glyma]), "counted")
+        self.assertEqual(self.state([self.albwt, self.glyma]), "aligned")
+
+    def test_not_aligned(self):
+        self.write('R01_raw.fq', 'other reads')
+        self.assertEqual(self.state([self.albwt, self.glyma]), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from collections import defaultdict
+
+from Pipeline.LengthIndex import LengthIndex
+
+
+'''LengthIndex: the model lengths of a GlymaFile, compiled once and rebuilt after the file changed'''
+
+
+MODELS = ["Glyma01g%05d.1" % i for i in range(50)]
+
+
+class LengthIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='rnaseq-test-')
+        self.cache = os.path.join(self.folder, 'cache')
+        self.glymafile = os.path.join(self.folder, 'glyma.tsv')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def glyma(self, extra=0, mtime=None):
+        with open(self.glymafile, 'w') as fh:
+            for i, model in enumerate(MODELS):
+                fh.write("%s\t%s\n" % (model, 'A' * (10 + i + extra)))
+        if mtime is not None:
+            os.utime(self.glymafile, (mtime, mtime))
+        return self.glymafile
+
+    def test_lengths(self):
+        index = LengthIndex(self.glyma(), self.cache)
+        self.assertEqual([index[model] for model in MODELS], [10 + i for i in range(len(MODELS))])
+        self.assertEqual(index.get("Glyma20g00000.1"), 0)
+        # the order the original length dict iterated the models in
+        lengthDict = defaultdict(lambda: 0)
+        for i, model in enumerate(MODELS):
+            lengthDict[model] = 10 + i
+        self.assertEqual(list(index), list(lengthDict))
+
+    def test_changed_glyma(self):
+        self.assertEqual(LengthIndex(self.glyma(mtime=1000000000), self.cache)[MODELS[0]], 10)
+        self.glyma(extra=1)
+        self.assertEqual(LengthIndex(self.glymafile, self.cache)[MODELS[0]], 11)
+
+    def test_touched_glyma(self):
+        '''an unchanged file with a new mtime keeps its index'''
+        indexfile = LengthIndex(self.glyma(mtime=1000000000), self.cache).indexfile
+        built = os.stat(indexfile).st_ino
+        os.utime(self.glymafile, (1000000005, 1000000005))
+        self.assertEqual(LengthIndex(self.glymafile, self.cache)[MODELS[1]], 11)
+        # a rebuilt index is written to a new file and renamed into place
+        self.assertEqual(os.stat(indexfile).st_ino, built)
+
+
+if __name__ == '__main__':
+    unittest.main()
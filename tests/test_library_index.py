@@ -0,0 +1,51 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from Pipeline.LibraryIndex import LibraryIndex, library_index
+
+
+'''LibraryIndex: a folder is scanned once and scanned again after it changed'''
+
+
+class LibraryIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='rnaseq-test-')
+        self.cache = os.path.join(self.folder, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def library_folder(self, names):
+        folder = os.path.join(self.folder, 'raw')
+        os.mkdir(folder)
+        for name in names:
+            open(os.path.join(folder, name), 'w').close()
+        # an index is only trusted a second after the folder's last change
+        os.utime(folder, (1000000000, 1000000000))
+        return folder
+
+    def test_reused(self):
+        folder = self.library_folder(["R01_a.fq", "R02_b.fq", "R02_c.fq"])
+        index = LibraryIndex(folder, self.cache)
+        self.assertEqual(index.ids(), ["R01", "R02"])
+        self.assertEqual(index.get("R02"), ["R02_b.fq", "R02_c.fq"])
+        again = LibraryIndex(folder, self.cache)
+        self.assertEqual(again.scanned, index.scanned)
+        self.assertTrue(library_index(folder, self.cache).is_current())
+
+    def test_changed_folder(self):
+        folder = self.library_folder(["R01_a.fq"])
+        index = library_index(folder, self.cache)
+        self.assertEqual(index.ids(), ["R01"])
+        open(os.path.join(folder, "R03_c.fq"), 'w').close()
+        self.assertFalse(index.is_current())
+        self.assertEqual(library_index(folder, self.cache).ids(), ["R01", "R03"])
+        os.remove(os.path.join(folder, "R01_a.fq"))
+        self.assertEqual(library_index(folder, self.cache).ids(), ["R03"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+from StringIO import StringIO
+
+from Pipeline.Metrics import StageMetrics, Measure, ALL, usage
+
+
+'''StageMetrics rows, their summaries and report, and what Measure attributes to a block of work'''
+
+
+class StageMetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='rnaseq-test-')
+        self.metrics = StageMetrics(os.path.join(self.folder, 'metrics.sqlite'))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def report(self):
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            self.metrics.report()
+            return sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+    def test_finish(self):
+        started = time.time()
+        self.metrics.start_run("test")
+        time.sleep(0.3)
+        self.metrics.finish()
+        command, seconds = self.metrics._execute("select command, seconds from pipelineruns where run = ?",
+                                                 (self.metrics.run, ))[0]
+        self.assertEqual(command, "test")
+        self.assertTrue(0.3 <= seconds <= time.time() - started, seconds)
+
+    def test_record(self):
+        run = self.metrics.start_run()
+        self.metrics.record("R01", "count", 2.0, 1.5, 4 * 1024 ** 2, 1000, 30 * 1024 ** 2)
+        self.metrics.record("R02", "count", 4.0, 3.0, 2 * 1024 ** 2, 3000, 20 * 1024 ** 2)
+        self.metrics.record("R03", "count", 1.0, ok=False)
+        self.metrics.record(ALL, "aggregate", 3.0, 2.0, 6 * 1024 ** 2, 8000, 50 * 1024 ** 2)
+        self.metrics.finish()
+        self.assertEqual([row[1:4] for row in self.metrics.slowest()], [("R02", "count", 4.0), ("R01", "count", 2.0)])
+        self.assertEqual(self.metrics.throughput(),
+                         [(run, "aggregate", 1, 3.0, 8000, 6 * 1024 ** 2, 50 * 1024 ** 2),
+                          (run, "count", 2, 6.0, 4000, 6 * 1024 ** 2, 30 * 1024 ** 2)])
+
+    def test_latest_run(self):
+        '''a library's slowest row is the one of its latest run'''
+        self.metrics.start_run()
+        self.metrics.record("R01", "count", 9.0)
+        self.metrics.start_run()
+        self.metrics.record("R01", "count", 1.0)
+        self.assertEqual([row[3] for row in self.metrics.slowest()], [1.0])
+
+    def test_report(self):
+        self.assertIn("no metrics recorded yet", self.report())
+        self.metrics.start_run()
+        self.metrics.record("R01", "count", 2.0, 1.5, 4 * 1024 ** 2, 1000, 30 * 1024 ** 2)
+        self.metrics.finish()
+        lines = self.report().splitlines()
+        self.assertIn("\t".join(["1", "R01", "count", "2.0s", "1.5s", "500", "2.00", "30.0"]), lines)
+        self.assertIn("\t".join(["count", "1", "1", "2.0s", "500", "2.00", "30.0"]), lines)
+
+
+class MeasureTest(unittest.TestCase):
+
+    def test_peaks(self):
+        measure = Measure(children=True)
+        self.assertEqual(measure.stop([None, 5 * 1024 ** 3])[2], 5 * 1024 ** 3)
+        self.assertEqual(measure.stop()[2], usage()[1])
+
+    def test_reaped_child(self):
+        '''the peak of a child waited for earlier is not taken for the block's'''
+        subprocess.check_call([sys.executable, '-c', 'x = " " * (300 * 1024 ** 2)'])
+        self.assertTrue(usage(children=True)[1] >= 300 * 1024 ** 2)
+        wall, cpu, rss = Measure(children=True).stop()
+        self.assertTrue(rss < 300 * 1024 ** 2, rss)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import os
+import time
+import array
+import unittest
+
+from Pipeline import ParallelHelper
+from Pipeline.ParallelHelper import WorkerPool, WorkerError, parmap, pparmap
+
+
+'''WorkerPool: result order, errors raised in & by the workers and shared memory arrays'''
+
+
+def square(x):
+    return x * x
+
+
+def late_square(x):
+    '''the first items take longest, so they are done last'''
+    time.sleep(0.02 * (10 - x % 10))
+    return x * x
+
+
+def fail_on_three(x):
+    if x == 3:
+        raise ValueError("three")
+    return x
+
+
+def die_on_two(x):
+    if x == 2:
+        os._exit(3)
+    return x
+
+
+def big_array(x):
+    return x, array.array('d', [x] * (ParallelHelper.SHARED_BYTES // 8 + 1))
+
+
+def shared_files():
+    return set(f for f in os.listdir(ParallelHelper.SHM_FOLDER) if f.startswith('rnaseq-'))
+
+
+class WorkerPoolTest(unittest.TestCase):
+
+    def test_ordered(self):
+        with WorkerPool(3) as pool:
+            self.assertEqual(list(pool.imap(late_square, range(20))), [x * x for x in range(20)])
+            self.assertEqual(pool.map(late_square, range(20), chunksize=3), [x * x for x in range(20)])
+
+    def test_unordered(self):
+        with WorkerPool(3) as pool:
+            results = list(pool.imap_unordered(late_square, range(20)))
+        self.assertEqual(sorted(results), [x * x for x in range(20)])
+
+    def test_generator_backlog(self):
+        '''items are taken from a generator only as results are handed out'''
+        taken = list()
+
+        def items():
+            for x in xrange(1000):
+                taken.append(x)
+                yield x
+        with WorkerPool(2, backlog=2) as pool:
+            results = pool.imap(square, items(), chunksize=5)
+            self.assertEqual([next(results) for i in range(3)], [0, 1, 4])
+            self.assertTrue(len(taken) <= 5 * 3, len(taken))
+            results.close()
+
+    def test_error(self):
+        with self.assertRaises(WorkerError) as raised:
+            with WorkerPool(2) as pool:
+                pool.map(fail_on_three, range(10))
+        self.assertIn("ValueError: three", raised.exception.traceback)
+
+    def test_dead_worker(self):
+        started = time.time()
+        with self.assertRaises(WorkerError):
+            with WorkerPool(2) as pool:
+                pool.map(die_on_two, range(10))
+        self.assertTrue(time.time() - started < 30)
+
+    def test_shared_arrays(self):
+        before = shared_files()
+        with WorkerPool(2) as pool:
+            results = pool.map(big_array, range(4))
+        self.assertEqual([x for x, values in results], range(4))
+        for x, values in results:
+            self.assertEqual(values.typecode, 'd')
+            self.assertEqual(set(values), set([x]))
+        self.assertEqual(shared_files(), before)
+
+    def test_parmap(self):
+        self.assertEqual(parmap(square, range(5)), [0, 1, 4, 9, 16])
+        self.assertEqual(pparmap(square, range(5), 2), [0, 1, 4, 9, 16])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+import os
+import sys
+import glob
+import gzip
+import shutil
+import hashlib
+import tempfile
+import unittest
+import subprocess
+
+from Pipeline.Benchmark import Benchmark, aggregate_file
+
+
+'''end to end runs on synthetic data with the fake bowtie (see Benchmark)
+
+    the rpkm & aggregate files are compared byte for byte with the files the original RPKMs and
+    MasterRPKM (before the chunked counter, the length & annotation indexes, the dataflow scheduler
+    and the worker pool) wrote for the same synthetic inputs, the alignment files with the output
+    of the fake bowtie run by hand.
+    '''
+
+
+# SyntheticData.generate(libraries=3, reads=2000, models=300, read_length=36, seed=7)
+SYNTHETIC = dict(libraries=3, reads=2000, models=300, read_length=36, seed=7)
+# sha1 of every rpkm file by the library name in its header: RPKMbyDirectory names a library by
+# its id in batch mode, the pipeline has always passed RNASeq.name, which is None
+BASELINE_RPKM = {
+    "R01_Synthetic1_W01_L001.fq.rpkm": {"R01": "2a2d180385d18ea381bfc7baa13115523f4125e4",
+                                        "None": "35db3550efa0d35402fae95e0327407f8035cb98"},
+    "R02_Synthetic2_W02_L001.fq.rpkm": {"R02": "aaee88e26240842bf60f67753b705eb08b2fc09f",
+                                        "None": "986e42a3a48112f74df25400904e2c397eb397ac"},
+    "R03_Synthetic3_W03_L001.fq.rpkm": {"R03": "6df00779d2958b1a3514c43164c5096af0c3e680",
+                                        "None": "a5be2a3acbf3034f14f5d72693268b2627712f8f"},
+}
+BASELINE_HITS = "86384ac69344d2503384309e90692b1a5ab54200"
+BASELINE_RPKMS = "c7013e859063892f2b05ea199c4bc4461434de01"
+
+
+def sha1(filename):
+    with open(filename, 'rb') as fh:
+        return hashlib.sha1(fh.read()).hexdigest()
+
+
+class EndToEndTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.work = tempfile.mkdtemp(prefix='rnaseq-test-')
+        cls.bench = Benchmark(cls.work, SYNTHETIC["libraries"], SYNTHETIC["reads"], SYNTHETIC["models"],
+                              SYNTHETIC["read_length"], SYNTHETIC["seed"], cores=2)
+        cls.config = cls.bench.config()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.work, ignore_errors=True)
+
+    def pipeline(self, *args):
+        '''runs the pipeline's command line against the benchmark config, returns its output'''
+        env = dict(os.environ)
+        env["RNASEQ_DB"] = self.bench.dbfile
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env["PYTHONPATH"] = root + (os.pathsep + env["PYTHONPATH"] if env.get("PYTHONPATH") else '')
+        child = subprocess.Popen([sys.executable, '-m', 'Pipeline', '-manifest', 'manifest.json'] + list(args),
+                                 env=env, cwd=self.bench.run_folder, stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT)
+        output = child.communicate()[0]
+        self.assertEqual(child.returncode, 0, output)
+        return output
+
+    def assertBaseline(self, named=True):
+        '''named - the rpkm files are headed by the library id (else by "None")'''
+        for name, digests in sorted(BASELINE_RPKM.items()):
+            expected = digests[name.partition('_')[0] if named else "None"]
+            self.assertEqual(sha1(os.path.join(self.config["RPKM Output"], name)), expected, name)
+        hits = glob.glob(os.path.join(self.config["Aggregate Output"], "Hits", "*.tsv"))
+        self.assertEqual([sha1(f) for f in hits], [BASELINE_HITS])
+        self.assertEqual(sha1(aggregate_file(self.config)), BASELINE_RPKMS)
+
+    def fake_bowtie(self, raw):
+        '''the alignments of a raw file as the fake bowtie writes them when it is run by hand'''
+        prefix = glob.glob(os.path.join(self.config["Cache Path"], "indexes", "*", "index.1.ebwt"))[0][:-len(".1.ebwt")]
+        return subprocess.check_output([os.path.join(self.config["Bowtie Path"], "bowtie"), "-v", "2", "-a",
+                                        "-m", "25", prefix, raw], stderr=open(os.devnull, 'w'))
+
+    def test_stages(self):
+        results = self.bench.run(["align", "count", "aggregate"])
+        self.assertEqual([r["stage"] for r in results if r["ok"]], ["align", "count", "aggregate"])
+        self.assertBaseline()
+        for raw in sorted(os.listdir(self.config["Raw Path"])):
+            with open(os.path.join(self.config["Bowtie Output"], raw + ".albwt"), 'rb') as fh:
+                self.assertEqual(fh.read(), self.fake_bowtie(os.path.join(self.config["Raw Path"], raw)), raw)
+
+    def test_resume(self):
+        '''a rerun leaves finished libraries alone and only redoes what is missing'''
+        self.bench.prepare()
+        self.pipeline('-pipeline')
+        self.assertBaseline(named=False)
+        rpkms = sorted(glob.glob(os.path.join(self.config["RPKM Output"], "*.rpkm")))
+        mtimes = [os.stat(f).st_mtime for f in rpkms]
+        output = self.pipeline('-pipeline')
+        # every library has its rpkm file, none is queued (see RNASeqManager.MissingLibraries)
+        self.assertIn("aligned & counted 0 libraries", output)
+        self.assertIn("aggregate is up to date", output)
+        self.assertEqual([os.stat(f).st_mtime for f in rpkms], mtimes)
+        os.remove(rpkms[1])
+        output = self.pipeline('-pipeline')
+        # the ledger still holds R02's alignment, only its count is redone
+        self.assertIn("R02: already aligned, counting", output)
+        self.assertIn("aligned & counted 1 libraries", output)
+        self.assertEqual(os.stat(rpkms[0]).st_mtime, mtimes[0])
+        self.assertBaseline(named=False)
+
+    def test_stream_shards(self):
+        '''counting bowtie's output of two shards as it arrives gives the same files, the tee keeps every alignment'''
+        self.bench.prepare()
+        self.pipeline('-pipeline', '-shards', '2', '-tee')
+        self.assertBaseline(named=False)
+        raw = sorted(os.listdir(self.config["Raw Path"]))[0]
+        tee = gzip.open(os.path.join(self.config["Bowtie Output"], raw + ".albwt.gz"))
+        try:
+            self.assertEqual(sorted(tee.read().splitlines()),
+                             sorted(self.fake_bowtie(os.path.join(self.config["Raw Path"], raw)).splitlines()))
+        finally:
+            tee.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
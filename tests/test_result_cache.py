@@ -0,0 +1,96 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from Pipeline.RPKM import RPKMs
+from Pipeline.ResultCache import ResultCache
+
+
+'''ResultCache: rpkm results are reused while the alignment & GlymaFile are unchanged'''
+
+
+MODELS = ["Glyma01g%05d.1" % i for i in range(50)]
+
+
+class ResultCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='rnaseq-test-')
+        self.cache = os.path.join(self.folder, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def write(self, name, lines):
+        path = os.path.join(self.folder, name)
+        with open(path, 'w') as fh:
+            fh.write(''.join(line + '\n' for line in lines))
+        return path
+
+    def glyma(self, extra=0):
+        return self.write('glyma.tsv', ["%s\t%s" % (model, 'A' * (10 + i + extra)) for i, model in enumerate(MODELS)])
+
+    def alignments(self, models):
+        return self.write('R01_Test_W01.fq.albwt', ["read%s\t+\t%s\t0\tACGT\tIIII\t0" % (i, model)
+                                                    for i, model in enumerate(models)])
+
+    def rpkm(self, output, cache_size=1):
+        rpkm = RPKMs(bowtiefile=os.path.join(self.folder, 'R01_Test_W01.fq.albwt'),
+                     glymafile=os.path.join(self.folder, 'glyma.tsv'),
+                     outputfile=os.path.join(self.folder, output), libraryname="R01",
+                     index_folder=self.cache, cache_size=cache_size)
+        rpkm.runRPKM()
+        with open(rpkm.outputfile) as fh:
+            return fh.read()
+
+    def stats(self):
+        return json.load(open(ResultCache(self.cache).statsfile))
+
+    def test_reuse(self):
+        self.glyma()
+        self.alignments(MODELS[:10] * 3)
+        counted = self.rpkm('1.rpkm')
+        self.assertEqual(self.stats(), {"lookups": 1, "stores": 1, "evictions": 0})
+        self.assertEqual(self.rpkm('2.rpkm'), counted)
+        self.assertEqual(self.stats()["hits"], 1)
+        self.assertEqual(self.rpkm('3.rpkm', cache_size=0), counted)
+
+    def test_hashed_while_counting(self):
+        '''a new alignment file is hashed by the count, its hash is then known until the file changes'''
+        self.glyma()
+        bowtiefile = self.alignments(MODELS[:10])
+        cache = ResultCache(self.cache)
+        key = lambda: cache.known_key(bowtiefile, os.path.join(self.folder, 'glyma.tsv'), 2, 2)
+        self.assertEqual(key(), None)
+        self.rpkm('1.rpkm')
+        self.assertEqual(key(), cache.key(bowtiefile, os.path.join(self.folder, 'glyma.tsv'), 2, 2))
+        os.utime(bowtiefile, (1000000000, 1000000000))
+        self.assertEqual(key(), None)
+
+    def test_changed_alignments(self):
+        self.glyma()
+        self.alignments(MODELS[:10])
+        first = self.rpkm('1.rpkm')
+        self.alignments(MODELS[:10] + MODELS[20:25])
+        second = self.rpkm('2.rpkm')
+        self.assertNotEqual(second, first)
+        self.assertEqual(self.stats().get("hits", 0), 0)
+        self.assertEqual(self.rpkm('3.rpkm', cache_size=0), second)
+
+    def test_changed_glyma(self):
+        self.glyma()
+        self.alignments(MODELS[:10])
+        first = self.rpkm('1.rpkm')
+        self.glyma(extra=5)
+        self.assertNotEqual(self.rpkm('2.rpkm'), first)
+        self.assertEqual(self.stats().get("hits", 0), 0)
+
+    def test_off(self):
+        for size in [0, '0', '', None]:
+            self.assertEqual(RPKMs(index_folder=self.cache, cache_size=size).getCache(), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+from StringIO import StringIO
+
+from Pipeline import Scheduler
+from Pipeline.Scheduler import BowtieScheduler, JOB_OVERHEAD
+
+
+'''BowtieScheduler: threads per job by input size and concurrent jobs within the core & memory budget'''
+
+
+INDEX_BYTES = 1000
+JOB_MEMORY = INDEX_BYTES + JOB_OVERHEAD
+
+
+class Job(object):
+    '''stands in for a Bowtie: a query file of size bytes and a reference with an INDEX_BYTES index'''
+
+    def __init__(self, folder, name, size, shards=1):
+        self.query = os.path.join(folder, name + '.fq')
+        with open(self.query, 'w') as fh:
+            fh.write('A' * size)
+        self.reference = os.path.join(folder, 'index')
+        self.shards = shards
+        self.threads = None
+
+
+class BowtieSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='rnaseq-test-')
+        with open(os.path.join(self.folder, 'index.1.ebwt'), 'w') as fh:
+            fh.write('I' * INDEX_BYTES)
+        self.host = (Scheduler.host_cores, Scheduler.host_memory)
+        Scheduler.host_cores = lambda: 8
+        Scheduler.host_memory = lambda: 64 * 1024 ** 3
+        self.stdout, sys.stdout = sys.stdout, StringIO()
+        self.lock = threading.Lock()
+        self.running = 0
+        self.most = 0
+        self.started = list()
+
+    def tearDown(self):
+        Scheduler.host_cores, Scheduler.host_memory = self.host
+        sys.stdout = self.stdout
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def jobs(self, sizes, shards=1):
+        return dict(("R%02d" % (i + 1), Job(self.folder, "R%02d" % (i + 1), size, shards))
+                    for i, size in enumerate(sizes))
+
+    def run_job(self, lib, bowtie):
+        '''records the jobs running at once and the threads each one was given'''
+        with self.lock:
+            self.running += 1
+            self.most = max(self.most, self.running)
+            self.started.append((lib, bowtie.threads))
+        time.sleep(0.2)
+        with self.lock:
+            self.running -= 1
+
+    def schedule(self, scheduler, jobs):
+        done = dict()
+        scheduler.run(jobs, callback=lambda lib, error: done.setdefault(lib, error), run=self.run_job)
+        return done
+
+    def test_limits(self):
+        self.assertEqual(BowtieScheduler().cores, 8)
+        self.assertEqual(BowtieScheduler(max_cores=4).cores, 4)
+        self.assertEqual(BowtieScheduler(max_cores=16).cores, 8)
+        self.assertEqual(BowtieScheduler(max_memory=1024 ** 3).memory, 1024 ** 3)
+        self.assertEqual(BowtieScheduler(max_memory=128 * 1024 ** 3).memory, 64 * 1024 ** 3)
+        self.assertEqual(BowtieScheduler(max_cores=1).min_threads, 1)
+
+    def test_from_config(self):
+        '''blank options leave the host's cores & memory'''
+        scheduler = Scheduler.from_config({"Max Cores": "", "Max Memory": "", "-p": ""})
+        self.assertEqual((scheduler.cores, scheduler.memory, scheduler.max_threads), (8, 64 * 1024 ** 3, 8))
+        scheduler = Scheduler.from_config({"Max Cores": "4", "Max Memory": "1.5", "-p": "3"})
+        self.assertEqual((scheduler.cores, scheduler.memory, scheduler.max_threads), (4, 1.5 * 1024 ** 3, 3))
+
+    def test_threads_by_size(self):
+        '''the largest job starts first, both share the cores by input size'''
+        done = self.schedule(BowtieScheduler(), self.jobs([1000, 3000]))
+        self.assertEqual(done, {"R01": None, "R02": None})
+        self.assertEqual(self.started, [("R02", 6), ("R01", 2)])
+        self.assertEqual(self.most, 2)
+
+    def test_max_threads(self):
+        self.schedule(BowtieScheduler(max_threads=3), self.jobs([1000]))
+        self.assertEqual(self.started, [("R01", 3)])
+
+    def test_core_budget(self):
+        '''a job needs min_threads free cores, so 3 cores run one job at a time'''
+        self.schedule(BowtieScheduler(max_cores=3), self.jobs([1000, 1000, 1000]))
+        self.assertEqual(self.most, 1)
+        self.assertEqual([threads for lib, threads in self.started], [3, 3, 3])
+
+    def test_memory_budget(self):
+        '''jobs only start while their index copies fit in the memory left'''
+        self.schedule(BowtieScheduler(max_memory=2 * JOB_MEMORY), self.jobs([1000] * 4))
+        self.assertEqual(self.most, 2)
+        self.assertEqual(len(self.started), 4)
+
+    def test_sharded_memory(self):
+        '''every shard's bowtie process loads its own copy of the index'''
+        self.schedule(BowtieScheduler(max_memory=2 * JOB_MEMORY), self.jobs([1000] * 3, shards=2))
+        self.assertEqual(self.most, 1)
+
+    def test_first_job_always_starts(self):
+        '''a job larger than the memory budget still runs once nothing else does'''
+        done = self.schedule(BowtieScheduler(max_memory=JOB_MEMORY // 2), self.jobs([1000, 1000]))
+        self.assertEqual(sorted(done), ["R01", "R02"])
+        self.assertEqual(self.most, 1)
+
+    def test_failed_job(self):
+        def fail(lib, bowtie):
+            raise ValueError("no index")
+        done = dict()
+        BowtieScheduler().run(self.jobs([1000]), callback=lambda lib, error: done.setdefault(lib, error), run=fail)
+        self.assertIn("ValueError: no index", done["R01"])
+
+
+if __name__ == '__main__':
+    unittest.main()
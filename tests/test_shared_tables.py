@@ -0,0 +1,72 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from Pipeline.LengthIndex import shared_index
+from Pipeline.ModelTable import shared_table
+
+
+'''shared_index & shared_table: one mapping per file and process, replaced once the file changed'''
+
+
+MODELS = ["Glyma01g%05d.1" % i for i in range(50)]
+
+
+class SharedTableTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='rnaseq-test-')
+        self.cache = os.path.join(self.folder, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def write(self, name, lines, mtime=None):
+        path = os.path.join(self.folder, name)
+        with open(path, 'w') as fh:
+            fh.write(''.join(line + '\n' for line in lines))
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+        return path
+
+    def glyma(self, extra=0, mtime=None):
+        return self.write('glyma.tsv', ["%s\t%s" % (model, 'A' * (10 + i + extra))
+                                        for i, model in enumerate(MODELS)], mtime)
+
+    def test_shared_index(self):
+        glymafile = self.glyma()
+        index = shared_index(glymafile, self.cache)
+        self.assertEqual(index[MODELS[2]], 12)
+        self.assertTrue(shared_index(glymafile, self.cache) is index)
+
+    def test_changed_glyma(self):
+        glymafile = self.glyma(mtime=1000000000)
+        index = shared_index(glymafile, self.cache)
+        self.glyma(extra=1)
+        changed = shared_index(glymafile, self.cache)
+        self.assertFalse(changed is index)
+        self.assertEqual(changed[MODELS[0]], 11)
+
+    def test_table_values(self):
+        tablefile = self.write('cds_Length.tsv', ["Model\tLength"] + ["%s\t%s" % (model, i)
+                                                                     for i, model in enumerate(MODELS)] +
+                               ["%s\tlast" % MODELS[3]])
+        table = shared_table(tablefile, self.cache)
+        self.assertEqual(table[MODELS[2]], "2")
+        self.assertEqual(table[MODELS[3]], "last")
+        self.assertEqual(table["Glyma20g00000.1"], 0)
+        self.assertEqual(len(table), len(MODELS))
+        self.assertTrue(shared_table(tablefile, self.cache) is table)
+
+    def test_changed_table(self):
+        tablefile = self.write('cds_Length.tsv', ["Model\tLength", "%s\t1" % MODELS[0]], mtime=1000000000)
+        table = shared_table(tablefile, self.cache)
+        self.write('cds_Length.tsv', ["Model\tLength", "%s\t2" % MODELS[0], "%s\t3" % MODELS[1]])
+        changed = shared_table(tablefile, self.cache)
+        self.assertFalse(changed is table)
+        self.assertEqual((changed[MODELS[0]], changed[MODELS[1]]), ("2", "3"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from Pipeline.tsv_splitter import Splitter, ExcelSplitter, OVERFLOW
+
+
+'''Splitter: the library columns of an aggregate file divided into several files in one pass
+ExcelSplitter: shards within a row & column limit'''
+
+
+LEADING = ["Model", "cds Length", "cDNA Length", "Hit Number"]
+TRAILING = ["Keywords", "nr Annotation"]
+
+
+class SplitTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='rnaseq-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def aggregate(self, libraries=6, models=4, rows=None):
+        '''an aggregate file with 10 transcript rows per model (or the given rows)'''
+        self.libraries = ["R%02d_Lib%s_W01 Hits" % (i, i) for i in range(1, libraries + 1)]
+        self.header = LEADING + self.libraries + TRAILING
+        self.rows = rows
+        if rows is None:
+            self.rows = [["Glyma%02d" % m, "100", "120", str(i)] + [str(m * l) for l in range(libraries)] +
+                         ["key%s" % m, "nr%s.%s" % (m, i)] for m in range(models) for i in range(1, 11)]
+        self.entryfile = os.path.join(self.folder, 'RNASeq.Hits.tsv')
+        with open(self.entryfile, 'w') as fh:
+            for row in [self.header] + self.rows:
+                fh.write('\t'.join(row) + '\n')
+        return self.entryfile
+
+    def read(self, filename):
+        with open(filename) as fh:
+            return [line.rstrip('\n').split('\t') for line in fh]
+
+    def columns(self, filename):
+        '''the library columns of a written file'''
+        return [h for h in self.read(filename)[0] if h in self.libraries]
+
+    def assertSplit(self, files, libraries):
+        '''every file holds the leading & trailing columns around its libraries, for every row'''
+        self.assertEqual([self.columns(f) for f in files], [[self.libraries[i - 1] for i in part]
+                                                            for part in libraries])
+        for f, part in zip(files, libraries):
+            index = [len(LEADING) + i - 1 for i in part]
+            expected = [row[:len(LEADING)] + [row[i] for i in index] + row[-len(TRAILING):]
+                        for row in [self.header] + self.rows]
+            self.assertEqual(self.read(f), expected, f)
+
+
+class SplitterTest(SplitTest):
+
+    def test_cutpoints(self):
+        files = Splitter(entryfile=self.aggregate(), cutpoints=[5, 3])._get_list()
+        self.assertEqual([os.path.basename(f) for f in files],
+                         ["RNASeq.Hits.1.tsv", "RNASeq.Hits.2.tsv", "RNASeq.Hits.3.tsv"])
+        self.assertSplit(files, [[1, 2], [3, 4], [5, 6]])
+
+    def test_cutofflibrary(self):
+        files = Splitter(entryfile=self.aggregate(), cutofflibrary=4)._get_list()
+        self.assertSplit(files, [[1, 2, 3], [4, 5, 6]])
+
+    def test_outside_cutpoints(self):
+        '''cutpoints at or before the first library or after the last one start no file'''
+        files = Splitter(entryfile=self.aggregate(), cutpoints=[1, 4, 20])._get_list()
+        self.assertSplit(files, [[1, 2, 3], [4, 5, 6]])
+
+    def test_nfiles(self):
+        files = Splitter(entryfile=self.aggregate(libraries=7), nfiles=3)._get_list()
+        self.assertSplit(files, [[1, 2, 3], [4, 5, 6], [7]])
+
+    def test_no_libraries(self):
+        entryfile = os.path.join(self.folder, 'other.tsv')
+        with open(entryfile, 'w') as fh:
+            fh.write("Model\tLength\nGlyma01\t10\n")
+        self.assertRaises(ValueError, Splitter, entryfile=entryfile)
+
+
+class ExcelSplitterTest(SplitTest):
+
+    def shards(self, **limits):
+        splitter = ExcelSplitter(entryfile=self.aggregate(**limits.pop('aggregate', {})), **limits)
+        return splitter, [self.read(f) for f in splitter._get_list()]
+
+    def test_column_budget(self):
+        '''the leading & trailing columns leave 2 libraries per shard'''
+        splitter, shards = self.shards(max_columns=len(LEADING) + len(TRAILING) + 2)
+        self.assertEqual([self.columns(f) for f in splitter._get_list()],
+                         [self.libraries[0:2], self.libraries[2:4], self.libraries[4:6]])
+        self.assertEqual(set(len(row) for shard in shards for row in shard), set([8]))
+        self.assertEqual([row[:len(LEADING)] + row[-len(TRAILING):] for row in shards[0]],
+                         [row[:len(LEADING)] + row[-len(TRAILING):] for row in [self.header] + self.rows])
+
+    def test_row_shards(self):
+        '''20 rows besides the header are two models, a model's rows stay in one shard'''
+        splitter, shards = self.shards(max_rows=26, aggregate=dict(models=5))
+        self.assertEqual([os.path.basename(f) for f in splitter._get_list()],
+                         ["RNASeq.Hits.%s-1.tsv" % i for i in (1, 2, 3)])
+        self.assertEqual([len(shard) for shard in shards], [21, 21, 11])
+        self.assertEqual([shard[0] for shard in shards], [self.header] * 3)
+        self.assertEqual([row for shard in shards for row in shard[1:]], self.rows)
+
+    def test_large_model(self):
+        '''a model with more rows than a shard holds is cut where the shard is full'''
+        splitter, shards = self.shards(max_rows=5, aggregate=dict(models=1))
+        self.assertEqual([len(shard) for shard in shards], [5, 5, 3])
+
+    def test_index(self):
+        splitter, shards = self.shards(max_rows=21, max_columns=len(LEADING) + len(TRAILING) + 3)
+        index = self.read(splitter.indexfile)
+        self.assertEqual(index[0], ["Shard", "Rows", "Models", "First Model", "Last Model", "Libraries"])
+        self.assertEqual(index[1:], [
+            ["RNASeq.Hits.1-1.tsv", "20", "2", "Glyma00", "Glyma01", ",".join(self.libraries[:3])],
+            ["RNASeq.Hits.1-2.tsv", "20", "2", "Glyma00", "Glyma01", ",".join(self.libraries[3:])],
+            ["RNASeq.Hits.2-1.tsv", "20", "2", "Glyma02", "Glyma03", ",".join(self.libraries[:3])],
+            ["RNASeq.Hits.2-2.tsv", "20", "2", "Glyma02", "Glyma03", ",".join(self.libraries[3:])]])
+
+    def test_wide_rows(self):
+        '''a row wider than the header keeps to the header's width, its extra columns joined into the last'''
+        self.aggregate()
+        self.rows[3] = self.rows[3] + ["nr more", "nr last"]
+        splitter, shards = self.shards(max_columns=len(LEADING) + len(TRAILING) + 2,
+                                       aggregate=dict(rows=self.rows))
+        for shard in shards:
+            self.assertEqual(set(len(row) for row in shard), set([8]))
+            self.assertEqual(shard[4][-1], OVERFLOW.join([self.rows[3][-3], "nr more", "nr last"]))
+
+    def test_too_many_columns(self):
+        self.assertRaises(ValueError, self.shards, max_columns=len(LEADING) + len(TRAILING))
+
+
+if __name__ == '__main__':
+    unittest.main()